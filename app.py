@@ -1,26 +1,64 @@
 import streamlit as st
-import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
-from google.cloud import vision
-import io
-from PIL import Image
 import json
 import re
+import sys
+import importlib
+import unicodedata
 import os
-import cv2
 import numpy as np
 from datetime import datetime
 import base64
 import random
+import hashlib
+import sqlite3
+import threading
+import time
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 # FORCE DEPLOY vFinal - Production Stable
 
-st.set_page_config(
-    page_title="予約カードOCRシステム",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+class LazyModule:
+    """
+    属性に初めてアクセスしたときに import するモジュールの代理。
+    cv2 / Vision / gspread は読み込みに数百msかかるため、起動直後の画面表示を待たせないよう遅らせる
+    (start_prewarm がバックグラウンドで先に読み込む)。
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            # sys.modules にあっても別スレッド (serve.py の先読み) が読み込み途中のことがあるため、
+            # import_module で読み込みの完了を待つ
+            loaded = self._name in sys.modules
+            started = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            if not loaded:
+                record_stage("import", time.perf_counter() - started, module=self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        # 差し替え (テスト用のスタブなど) は代理ではなくモジュール本体に反映する
+        if attr.startswith("_"):
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._load(), attr, value)
+
+cv2 = LazyModule("cv2")
+vision = LazyModule("google.cloud.vision")
+gspread = LazyModule("gspread")
+gapi_exceptions = LazyModule("google.api_core.exceptions")
+gauth_exceptions = LazyModule("google.auth.exceptions")
+service_account = LazyModule("google.oauth2.service_account")
 
 def local_css():
     st.markdown("""
@@ -57,37 +95,468 @@ def local_css():
 SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1McrtrFeMCufGrzVJgaKFGJMyO5kSLnv9hEHGnah9t4A/edit?usp=sharing"
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/cloud-vision"]
 
+# スプレッドシートのA〜J列に対応する項目 (書き込み順)
+SHEET_COLUMNS = ["氏名", "フリガナ", "生年月日", "職業", "住所", "電話番号", "メールアドレス", "チェックイン日", "チェックアウト日", "メール配信"]
+# 旧レイアウトの項目 → 転記先の列
+FIELD_ALIASES = {"年齢": "生年月日"}
+DATE_FIELDS = ["生年月日", "チェックイン日", "チェックアウト日"]
+CONSENT_FIELD = "メール配信"
+# batch_annotate_images 1リクエストあたりの画像上限 (Vision API の同期バッチ制限)
+VISION_BATCH_LIMIT = 16
+OCR_FEATURE = "TEXT_DETECTION"
+OCR_LANGUAGE_HINTS = ["ja", "en"]
+# 非同期OCR (一括取り込み) の同時RPC数と、一時的なエラーの再試行
+VISION_MAX_CONCURRENCY = int(os.environ.get("VISION_MAX_CONCURRENCY", "4"))
+VISION_MAX_RETRIES = 4
+VISION_RETRY_BASE = 1.0   # 再試行の待ち時間 (秒) は 1, 2, 4, 8... にジッターを掛ける
+VISION_MAX_BACKOFF = 30.0
+# 再試行する google.api_core.exceptions の例外 (import を遅らせるためクラス名で持つ)
+VISION_RETRYABLE_ERRORS = ("ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError")
+
+# 読み取り結果 (個人情報) を保存するOCR結果キャッシュと重複カードの索引に共通の保存期間 (最後に使ってから)
+PERSONAL_DATA_RETENTION_SEC = float(os.environ.get("PERSONAL_DATA_RETENTION_DAYS", "14")) * 86400
+# OCR結果キャッシュ (セル画像のハッシュ → テキスト)。保存期間を過ぎたもの・サイズ上限を超えた分を最終利用が古い順に削除
+OCR_CACHE_PATH = os.environ.get("OCR_CACHE_PATH", ".ocr_cache.sqlite3")
+OCR_CACHE_MAX_BYTES = int(os.environ.get("OCR_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
 def load_credentials(source):
     try:
         if isinstance(source, str):
-            creds = Credentials.from_service_account_file(source, scopes=SCOPES)
+            creds = service_account.Credentials.from_service_account_file(source, scopes=SCOPES)
         elif isinstance(source, dict):
-            creds = Credentials.from_service_account_info(source, scopes=SCOPES)
+            creds = service_account.Credentials.from_service_account_info(source, scopes=SCOPES)
         else:
             creds_dict = json.load(source)
-            creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+            creds = service_account.Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
         return creds
     except Exception as e:
         st.error(f"認証エラー: {e}")
         return None
 
-def get_aligned_card_and_crops(image_bytes, use_enhance=True):
+def find_credentials():
     """
-    画像を読み込み、カードの輪郭を検出して正面の 1000x360 画像に補正。
-    その後、9つの入力セルエリアを切り出して返却する。
+    ローカルファイル → 環境変数(Render) → Streamlit Secrets の順に認証キーを探す。
+    (credentials, 読込元ラベル) を返し、見つからなければ (None, None)。
+    """
+    if os.path.exists("service_account.json"):
+        return load_credentials("service_account.json"), "Local"
+    if os.environ.get("GCP_SERVICE_ACCOUNT_JSON"):
+        creds_dict = json.loads(os.environ.get("GCP_SERVICE_ACCOUNT_JSON"))
+        return load_credentials(creds_dict), "Render Env"
+    try:
+        has_secrets = 'gcp_service_account' in st.secrets
+    except Exception:
+        has_secrets = False  # secrets.toml が無い環境 (CLI実行など)
+    if has_secrets:
+        return load_credentials(dict(st.secrets['gcp_service_account'])), "Secrets"
+    return None, None
+
+@st.cache_resource
+def _cached_credentials():
+    return find_credentials()
+
+def get_credentials():
+    """
+    find_credentials の結果をプロセスで共有する (事前準備のスレッドが読み込んでおき、画面の再実行ごとに google-auth を待たない)。
+    見つからなかった場合はキャッシュせず、次回また探す (認証キーを後から設定した場合)。
+    """
+    creds, source = _cached_credentials()
+    if creds is None:
+        _cached_credentials.clear()
+    return creds, source
+
+# 処理段階ごとの計測 (JSONログ・サイドバーのデバッグ表示・Prometheus形式の /metrics)
+METRIC_BUCKETS_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_RECENT_SAMPLES = 200  # サイドバーの p50/p95 に使う直近サンプル数
+
+logger = logging.getLogger("res_card_ocr")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# 現在の処理 (OCR 1回分など) で記録された [(段階名, ミリ秒), ...]。collect_spans() の中でだけ有効
+_current_spans = contextvars.ContextVar("current_spans", default=None)
+
+@st.cache_resource
+def get_metrics():
+    """プロセス共通の段階別ヒストグラム (累積) と直近サンプル"""
+    return {"lock": threading.Lock(), "histograms": {}, "recent": {}}
+
+def record_stage(stage, seconds, **fields):
+    """段階の所要時間をヒストグラムに加算し、JSONログ1行を出力する"""
+    metrics = get_metrics()
+    with metrics["lock"]:
+        hist = metrics["histograms"].setdefault(stage, {"buckets": [0] * len(METRIC_BUCKETS_SEC), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(METRIC_BUCKETS_SEC):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+        metrics["recent"].setdefault(stage, deque(maxlen=METRIC_RECENT_SAMPLES)).append(seconds)
+    spans = _current_spans.get()
+    if spans is not None:
+        spans.append((stage, seconds * 1000))
+    logger.info(json.dumps({"event": "stage", "stage": stage, "ms": round(seconds * 1000, 2), **fields}, ensure_ascii=False))
+
+@contextmanager
+def stage_span(stage, **fields):
+    """with ブロックの所要時間を段階 stage として記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, **fields)
+
+@contextmanager
+def collect_spans():
+    """with ブロック内で記録された段階を [(段階名, ミリ秒), ...] として集める"""
+    spans = []
+    token = _current_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _current_spans.reset(token)
+
+def stage_summary():
+    """段階ごとの直近 p50/p95 (ミリ秒) と累積件数"""
+    metrics = get_metrics()
+    with metrics["lock"]:
+        recent = {stage: sorted(values) for stage, values in metrics["recent"].items()}
+        counts = {stage: hist["count"] for stage, hist in metrics["histograms"].items()}
+    return [
+        {"段階": stage, "p50 (ms)": round(values[len(values) // 2] * 1000, 1),
+         "p95 (ms)": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 1), "件数": counts[stage]}
+        for stage, values in recent.items() if values
+    ]
+
+def render_prometheus_metrics():
+    """Prometheus のテキスト形式で段階別ヒストグラム・OCRキャッシュ・転記キューの値を返す"""
+    metrics = get_metrics()
+    lines = ["# HELP res_card_ocr_stage_duration_seconds Processing time per pipeline stage.",
+             "# TYPE res_card_ocr_stage_duration_seconds histogram"]
+    with metrics["lock"]:
+        for stage, hist in sorted(metrics["histograms"].items()):
+            for bound, count in zip(METRIC_BUCKETS_SEC, hist["buckets"]):
+                lines.append(f'res_card_ocr_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'res_card_ocr_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+            lines.append(f'res_card_ocr_stage_duration_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+            lines.append(f'res_card_ocr_stage_duration_seconds_count{{stage="{stage}"}} {hist["count"]}')
+
+    cache = ocr_cache_stats()
+    lines += ["# TYPE res_card_ocr_cache_hits_total counter", f"res_card_ocr_cache_hits_total {cache['hits']}",
+              "# TYPE res_card_ocr_cache_misses_total counter", f"res_card_ocr_cache_misses_total {cache['misses']}",
+              "# TYPE res_card_ocr_outbox_pending gauge"]
+    for target, depth in outbox_depth().items():
+        lines.append(f'res_card_ocr_outbox_pending{{target="{target}"}} {depth}')
+    lines.append("# TYPE res_card_ocr_outbox_dead gauge")
+    for target, depth in outbox_depth("outbox_dead").items():
+        lines.append(f'res_card_ocr_outbox_dead{{target="{target}"}} {depth}')
+
+    status = startup_status()
+    lines += ["# HELP res_card_ocr_startup_seconds Seconds from process start until the first page was rendered / everything was prewarmed.",
+              "# TYPE res_card_ocr_startup_seconds gauge"]
+    for phase in ("shell", "ready"):
+        if status[f"{phase}_sec"] is not None:
+            lines.append(f'res_card_ocr_startup_seconds{{phase="{phase}"}} {status[f"{phase}_sec"]}')
+    return "\n".join(lines) + "\n"
+
+# /warmup?wait=秒 で準備完了を待つ時間の上限
+WARMUP_MAX_WAIT = 60.0
+
+def healthz_response():
+    """/healthz の (ステータス, 本文)。プロセスが応答できれば 200 (準備の完了は待たない)"""
+    return 200, dict(startup_status(), status="ok")
+
+def warmup_response(wait):
+    """/warmup の (ステータス, 本文)。事前準備を始めて最大 wait 秒待ち、完了していれば 200、準備中なら 202"""
+    start_prewarm()
+    try:
+        wait = float(wait or 0)
+    except ValueError:
+        wait = 0.0
+    warm = get_startup()["done"].wait(min(max(wait, 0.0), WARMUP_MAX_WAIT))
+    return (200 if warm else 202), startup_status()
+
+def health_routes():
+    """
+    Streamlit のサーバー (st.App) に載せる /healthz・/warmup・/metrics のルート。Render は $PORT しか外に出さないため、
+    serve.py が画面と同じポートで返す。同期関数のエンドポイントは Starlette がスレッドプールで実行する。
+    """
+    from starlette.responses import JSONResponse, PlainTextResponse
+    from starlette.routing import Route
+
+    def healthz(request):
+        status, body = healthz_response()
+        return JSONResponse(body, status_code=status)
+
+    def warmup(request):
+        status, body = warmup_response(request.query_params.get("wait"))
+        return JSONResponse(body, status_code=status)
+
+    def metrics(request):
+        return PlainTextResponse(render_prometheus_metrics(), media_type="text/plain; version=0.0.4")
+    return [Route("/healthz", healthz), Route("/warmup", warmup), Route("/metrics", metrics)]
+
+# 起動時間の計測とバックグラウンドでの事前準備 (コールドスタート対策)
+# 起動スクリプト (serve.py) がプロセスの起動時刻を渡す。streamlit run で直接起動した場合は最初の実行の開始を起点にする
+PROCESS_STARTED_ENV = "APP_PROCESS_STARTED"
+
+@st.cache_resource
+def get_startup():
+    """プロセス共通の起動時間の記録 (時刻は time.time()、steps は事前準備の手順ごとのミリ秒またはエラー)"""
+    origin = float(os.environ.get(PROCESS_STARTED_ENV) or 0) or time.time()
+    return {"origin": origin, "shell": None, "ready": None, "steps": {}, "done": threading.Event()}
+
+def startup_status():
+    """起動時間 (秒、未到達なら None) と事前準備の状況"""
+    startup = get_startup()
+
+    def elapsed(t):
+        return None if t is None else round(t - startup["origin"], 3)
+    return {"warm": startup["done"].is_set(), "shell_sec": elapsed(startup["shell"]),
+            "ready_sec": elapsed(startup["ready"]), "steps": dict(startup["steps"])}
+
+def mark_shell_rendered():
+    """最初の画面 (タイトル) を表示し終えた時刻を記録する (プロセスごとに1回。認証キーがない場合も記録する)"""
+    startup = get_startup()
+    if startup["shell"] is None:
+        startup["shell"] = time.time()
+        logger.info(json.dumps({"event": "startup_shell", "sec": startup_status()["shell_sec"]}))
+
+def prewarm():
+    """
+    重いライブラリの読み込みとテンプレートの準備、認証キー・Vision クライアントの生成、転記キューの書き込みスレッドの起動、
+    シート行の索引の読み込みを順に行い、
+    手順ごとの所要時間を get_startup() に記録する。失敗した手順はエラーを記録して先へ進む (実際の利用時に改めて試みる)。
+    """
+    startup = get_startup()
+
+    def step(name, fn):
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            startup["steps"][name] = f"{type(e).__name__}: {e}"
+            return None
+        startup["steps"][name] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    # CLAHE はスレッドごとに持つため (get_clahe)、ここでは生成せず cv2 の読み込みだけ済ませる
+    step("cv2", lambda: (cv2.createCLAHE, load_card_templates(), get_reference_features()))
+    step("vision", lambda: vision.ImageAnnotatorClient)
+    step("gspread", lambda: gspread.authorize)
+    creds = step("credentials", lambda: get_credentials()[0])
+    if creds:
+        step("vision_client", lambda: get_vision_client(creds))
+        step("outbox_flusher", lambda: start_outbox_flusher(creds))
+        step("sheet_index", lambda: refresh_sheet_index(creds))
+    startup["ready"] = time.time()
+    startup["done"].set()
+    logger.info(json.dumps({"event": "startup_ready", **startup_status()}, ensure_ascii=False))
+
+@st.cache_resource
+def start_prewarm():
+    """prewarm をバックグラウンドスレッドでプロセスごとに1回だけ実行する (画面の表示は待たない)"""
+    thread = threading.Thread(target=prewarm, name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+def start_background_services():
+    """
+    事前準備のスレッドを起動する (プロセスごとに1回)。
+    serve.py がプロセスの起動時に呼ぶため、画面が一度も開かれていなくても準備が進む (/healthz・/warmup・/metrics は health_routes)。
+    """
+    start_prewarm()
+
+# カードのレイアウト定義 (card_templates/*.json)。セル座標は 1000x360 補正画像上の (ymin, xmin, ymax, xmax)
+CARD_TEMPLATE_DIR = os.environ.get("CARD_TEMPLATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "card_templates"))
+# レイアウト判定に使う縮小画像の倍率 (1000x360 → 250x90)
+TEMPLATE_FINGERPRINT_SCALE = 4
+# 縦罫線ありとみなす、周囲との明るさの差 (縮小グレースケール画像の輝度)
+TEMPLATE_LINE_CONTRAST = 20
+# 行帯の高さのうち、この割合以上の行で暗ければ罫線ありとみなす
+TEMPLATE_LINE_COVERAGE = 0.8
+
+def row_bands(crop_definitions):
+    """セル定義の縦範囲を重なり・隣接ごとにまとめた [(ymin, ymax), ...] を返す"""
+    bands = []
+    for ymin, _, ymax, _ in sorted(crop_definitions.values()):
+        if bands and ymin <= bands[-1][1]:
+            bands[-1][1] = max(bands[-1][1], ymax)
+        else:
+            bands.append([ymin, ymax])
+    return [tuple(b) for b in bands]
+
+def ruling_points(cells, width, height, step=8):
+    """外枠・行帯の上下・セル間の縦線の上に step 画素おきに取った点 (カード座標, Nx1x2) を返す"""
+    segments = [((0, 0), (width - 1, 0)), ((0, height - 1), (width - 1, height - 1)),
+                ((0, 0), (0, height - 1)), ((width - 1, 0), (width - 1, height - 1))]
+    for ymin, ymax in row_bands(cells):
+        segments += [((0, ymin), (width - 1, ymin)), ((0, ymax), (width - 1, ymax))]
+    segments += [((xmin, ymin), (xmin, ymax)) for ymin, xmin, ymax, _ in cells.values() if xmin > 0]
+    points = [np.linspace(p, q, max(int(max(abs(q[0] - p[0]), abs(q[1] - p[1])) / step), 2))
+              for p, q in dict.fromkeys(segments)]
+    return np.concatenate(points).astype(np.float32).reshape(-1, 1, 2)
+
+def compile_card_template(spec):
+    """
+    テンプレートJSONを検証し、切り出し用のスライス・補正用の行帯・判定用の縦罫線位置を前計算する。
+    """
+    target_w, target_h = spec.get("size", CARD_SIZE)
+    if (target_w, target_h) != CARD_SIZE:
+        raise ValueError(f"テンプレート {spec['name']}: サイズ {target_w}x{target_h} には未対応です")
+    cells = {}
+    for name, rect in spec["cells"].items():
+        ymin, xmin, ymax, xmax = rect
+        if not (0 <= ymin < ymax <= target_h and 0 <= xmin < xmax <= target_w):
+            raise ValueError(f"テンプレート {spec['name']}: セル '{name}' の座標 {rect} がカード外です")
+        cells[name] = (ymin, xmin, ymax, xmax)
+    return {
+        "name": spec["name"],
+        "version": spec.get("version", 0),
+        "description": spec.get("description", ""),
+        "cells": cells,
+        "slices": [(name, slice(ymin, ymax), slice(xmin, xmax)) for name, (ymin, xmin, ymax, xmax) in cells.items()],
+        "bands": row_bands(cells),
+        # セル左端の縦罫線 (行帯の上端, 下端, x)。カード左端 (x=0) は全レイアウト共通なので除く
+        "separators": frozenset((ymin, ymax, xmin) for ymin, xmin, ymax, _ in cells.values() if xmin > 0),
+        # 特徴点照合用の無記入カード画像 (任意、テンプレートJSONからの相対パス)
+        "reference": spec.get("reference"),
+        "rulings": ruling_points(cells, target_w, target_h),
+    }
+
+@st.cache_resource
+def load_card_templates(template_dir=None):
+    """テンプレートを読み込んで前計算し、バージョンの新しい順の {名前: テンプレート} を返す (省略時は CARD_TEMPLATE_DIR)"""
+    template_dir = template_dir or CARD_TEMPLATE_DIR
+    templates = []
+    for filename in sorted(os.listdir(template_dir)):
+        if filename.endswith(".json"):
+            with open(os.path.join(template_dir, filename), encoding="utf-8") as f:
+                template = compile_card_template(json.load(f))
+            if template["reference"]:
+                template["reference"] = os.path.join(template_dir, template["reference"])
+            templates.append(template)
+    if not templates:
+        raise FileNotFoundError(f"カードテンプレートがありません: {template_dir}")
+    templates.sort(key=lambda t: t["version"], reverse=True)
+    return {t["name"]: t for t in templates}
+
+def get_card_template(name=None):
+    """名前でテンプレートを返す (省略時は最新バージョン)"""
+    templates = load_card_templates()
+    return templates[name] if name else next(iter(templates.values()))
+
+def detect_card_template(aligned):
+    """
+    補正済みカード画像を 1/4 に縮小し、各テンプレートの縦罫線の位置で罫線の有無を調べてテンプレートを判定する。
+    全レイアウト共通の罫線は差が出ないため、実質的に差のある罫線だけで比較される。同点なら新しいバージョン。
+    """
+    templates = load_card_templates()
+    if len(templates) == 1:
+        return next(iter(templates.values()))
+
+    k = TEMPLATE_FINGERPRINT_SCALE
+    gray = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (gray.shape[1] // k, gray.shape[0] // k), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    present = {}
+    for sep in frozenset().union(*(t["separators"] for t in templates.values())):
+        ymin, ymax, x = sep
+        rows = slice(ymin // k + 1, max(ymin // k + 2, ymax // k - 1))  # 行帯の上下の横罫線を避ける
+        xs = x // k
+        line = small[rows, max(0, xs - 1):xs + 2].min(axis=1)
+        around = np.concatenate([small[rows, max(0, xs - 5):max(0, xs - 2)], small[rows, xs + 3:xs + 6]], axis=1)
+        if not around.size:
+            present[sep] = False
+            continue
+        # 罫線は行帯の上から下まで周囲より暗い (手書き文字が横切っただけなら一部の行しか暗くならない)
+        dark_rows = (np.median(around, axis=1) - line) > TEMPLATE_LINE_CONTRAST
+        present[sep] = float(dark_rows.mean()) >= TEMPLATE_LINE_COVERAGE
+
+    # 罫線の有無がテンプレートの定義と一致した数が最も多いものを選ぶ
+    def score(t):
+        return sum(present[sep] == (sep in t["separators"]) for sep in present)
+    return max(templates.values(), key=score)
+
+# 手書き文字補正の段階
+#   off:      グレースケールのみ
+#   fast:     軽量な平滑化 (GaussianBlur) + コントラスト強調(CLAHE)
+#   accurate: 高精度ノイズ除去(fastNlMeansDenoising) + コントラスト強調(CLAHE)
+ENHANCE_TIERS = {"off": "補正なし", "fast": "高速補正", "accurate": "高精度補正 (推奨)"}
+
+_enhance_local = threading.local()
+
+def get_clahe():
+    """
+    CLAHE オブジェクトをスレッドごとに1回だけ生成して使い回す。
+    セル行 (幅1000px) 単位で適用するため、タイルはセル単位時代 (幅220px / 8分割) と同程度の大きさにする。
+    """
+    if not hasattr(_enhance_local, "clahe"):
+        _enhance_local.clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(36, 8))
+    return _enhance_local.clahe
+
+def enhance_card(aligned, tier="accurate", template=None, bands=None):
+    """
+    補正済みカード画像をグレースケール化し、テンプレートのセルがある行帯だけを指定段階で一括補正して返す。
+    (セルごとに補正するより呼び出し回数が少なく、セル境界での処理ムラも出ない)
+    bands を指定するとその行帯だけを補正する (1セルの再読み取り用)。
+    """
+    gray = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
+    if tier in (True, False):
+        tier = "accurate" if tier else "off"  # 旧 use_enhance 引数との互換
+    if tier == "off":
+        return gray
+
+    clahe = get_clahe()
+    for ymin, ymax in bands or (template or get_card_template())["bands"]:
+        band = gray[ymin:ymax]
+        if tier == "accurate":
+            band = cv2.fastNlMeansDenoising(band, h=10)
+        else:
+            band = cv2.GaussianBlur(band, (3, 3), 0)
+        gray[ymin:ymax] = clahe.apply(band)
+    return gray
+
+CARD_SIZE = (1000, 360)  # 補正後のカード画像 (幅, 高さ)
+# 輪郭検出用の縮小デコードで確保する長辺の最小画素数 (これを下回らない範囲で 1/2, 1/4, 1/8 に縮小)
+DETECT_MIN_SIDE = 800
+REDUCED_GRAYSCALE_FLAGS = {8: "IMREAD_REDUCED_GRAYSCALE_8", 4: "IMREAD_REDUCED_GRAYSCALE_4", 2: "IMREAD_REDUCED_GRAYSCALE_2"}
+
+def decode_card_image(image_bytes):
+    """
+    アップロードされた画像バイト列をそのままデコードする。
+    射影変換用のフル解像度カラー画像と、輪郭検出用の縮小グレースケール画像 (JPEGはDCT段階で縮小) を返す。
+    (img, small_gray, (x方向倍率, y方向倍率)) ※倍率は 縮小座標 → フル解像度座標
     """
     nparr = np.frombuffer(image_bytes, np.uint8)
     img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("画像を読み込めませんでした")
     h_orig, w_orig = img.shape[:2]
 
-    # 1. 輪郭検出
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    factor = next((f for f in REDUCED_GRAYSCALE_FLAGS if max(w_orig, h_orig) / f >= DETECT_MIN_SIDE), 1)
+    if factor > 1:
+        small = cv2.imdecode(nparr, getattr(cv2, REDUCED_GRAYSCALE_FLAGS[factor]))
+    else:
+        small = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h_small, w_small = small.shape[:2]
+    return img, small, (w_orig / w_small, h_orig / h_small)
+
+def find_card_quad(gray):
+    """
+    グレースケール画像から面積最大の4点輪郭 (カード外郭) を探し、4x2 の座標配列を返す。見つからなければ None。
+    """
+    h_orig, w_orig = gray.shape[:2]
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     edged = cv2.Canny(blurred, 50, 150)
     
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
     dilated = cv2.dilate(edged, kernel, iterations=2)
-    contours, _ = cv2.findContours(dilated.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
     card_contour = None
     max_area = 0
@@ -103,68 +572,441 @@ def get_aligned_card_and_crops(image_bytes, use_enhance=True):
                 card_contour = approx
                 max_area = area
 
-    target_w, target_h = 1000, 360
-    aligned = None
+    return None if card_contour is None else card_contour.reshape(4, 2).astype("float32")
 
-    # 2. 射影変換
-    if card_contour is not None:
-        pts = card_contour.reshape(4, 2)
-        rect = np.zeros((4, 2), dtype="float32")
-        
-        s = pts.sum(axis=1)
-        rect[0] = pts[np.argmin(s)]  # 左上
-        rect[2] = pts[np.argmax(s)]  # 右下
-        
-        diff = np.diff(pts, axis=1)
-        rect[1] = pts[np.argmin(diff)] # 右上
-        rect[3] = pts[np.argmax(diff)] # 左下
-        
-        dst = np.array([
-            [0, 0],
-            [target_w - 1, 0],
-            [target_w - 1, target_h - 1],
-            [0, target_h - 1]
-        ], dtype="float32")
-        
-        M = cv2.getPerspectiveTransform(rect, dst)
-        aligned = cv2.warpPerspective(img, M, (target_w, target_h))
-    else:
-        aligned = cv2.resize(img, (target_w, target_h))
-
-    # 3. 10個の手書きセル枠の切り出し座標 (ymin, xmin, ymax, xmax)
-    # ※最新の生年月日(年齢から変更)およびメール配信付きレイアウトに最適化
-    crop_definitions = {
-        "氏名": (47, 0, 94, 220),
-        "フリガナ": (47, 220, 94, 440),        # 22%幅
-        "生年月日": (47, 440, 94, 770),        # 年齢から生年月日に変更 (33%幅)
-        "職業": (47, 770, 94, 1000),          # 23%幅
-        "住所": (126, 0, 173, 1000),
-        "電話番号": (205, 0, 252, 330),
-        "メールアドレス": (205, 330, 252, 1000),
-        "チェックイン日": (288, 0, 335, 330),
-        "チェックアウト日": (288, 330, 335, 765), # 右端を765に変更
-        "メール配信": (288, 765, 335, 1000)       # 新規追加 (可/不可の◯判定用)
-    }
+# 段階的なカード検出: 輪郭 → 直線 (Hough) → 特徴点照合 (ORB)。どれも失敗したら全体を縮小するだけ
+LOCATE_TIERS = ("contour", "lines", "features")
+LOCATE_TIER_LABELS = {"contour": "輪郭", "lines": "直線の組み合わせ", "features": "参照カードとの特徴点照合"}
+CARD_MIN_AREA_RATIO = 0.15          # 写真に占めるカード面積の下限
+CARD_ASPECT_RANGE = (2.0, 3.6)      # 検出した四角形の長辺/短辺の許容範囲 (カードは 1000/360 ≒ 2.8)
+LINE_ANGLE_TOLERANCE = 15.0         # カードの向きと平行/垂直とみなす角度差 (度)
+LINE_MERGE_DISTANCE = 0.006         # 同一直線とみなす距離 (画像の長辺に対する割合)。罫線と外枠を混同しない程度に小さく
+LINE_CANDIDATES = 12                # 向きごとに残す直線の数 (総延長の長い順)
+LINE_MIN_SUPPORT = 0.5              # 写したテンプレートの罫線のうちエッジと重なる割合の下限 (指などで隠れてよいのは残り)
+ORB_FEATURES = 3000
+ORB_MIN_INLIERS = 25
+ORB_RATIO = 0.75                    # Lowe の比率テスト
+LINE_MIN_ALIGNED_SUPPORT = 0.65     # 直線・特徴点の段階で、補正後のカード画像のテンプレートの罫線がエッジと重なる割合の下限
 
-    crops = {}
-    for name, (ymin, xmin, ymax, xmax) in crop_definitions.items():
-        crop_img = aligned[ymin:ymax, xmin:xmax]
-        
-        # 切り出したセルごとにグレースケール化
-        gray_crop = cv2.cvtColor(crop_img, cv2.COLOR_BGR2GRAY)
-        
-        if use_enhance:
-            # 以前の preprocess_image と同等の高精度ノイズ除去(Denoise) ＋ コントラスト強調(CLAHE)
-            denoised = cv2.fastNlMeansDenoising(gray_crop, h=10)
-            clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-            processed = clahe.apply(denoised)
+def is_plausible_card_quad(quad, image_shape, min_area_ratio=CARD_MIN_AREA_RATIO):
+    """四角形が凸で、写真に対して十分な面積 (min_area_ratio 以上) があり、カードらしい縦横比かどうか"""
+    if quad is None or not np.all(np.isfinite(quad)):
+        return False
+    h, w = image_shape[:2]
+    pts = order_quad(quad)
+    if not cv2.isContourConvex(pts.reshape(-1, 1, 2)):
+        return False
+    if cv2.contourArea(pts) < w * h * min_area_ratio:
+        return False
+    long_side = (np.linalg.norm(pts[1] - pts[0]) + np.linalg.norm(pts[2] - pts[3])) / 2
+    short_side = (np.linalg.norm(pts[3] - pts[0]) + np.linalg.norm(pts[2] - pts[1])) / 2
+    return short_side > 0 and CARD_ASPECT_RANGE[0] <= long_side / short_side <= CARD_ASPECT_RANGE[1]
+
+def _merge_collinear_segments(segments, merge_distance):
+    """
+    同一直線上の線分をまとめ、総延長の長い順に [(総延長, 直線 (a, b, c): ax + by = c), ...] を返す。
+    遠近で辺どうしは平行にならないため、長い線分から順に「両端がその直線の近くにあるか」で判定する。
+    """
+    lengths = np.linalg.norm(segments[:, 2:] - segments[:, :2], axis=1)
+    clusters = []
+    for i in np.argsort(-lengths):
+        p1, p2 = segments[i, :2], segments[i, 2:]
+        for cluster in clusters:
+            a, b, c = cluster["line"]
+            if abs(a * p1[0] + b * p1[1] - c) <= merge_distance and abs(a * p2[0] + b * p2[1] - c) <= merge_distance:
+                cluster["segments"].append(segments[i])
+                cluster["length"] += lengths[i]
+                break
         else:
-            processed = gray_crop
-        
-        _, encoded = cv2.imencode('.jpg', processed)
+            direction = (p2 - p1) / lengths[i]
+            normal = np.array([-direction[1], direction[0]])
+            clusters.append({"line": (normal[0], normal[1], normal @ p1), "segments": [segments[i]], "length": lengths[i]})
+
+    fitted = []
+    for cluster in clusters:
+        points = np.array(cluster["segments"]).reshape(-1, 2).astype(np.float32)
+        vx, vy, x0, y0 = cv2.fitLine(points, cv2.DIST_L2, 0, 0.01, 0.01).flatten()
+        fitted.append((cluster["length"], (-vy, vx, -vy * x0 + vx * y0)))
+    fitted.sort(key=lambda item: -item[0])
+    return fitted[:LINE_CANDIDATES]
+
+def _intersect(l1, l2):
+    a = np.array([[l1[0], l1[1]], [l2[0], l2[1]]], dtype=np.float64)
+    if abs(np.linalg.det(a)) < 1e-9:
+        return None
+    return np.linalg.solve(a, np.array([l1[2], l2[2]], dtype=np.float64))
+
+def find_card_quad_lines(gray):
+    """
+    輪郭が途切れている (指で端が隠れている・背景がごちゃついている) 場合の検出。
+    HoughLinesP の線分をカードの向きと平行・垂直な2群に分けて直線にまとめ、
+    2本ずつの組み合わせのうちカードらしく、テンプレートの罫線が最もよく重なる四角形を返す。見つからなければ None。
+    """
+    h, w = gray.shape[:2]
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    segments = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=80,
+                               minLineLength=int(min(w, h) * 0.15), maxLineGap=int(max(w, h) * 0.02))
+    if segments is None:
+        return None
+    segments = segments.reshape(-1, 4).astype(np.float64)
+    vectors = segments[:, 2:] - segments[:, :2]
+    angles = np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0])) % 180
+    # カードの向き = 最も長い線分の向き
+    dominant = angles[np.argmax(np.linalg.norm(vectors, axis=1))]
+
+    groups = []
+    for base in (dominant, dominant + 90):
+        diff = np.abs((angles - base + 90) % 180 - 90)
+        groups.append(_merge_collinear_segments(segments[diff <= LINE_ANGLE_TOLERANCE], max(w, h) * LINE_MERGE_DISTANCE))
+    if len(groups[0]) < 2 or len(groups[1]) < 2:
+        return None
+
+    # 候補の四角形でテンプレートの罫線 (外枠・行帯・縦線) を写真上へ写し、エッジと重なる割合が最大のものを選ぶ。
+    # 行帯の罫線で作った内側の四角形や背景の直線まで延びた四角形では、写した罫線が実際の罫線からずれる
+    edge_mask = cv2.dilate(edges, np.ones((5, 5), np.uint8)) > 0
+    best, best_score = None, LINE_MIN_SUPPORT
+    for i, (_, a1) in enumerate(groups[0]):
+        for _, a2 in groups[0][i + 1:]:
+            for j, (_, b1) in enumerate(groups[1]):
+                for _, b2 in groups[1][j + 1:]:
+                    corners = [_intersect(a1, b1), _intersect(a1, b2), _intersect(a2, b2), _intersect(a2, b1)]
+                    if any(c is None for c in corners):
+                        continue
+                    quad = np.array(corners, dtype="float32")
+                    if not is_plausible_card_quad(quad, gray.shape):
+                        continue
+                    score = _ruling_score(quad, edge_mask)
+                    if score > best_score:
+                        best, best_score = quad, score
+    return best
+
+def _ruling_score(quad, edge_mask):
+    """四角形をカードとみなしたとき、テンプレートの罫線がエッジと重なる割合 (全テンプレートの最大値)"""
+    h, w = edge_mask.shape
+    target_w, target_h = CARD_SIZE
+    card_corners = np.float32([[0, 0], [target_w - 1, 0], [target_w - 1, target_h - 1], [0, target_h - 1]])
+    M = cv2.getPerspectiveTransform(card_corners, order_quad(quad))
+    best = 0.0
+    for template in load_card_templates().values():
+        projected = cv2.perspectiveTransform(template["rulings"], M).reshape(-1, 2).round().astype(int)
+        inside = (projected[:, 0] >= 0) & (projected[:, 0] < w) & (projected[:, 1] >= 0) & (projected[:, 1] < h)
+        best = max(best, edge_mask[projected[inside, 1], projected[inside, 0]].sum() / len(projected))
+    return best
+
+@st.cache_resource
+def get_reference_features():
+    """
+    テンプレートごとの参照カードの ORB 特徴点 {名前: (座標 Nx2, 記述子)} を起動時に一度だけ計算する。
+    参照画像はテンプレートの "reference" (無記入カードを正面から撮った画像)。罫線だけの画像では
+    特徴点が少なく位置合わせできないため、reference のないテンプレートは対象外。
+    """
+    orb = cv2.ORB_create(nfeatures=ORB_FEATURES)
+    features = {}
+    for name, template in load_card_templates().items():
+        reference = cv2.imread(template["reference"], cv2.IMREAD_GRAYSCALE) if template["reference"] else None
+        if reference is None:
+            continue
+        reference = cv2.resize(reference, CARD_SIZE, interpolation=cv2.INTER_AREA)
+        keypoints, descriptors = orb.detectAndCompute(reference, None)
+        if descriptors is not None:
+            features[name] = (np.float32([kp.pt for kp in keypoints]), descriptors)
+    return features
+
+def find_card_quad_features(gray):
+    """
+    参照カードとの ORB 特徴点照合 (比率テスト + RANSAC によるホモグラフィ推定) でカード外郭を求める。
+    インライアが最も多いテンプレートの結果を返し、見つからなければ (参照画像がなければ常に) None。
+    """
+    references = get_reference_features()
+    if not references:
+        return None
+    orb = cv2.ORB_create(nfeatures=ORB_FEATURES)
+    keypoints, descriptors = orb.detectAndCompute(gray, None)
+    if descriptors is None or len(keypoints) < ORB_MIN_INLIERS:
+        return None
+    points = np.float32([kp.pt for kp in keypoints])
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    target_w, target_h = CARD_SIZE
+    corners = np.float32([[0, 0], [target_w - 1, 0], [target_w - 1, target_h - 1], [0, target_h - 1]]).reshape(-1, 1, 2)
+
+    best, best_inliers = None, ORB_MIN_INLIERS - 1
+    for ref_points, ref_descriptors in references.values():
+        pairs = matcher.knnMatch(ref_descriptors, descriptors, k=2)
+        good = [p[0] for p in pairs if len(p) == 2 and p[0].distance < ORB_RATIO * p[1].distance]
+        if len(good) < ORB_MIN_INLIERS:
+            continue
+        src = ref_points[[m.queryIdx for m in good]]
+        dst = points[[m.trainIdx for m in good]]
+        H, mask = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+        if H is None or int(mask.sum()) <= best_inliers:
+            continue
+        quad = cv2.perspectiveTransform(corners, H).reshape(4, 2)
+        if is_plausible_card_quad(quad, gray.shape):
+            best, best_inliers = quad, int(mask.sum())
+    return best
+
+def ruling_alignment(aligned):
+    """
+    補正後のカード画像 (1000x360) でテンプレートの罫線がエッジと重なる割合 (全テンプレートの最大値)。
+    縮小画像での _ruling_score より許容幅が狭く、行帯1つ分などのずれた四角形を見分けられる。
+    """
+    gray = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
+    edge_mask = cv2.dilate(cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150), np.ones((5, 5), np.uint8)) > 0
+    best = 0.0
+    for template in load_card_templates().values():
+        points = template["rulings"].reshape(-1, 2).round().astype(int)
+        best = max(best, float(edge_mask[points[:, 1], points[:, 0]].mean()))
+    return best
+
+def locate_card(gray):
+    """
+    段階的にカード外郭を探す (簡単な写真は最初の輪郭検出だけで済む)。
+    (4x2 の座標配列 or None, 成功した段階名 or "resize") を返し、各段階の所要時間を記録する。
+    """
+    for tier, finder in zip(LOCATE_TIERS, (find_card_quad, find_card_quad_lines, find_card_quad_features)):
+        with stage_span(f"locate_{tier}"):
+            quad = finder(gray)
+        if quad is not None:
+            return quad, tier
+    return None, "resize"
+
+# 1枚の写真に複数枚のカードを並べて撮る場合
+MULTI_CARD_MIN_AREA_RATIO = 0.03      # 1枚あたりの写真に占める面積の下限
+MULTI_CARD_MIN_RELATIVE_AREA = 0.5    # 最大のカードに対する面積比の下限 (同じ大きさのカードだけを拾う)
+
+def find_card_quads(gray):
+    """
+    写真に並べた複数枚のカードの外郭を探し、読み取り順 (上の行から、行内は左から) のリストで返す。
+    カードらしい4点輪郭のうち、テンプレートの罫線がエッジと重なるもの (机の上の別の紙などを除く) を
+    互いに重ならないように選ぶ。
+    """
+    edged = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    dilated = cv2.dilate(edged, cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3)), iterations=2)
+    contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    edge_mask = cv2.dilate(edged, np.ones((5, 5), np.uint8)) > 0
+
+    candidates = []
+    for c in contours:
+        approx = cv2.approxPolyDP(c, 0.02 * cv2.arcLength(c, True), True)
+        if len(approx) != 4:
+            continue
+        quad = order_quad(approx.reshape(4, 2).astype("float32"))
+        if is_plausible_card_quad(quad, gray.shape, MULTI_CARD_MIN_AREA_RATIO) and _ruling_score(quad, edge_mask) >= LINE_MIN_SUPPORT:
+            candidates.append(quad)
+    if not candidates:
+        return []
+
+    candidates.sort(key=cv2.contourArea, reverse=True)
+    min_area = cv2.contourArea(candidates[0]) * MULTI_CARD_MIN_RELATIVE_AREA
+    quads = []
+    for quad in candidates:
+        if cv2.contourArea(quad) < min_area:
+            break
+        center = tuple(float(v) for v in quad.mean(axis=0))
+        if any(cv2.pointPolygonTest(q.reshape(-1, 1, 2), center, False) >= 0 or
+               cv2.pointPolygonTest(quad.reshape(-1, 1, 2), tuple(float(v) for v in q.mean(axis=0)), False) >= 0
+               for q in quads):
+            continue
+        quads.append(quad)
+
+    # 中心の高さの差がカードの短辺の半分未満なら同じ行とみなす
+    row_height = np.median([np.linalg.norm(q[3] - q[0]) for q in quads]) / 2
+    quads.sort(key=lambda q: q.mean(axis=0)[1])
+    rows = []
+    for quad in quads:
+        if rows and quad.mean(axis=0)[1] - rows[-1][0].mean(axis=0)[1] < row_height:
+            rows[-1].append(quad)
+        else:
+            rows.append([quad])
+    return [quad for row in rows for quad in sorted(row, key=lambda q: q.mean(axis=0)[0])]
+
+def order_quad(pts):
+    """4点を 左上, 右上, 右下, 左下 の順に並べる"""
+    rect = np.zeros((4, 2), dtype="float32")
+    
+    s = pts.sum(axis=1)
+    rect[0] = pts[np.argmin(s)]  # 左上
+    rect[2] = pts[np.argmax(s)]  # 右下
+    
+    diff = np.diff(pts, axis=1)
+    rect[1] = pts[np.argmin(diff)] # 右上
+    rect[3] = pts[np.argmax(diff)] # 左下
+    return rect
+
+def warp_card(img, quad):
+    """
+    カード外郭の4点でフル解像度画像を射影変換し 1000x360 に正規化する。quad が None なら全体を縮小するだけ。
+    """
+    target_w, target_h = CARD_SIZE
+    if quad is None:
+        return cv2.resize(img, (target_w, target_h), interpolation=cv2.INTER_AREA)
+
+    dst = np.array([
+        [0, 0],
+        [target_w - 1, 0],
+        [target_w - 1, target_h - 1],
+        [0, target_h - 1]
+    ], dtype="float32")
+    
+    M = cv2.getPerspectiveTransform(order_quad(quad), dst)
+    return cv2.warpPerspective(img, M, (target_w, target_h))
+
+def encode_crops(processed, template=None):
+    """補正済みグレースケール画像からテンプレートの各セルを切り出し、JPEGバイト列の dict で返す"""
+    crops = {}
+    for name, rows, cols in (template or get_card_template())["slices"]:
+        _, encoded = cv2.imencode('.jpg', processed[rows, cols])
         crops[name] = encoded.tobytes()
+    return crops
+
+def align_card(image_bytes, template=None, info=None):
+    """
+    画像を読み込み、カードの輪郭を検出して正面の 1000x360 画像に補正し、レイアウト (テンプレート) を判定する。
+    (補正済み画像, テンプレート) を返す。template を指定すると判定を省略する。
+    info に dict を渡すと判定したテンプレート名・カード外郭の検出可否・検出できた段階・外郭の4点 (フル解像度)・写真に占めるカードの面積比を書き込む。
+    """
+    with stage_span("decode"):
+        img, small, (sx, sy) = decode_card_image(image_bytes)
+
+    # 1. 外郭検出 (縮小画像で輪郭 → 直線 → 特徴点の順に試し、座標をフル解像度へ戻す)
+    with stage_span("locate"):
+        quad, tier = locate_card(small)
+        if quad is not None:
+            quad = quad * np.array([sx, sy], dtype="float32")
+    return _warp_and_detect(img, quad, tier, template, info)
+
+def align_cards(image_bytes, template=None):
+    """
+    1枚の写真に並べた複数枚のカードをそれぞれ補正し、[(補正済み画像, テンプレート, info), ...] を読み取り順で返す。
+    カードが2枚以上見つからなければ align_card と同じ段階的な検出で1枚として扱う (常に1件以上返す)。
+    """
+    with stage_span("decode"):
+        img, small, scale = decode_card_image(image_bytes)
+
+    with stage_span("locate"):
+        quads = find_card_quads(small)
+        tier = LOCATE_TIERS[0]
+        if len(quads) < 2:
+            quad, tier = locate_card(small)
+            quads = [quad]
+    cards = []
+    for quad in quads:
+        info = {}
+        if quad is not None:
+            quad = quad * np.array(scale, dtype="float32")
+        aligned, card_template = _warp_and_detect(img, quad, tier, template, info)
+        cards.append((aligned, card_template, info))
+    return cards
+
+def _warp_and_detect(img, quad, tier, template=None, info=None):
+    # 2. 射影変換 (フル解像度画像からサンプリングするため切り出し画質は変わらない)
+    with stage_span("warp"):
+        aligned = warp_card(img, quad)
+    if tier in ("lines", "features"):
+        # 直線の組み合わせや特徴点の対応は行帯の罫線・背景にずれて合うことがあるため、補正後の画像で罫線が重なるか確かめる。
+        # ずれていれば切り出し位置が当てにならないので、カードを検出できなかった場合と同じく全体を縮小して使う
+        with stage_span("verify_lines"):
+            verified = ruling_alignment(aligned) >= LINE_MIN_ALIGNED_SUPPORT
+        if not verified:
+            quad, tier = None, "resize"
+            with stage_span("warp"):
+                aligned = warp_card(img, None)
+
+    # 3. レイアウト判定
+    if template is None:
+        with stage_span("detect_template"):
+            template = detect_card_template(aligned)
+    if info is not None:
+        info["template"] = template["name"]
+        info["card_found"] = quad is not None
+        info["locate_tier"] = tier
+        info["quad"] = None if quad is None else order_quad(quad)
+        info["area_ratio"] = 0.0 if quad is None else cv2.contourArea(info["quad"]) / (img.shape[0] * img.shape[1])
+    return aligned, template
+
+def crop_card(aligned, enhance="accurate", template=None):
+    """セル行ごとにまとめて補正し、手書きセル枠をJPEGで切り出して {項目名: バイト列} を返す"""
+    with stage_span("enhance", tier=str(enhance)):
+        processed = enhance_card(aligned, enhance, template)
+    with stage_span("encode"):
+        return encode_crops(processed, template)
+
+def crop_cell(aligned, key, enhance="accurate", template=None):
+    """1セルだけを指定段階で切り出し直す (そのセルを含む行帯だけを補正する)"""
+    template = template or get_card_template()
+    ymin, xmin, ymax, xmax = template["cells"][key]
+    bands = [(b0, b1) for b0, b1 in template["bands"] if b0 <= ymin and ymax <= b1]
+    with stage_span("enhance", tier=str(enhance), cells=1):
+        processed = enhance_card(aligned, enhance, template, bands=bands)
+    _, encoded = cv2.imencode('.jpg', processed[ymin:ymax, xmin:xmax])
+    return encoded.tobytes()
+
+def get_aligned_card_and_crops(image_bytes, enhance="accurate", template=None, info=None):
+    """
+    画像を読み込み、カードの輪郭を検出して正面の 1000x360 画像に補正。
+    その後、レイアウト (テンプレート) を判定して入力セルエリアを切り出して返却する。
+    enhance は手書き文字補正の段階 (ENHANCE_TIERS のキー、True/False も可)。
+    template を指定すると判定を省略する。info に dict を渡すと判定したテンプレート名などを書き込む。
+    """
+    aligned, template = align_card(image_bytes, template, info)
+    return aligned, crop_card(aligned, enhance, template)
+
+def get_aligned_cards_and_crops(image_bytes, enhance="accurate", template=None):
+    """
+    get_aligned_card_and_crops の複数枚版。写真に並べたカードごとに
+    [(補正済み画像, {項目名: バイト列}, info), ...] を読み取り順で返す。
+    """
+    return [(aligned, crop_card(aligned, enhance, card_template), info)
+            for aligned, card_template, info in align_cards(image_bytes, template)]
 
-    return aligned, crops
+# 撮影フレームの品質判定 (OCRに送る前にローカルで採点し、読めない写真で Vision API を呼ばない)
+FRAME_MIN_SHARPNESS = 60.0      # 補正後カードのラプラシアン分散の下限 (ぼけると数十以下になる)
+FRAME_GLARE_LEVEL = 250         # これ以上の明るさを白飛びとみなす
+FRAME_MAX_GLARE = 0.05          # 補正後カードに占める白飛び画素の割合の上限
+# 写真上でのセルの高さの下限 (px)。手書き文字はセルの半分ほどの高さなので、これを下回ると文字が 12px を切ってつぶれる。
+# 面積比ではなく画素数で判定する (カメラ入力の 640x480 ならカードが写真の 3 割ほど、1200万画素の写真なら 1% ほどに相当)
+FRAME_MIN_CELL_HEIGHT = 24
+
+def card_cell_height(quad, template):
+    """写真上でのセルの高さ (px)。quad は order_quad 済みの四隅、テンプレートで最も低いセルで測る"""
+    tl, tr, br, bl = quad
+    card_height = (np.linalg.norm(bl - tl) + np.linalg.norm(br - tr)) / 2
+    return float(card_height * min(ymax - ymin for ymin, _, ymax, _ in template["cells"].values()) / CARD_SIZE[1])
+
+def score_frame(image_bytes):
+    """
+    撮影フレームをローカルで採点する (デコード〜外郭検出〜射影変換のみで、補正・切り出し・OCRはしない)。
+    {"sharpness", "glare", "card_found", "area_ratio", "cell_height", "ok", "reasons"} を返す。
+    sharpness は補正後カードのラプラシアン分散 (大きいほど鮮明)、glare は白飛び画素の割合、
+    cell_height は写真上でのセルの高さ (px、カード未検出なら 0)、reasons は基準を満たさない理由のリスト (ok なら空)。
+    """
+    info = {}
+    with stage_span("frame_score"):
+        try:
+            aligned, template = align_card(image_bytes, info=info)
+        except ValueError:
+            return {"sharpness": 0.0, "glare": 0.0, "card_found": False, "area_ratio": 0.0, "cell_height": 0.0,
+                    "ok": False, "reasons": ["読み込めない画像"]}
+        gray = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
+        sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+        glare = float(np.count_nonzero(gray >= FRAME_GLARE_LEVEL)) / gray.size
+    cell_height = card_cell_height(info["quad"], template) if info["card_found"] else 0.0
+
+    reasons = []
+    if not info["card_found"]:
+        reasons.append("カード未検出")
+    elif cell_height < FRAME_MIN_CELL_HEIGHT:
+        reasons.append("カードが小さい")
+    if sharpness < FRAME_MIN_SHARPNESS:
+        reasons.append("ピンぼけ")
+    if glare > FRAME_MAX_GLARE:
+        reasons.append("白飛び")
+    return {"sharpness": sharpness, "glare": glare, "card_found": info["card_found"], "area_ratio": info["area_ratio"],
+            "cell_height": cell_height, "ok": not reasons, "reasons": reasons}
+
+def best_frame(scores):
+    """{キー: score_frame の結果} から、基準を満たすうち最も鮮明なフレームのキーを返す (なければ基準未満で最も鮮明なもの)"""
+    return max(scores, key=lambda k: (scores[k]["ok"], scores[k]["sharpness"]), default=None)
 
 def clean_date_string(text):
     """
@@ -183,93 +1025,1037 @@ def clean_date_string(text):
     text = re.sub(r'[\s年月日の\.\-/]+', '/', text).strip('/')
     return text
 
-def perform_ocr_batch(crops_dict, credentials):
+def clean_field_text(key, text):
+    """
+    項目ごとのOCRテキスト整形 (日付系は YYYY/MM/DD 化、それ以外は先頭の記号除去)
+    """
+    if key in DATE_FIELDS:
+        return clean_date_string(text)
+    return re.sub(r'^[:：\s]+', '', text).strip()
+
+# 空欄判定: 罫線の残りを避けるため外周を除き、Otsu二値化した連結成分のうち小さなノイズを除いたインク面積で判定
+BLANK_MARGIN = 4              # 外周から除く画素数
+BLANK_MIN_CONTRAST = 40       # セル内の明暗差がこれ未満なら (二値化するまでもなく) 空欄
+BLANK_MIN_COMPONENT_AREA = 15 # これ未満の連結成分はノイズとして無視
+BLANK_MAX_INK_RATIO = 0.004   # 有効なインク面積の割合がこれ未満なら空欄
+
+def is_blank_cell(image_content):
+    """
+    セル画像に手書き文字が無さそうかを判定する。(空欄か, 有効インク面積の割合) を返す。
+    """
+    nparr = np.frombuffer(image_content, np.uint8)
+    crop_img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+    inner = crop_img[BLANK_MARGIN:-BLANK_MARGIN, BLANK_MARGIN:-BLANK_MARGIN]
+    if inner.size == 0:
+        return True, 0.0
+
+    lo, hi = np.percentile(inner, (1, 99))
+    if hi - lo < BLANK_MIN_CONTRAST:
+        return True, 0.0
+
+    # 二値化 (背景を黒(0)、手書き・文字を白(255)にする)
+    _, thresh = cv2.threshold(inner, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+    h, w = thresh.shape
+    ink = 0
+    for x, y, cw, ch, area in stats[1:]:
+        if area < BLANK_MIN_COMPONENT_AREA:
+            continue
+        if (cw >= w * 0.8 and ch <= 4) or (ch >= h * 0.8 and cw <= 4):
+            continue  # 切り出し位置のずれで入り込んだ罫線
+        ink += area
+    ratio = ink / float(h * w)
+    return ratio < BLANK_MAX_INK_RATIO, ratio
+
+def find_blank_cells(crops_dict):
+    """"メール配信" 以外のセルのうち空欄と判定したものの項目名リスト"""
+    with stage_span("blank_check"):
+        return [key for key, image_content in crops_dict.items()
+                if key != CONSENT_FIELD and is_blank_cell(image_content)[0]]
+
+def detect_mail_consent(image_content):
+    """
+    "メール配信" セル画像から手書き◯の位置を判定する (OpenCVの黒画素密度解析)。
+    (判定結果, 左画素数, 右画素数) を返す。
+    """
+    nparr = np.frombuffer(image_content, np.uint8)
+    crop_img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+
+    # 二値化 (背景を黒(0)、手書き・文字を白(255)にする)
+    _, thresh = cv2.threshold(crop_img, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    h, w = thresh.shape
+
+    # 左右に分割 (左: 可, 右: 不可)
+    left_half = thresh[:, :w//2]
+    right_half = thresh[:, w//2:]
+
+    left_pixels = np.sum(left_half == 255)
+    right_pixels = np.sum(right_half == 255)
+
+    # 印刷文字「可」(1文字)と「不可」(2文字)の基本画素数の差を補正して判定
+    # 手書きの◯がある側が劇的に画素数増となる
+    if left_pixels > right_pixels * 1.3 + 120:
+        consent = "可"
+    elif right_pixels > left_pixels * 1.1 + 120:
+        consent = "不可"
+    else:
+        consent = "未選択"
+    return consent, left_pixels, right_pixels
+
+def open_sqlite(path):
+    """スレッド間で共有する SQLite 接続 (WALモード・自動コミット) を開く"""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+@st.cache_resource
+def get_ocr_cache():
+    """
+    プロセス共通のOCR結果キャッシュ (SQLite) と ヒット/ミス カウンタを返す。
+    読み取り結果 (個人情報) を含むため、PERSONAL_DATA_RETENTION_SEC を過ぎたもの・OCR_CACHE_MAX_BYTES を超えた分は削除する。
+    """
+    conn = open_sqlite(OCR_CACHE_PATH)
+    conn.execute("""CREATE TABLE IF NOT EXISTS ocr_cache (
+        key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)")
+    cache = {"conn": conn, "lock": threading.Lock(), "hits": 0, "misses": 0}
+    with cache["lock"]:
+        _evict_ocr_cache(conn)
+    return cache
+
+def _evict_ocr_cache(conn):
+    """保存期間を過ぎたテキストを削除し、合計サイズが上限を超えていれば上限の9割まで最終利用が古い順に削除する"""
+    conn.execute("DELETE FROM ocr_cache WHERE last_used < ?", (time.time() - PERSONAL_DATA_RETENTION_SEC,))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+    if total > OCR_CACHE_MAX_BYTES:
+        excess = total - int(OCR_CACHE_MAX_BYTES * 0.9)
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM ocr_cache ORDER BY last_used"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM ocr_cache WHERE key = ?", victims)
+
+def ocr_cache_key(image_content):
+    """セル画像 + 機能種別 + 言語ヒントのハッシュ (設定が変われば別キーになる)"""
+    h = hashlib.sha256(image_content)
+    h.update(f"|{OCR_FEATURE}|{','.join(OCR_LANGUAGE_HINTS)}".encode())
+    return h.hexdigest()
+
+def ocr_cache_get(keys):
+    """キャッシュ済みのテキスト (保存期間内のもの) を {キー: テキスト} で返し、最終利用時刻を更新する"""
+    cache = get_ocr_cache()
+    found = {}
+    expired = time.time() - PERSONAL_DATA_RETENTION_SEC
+    with cache["lock"]:
+        for key in keys:
+            row = cache["conn"].execute("SELECT text FROM ocr_cache WHERE key = ? AND last_used >= ?", (key, expired)).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        if found:
+            now = time.time()
+            cache["conn"].executemany("UPDATE ocr_cache SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+        cache["hits"] += len(found)
+        cache["misses"] += len(keys) - len(found)
+    return found
+
+def ocr_cache_put(entries):
+    """{キー: テキスト} を保存し、保存期間を過ぎたもの・上限サイズを超えた分を削除する"""
+    if not entries:
+        return
+    cache = get_ocr_cache()
+    now = time.time()
+    with cache["lock"]:
+        conn = cache["conn"]
+        conn.executemany(
+            "INSERT OR REPLACE INTO ocr_cache (key, text, size, last_used) VALUES (?, ?, ?, ?)",
+            [(k, t, len(k) + len(t.encode()), now) for k, t in entries.items()]
+        )
+        _evict_ocr_cache(conn)
+
+def ocr_cache_stats():
+    cache = get_ocr_cache()
+    with cache["lock"]:
+        entries, size = cache["conn"].execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()
+    return {"hits": cache["hits"], "misses": cache["misses"], "entries": entries, "bytes": size}
+
+def _text_request(image_content):
+    return vision.AnnotateImageRequest(
+        image=vision.Image(content=image_content),
+        features=[vision.Feature(type_=vision.Feature.Type[OCR_FEATURE])],
+        image_context=vision.ImageContext(language_hints=OCR_LANGUAGE_HINTS)
+    )
+
+def _text_result(res):
+    """AnnotateImageResponse 1件を (テキスト, エラーメッセージ) にする"""
+    if res.error.message:
+        return "", res.error.message
+    return (res.text_annotations[0].description.strip() if res.text_annotations else ""), None
+
+def _lookup_cached_texts(images, use_cache):
+    """(キャッシュキー, 入力順の結果 (ミスは None), ミスした添字) を返す"""
+    keys = [ocr_cache_key(image_content) for image_content in images]
+    with stage_span("ocr_cache"):
+        cached = ocr_cache_get(keys) if use_cache else {}
+    results = [(cached[k], None) if k in cached else None for k in keys]
+    return keys, results, [i for i, r in enumerate(results) if r is None]
+
+def annotate_texts(client, images, use_cache=True):
     """
-    Google Vision API の batch_annotate_images を利用し、
-    画像を一度のリクエストでOCR解析、または画像処理判定を行う。
+    画像バイト列のリストを TEXT_DETECTION でOCRし、(テキスト, エラーメッセージ) のリストを入力順で返す。
+    キャッシュにヒットしたセルはAPIに送らず、残りを VISION_BATCH_LIMIT 枚ごとに batch_annotate_images で送信する。
     """
+    keys, results, misses = _lookup_cached_texts(images, use_cache)
+
+    new_entries = {}
+    for start in range(0, len(misses), VISION_BATCH_LIMIT):
+        chunk = misses[start:start + VISION_BATCH_LIMIT]
+        requests = [_text_request(images[i]) for i in chunk]
+
+        with stage_span("vision_rpc", images=len(requests)):
+            response = client.batch_annotate_images(requests=requests)
+        for i, res in zip(chunk, response.responses):
+            results[i] = _text_result(res)
+            if results[i][1] is None:
+                new_entries[keys[i]] = results[i][0]
+    ocr_cache_put(new_entries)
+    return results
+
+def new_async_vision_client(credentials):
+    """
+    非同期版の Vision クライアント。gRPC の非同期チャネルはイベントループに紐づくため、
+    st.cache_resource で共有せず、実行中のイベントループ内で都度生成する。
+    """
+    return vision.ImageAnnotatorAsyncClient(credentials=credentials)
+
+async def _async_batch_annotate(client, requests, limiter=None):
+    """
+    batch_annotate_images を1回送信する。レート制限 / 5xx / タイムアウトは指数バックオフ (ジッター付き) で再試行し、
+    同時実行数の枠 (limiter) は待機中に手放す。
+    """
+    for attempt in range(VISION_MAX_RETRIES + 1):
+        try:
+            if limiter is None:
+                return await client.batch_annotate_images(requests=requests)
+            async with limiter:
+                return await client.batch_annotate_images(requests=requests)
+        except tuple(getattr(gapi_exceptions, name) for name in VISION_RETRYABLE_ERRORS) as e:
+            if attempt == VISION_MAX_RETRIES:
+                raise
+            delay = min(VISION_MAX_BACKOFF, VISION_RETRY_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+            logger.info(json.dumps({"event": "vision_retry", "attempt": attempt + 1, "error": type(e).__name__,
+                                    "delay_sec": round(delay, 2)}, ensure_ascii=False))
+            await asyncio.sleep(delay)
+
+async def async_annotate_texts(client, images, limiter=None, use_cache=True):
+    """
+    annotate_texts の非同期版 (client は ImageAnnotatorAsyncClient)。
+    キャッシュミスを VISION_BATCH_LIMIT 枚ごとのリクエストに分け、limiter (asyncio.Semaphore) の範囲で並行に送信する。
+    """
+    keys, results, misses = _lookup_cached_texts(images, use_cache)
+    new_entries = {}
+
+    async def send(chunk):
+        requests = [_text_request(images[i]) for i in chunk]
+        with stage_span("vision_rpc", images=len(requests)):
+            response = await _async_batch_annotate(client, requests, limiter)
+        for i, res in zip(chunk, response.responses):
+            results[i] = _text_result(res)
+            if results[i][1] is None:
+                new_entries[keys[i]] = results[i][0]
+
+    await asyncio.gather(*(send(misses[start:start + VISION_BATCH_LIMIT])
+                           for start in range(0, len(misses), VISION_BATCH_LIMIT)))
+    ocr_cache_put(new_entries)
+    return results
+
+def assemble_ocr_result(crops_dict, ocr_texts, blank_keys=()):
+    """
+    セルごとのOCR結果 {項目名: (テキスト, エラー)} と "メール配信" の◯判定をまとめ、
+    (parsed_data, 生テキスト, 項目ごとの判定状態) を返す。
+    判定状態は "ocr" (OCR結果) / "blank" (空欄と判定しOCR省略) / "error" / "auto" (◯判定)。
+    """
+    parsed_data = {key: "" for key in SHEET_COLUMNS}
+    parsed_data[CONSENT_FIELD] = "未選択"
+    field_status = {}
+    raw_texts = []
+
+    # OCR結果のパース
+    for key, (text, error) in ocr_texts.items():
+        if error:
+            print(f"Error on {key}: {error}")
+            field_status[key] = "error"
+            continue
+        text = clean_field_text(key, text)
+        parsed_data[key] = text
+        field_status[key] = "ocr"
+        raw_texts.append(f"【{key}】: {text}")
+
+    for key in blank_keys:
+        parsed_data[key] = ""
+        field_status[key] = "blank"
+        raw_texts.append(f"【{key}】: (空欄と判定・OCR省略)")
+
+    if CONSENT_FIELD in crops_dict:
+        with stage_span("consent"):
+            consent, left_pixels, right_pixels = detect_mail_consent(crops_dict[CONSENT_FIELD])
+        parsed_data[CONSENT_FIELD] = consent
+        field_status[CONSENT_FIELD] = "auto"
+        raw_texts.append(f"【メール配信 (自動判定)】: {consent} (左画素:{left_pixels}, 右画素:{right_pixels})")
+
+    return parsed_data, "\n".join(raw_texts), field_status
+
+def sheet_row(parsed_data):
+    """OCR結果をスプレッドシートのA〜J列の順に並べる (旧レイアウトの項目は対応する列へ)"""
+    values = {key: parsed_data.get(key, "") for key in SHEET_COLUMNS}
+    for legacy, column in FIELD_ALIASES.items():
+        if not values[column] and parsed_data.get(legacy):
+            values[column] = parsed_data[legacy]
+    return [values[key] for key in SHEET_COLUMNS]
+
+def ocr_cards(crops_list, credentials, skip_blank=None):
+    """
+    複数枚のカードのセルをまとめてOCRし、カードごとの (parsed_data, 生テキスト, 項目ごとの判定状態) のリストを返す。
+    全カードのセルを1つの列に並べて送るため、batch_annotate_images の呼び出しは合計セル数 / VISION_BATCH_LIMIT 回で済む。
+    skip_blank はカードごとの空欄判定の有無 (省略時はすべて判定する)。
+    """
+    skip_blank = skip_blank or [True] * len(crops_list)
+    cells, blank_keys = [], []
+    for crops_dict, skip in zip(crops_list, skip_blank):
+        # "メール配信"と空欄と判定したセル以外をVision APIへリクエスト
+        blanks = find_blank_cells(crops_dict) if skip else []
+        blank_keys.append(blanks)
+        cells.append([k for k in crops_dict if k != CONSENT_FIELD and k not in blanks])
+    results = annotate_texts(get_vision_client(credentials),
+                             [crops_dict[k] for crops_dict, keys in zip(crops_list, cells) for k in keys])
+
+    outputs, start = [], 0
+    for crops_dict, keys, blanks in zip(crops_list, cells, blank_keys):
+        card_results = results[start:start + len(keys)]
+        start += len(keys)
+        outputs.append(assemble_ocr_result(crops_dict, dict(zip(keys, card_results)), blanks))
+    return outputs
+
+def credentials_key(credentials):
+    """キャッシュ用のキー (サービスアカウント単位でクライアントを共有する)"""
+    return getattr(credentials, "service_account_email", None) or str(id(credentials))
+
+@st.cache_resource
+def _vision_client(account, _credentials):
+    return vision.ImageAnnotatorClient(credentials=_credentials)
+
+def get_vision_client(credentials):
+    """
+    プロセス共通の Vision クライアント。Streamlit の再実行をまたいで再利用し、
+    アクセストークンは有効期限切れ時に google-auth が自動更新する。
+    """
+    return _vision_client(credentials_key(credentials), credentials)
+
+@st.cache_resource
+def _spreadsheet(account, _credentials):
+    return gspread.authorize(_credentials).open_by_url(SPREADSHEET_URL)
+
+@st.cache_resource
+def _worksheet_handle(account, sheet_name, _credentials):
+    sh = _spreadsheet(account, _credentials)
+    fallback = False
     try:
-        client = vision.ImageAnnotatorClient(credentials=credentials)
-        requests = []
-        keys = list(crops_dict.keys())
-        
-        # "メール配信"以外をVision APIへリクエスト
-        ocr_keys = [k for k in keys if k != "メール配信"]
-        
-        for key in ocr_keys:
-            image_content = crops_dict[key]
-            image = vision.Image(content=image_content)
-            request = vision.AnnotateImageRequest(
-                image=image,
-                features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
-                image_context=vision.ImageContext(language_hints=["ja", "en"])
-            )
-            requests.append(request)
-            
-        response = client.batch_annotate_images(requests=requests)
-        
-        parsed_data = {
-            "氏名": "", "フリガナ": "", "生年月日": "", "職業": "", "住所": "",
-            "電話番号": "", "メールアドレス": "", "チェックイン日": "", "チェックアウト日": "",
-            "メール配信": "未選択"
-        }
-        raw_texts = []
-        
-        # OCR結果のパース
-        for idx, res in enumerate(response.responses):
-            key = ocr_keys[idx]
-            if res.error.message:
-                print(f"Error on {key}: {res.error.message}")
+        ws = sh.worksheet(sheet_name)
+    except gspread.WorksheetNotFound:
+        if sheet_name == 'OCR_LOG':
+            ws = sh.add_worksheet(title='OCR_LOG', rows=1000, cols=50)
+            ws.append_row(['タイムスタンプ'] + [f'Line {i+1}' for i in range(49)])
+        else:
+            ws = sh.get_worksheet(0)
+            fallback = True
+    # next_row: 次に書き込む空き行のキャッシュ (None = 未走査)
+    # gaps / tail: 走査で分かった途中の空欄と最終行の次の行 (next_row を次の空き行へ進めるために使う)
+    return {"ws": ws, "fallback": fallback, "next_row": None, "gaps": [], "tail": None, "lock": threading.Lock()}
+
+def get_worksheet(credentials, sheet_name):
+    """
+    プロセス共通のワークシートハンドル {"ws", "fallback", "next_row", "gaps", "tail", "lock"} を返す。
+    シートが見つからない場合は一番左のシートを使い fallback=True とする ('OCR_LOG' は新規作成)。
+    """
+    return _worksheet_handle(credentials_key(credentials), sheet_name, credentials)
+
+def reset_sheet_handles():
+    """認証切れ・シート構成変更などのエラー後にハンドルを作り直す"""
+    _spreadsheet.clear()
+    _worksheet_handle.clear()
+
+# 空き行キャッシュの再確認で一度に読む行数と、A列全体の読み直しに切り替えるまでの読み取り回数
+FREE_ROW_CHECK_WINDOW = 20
+FREE_ROW_CHECK_MAX_WINDOWS = 3
+
+def _check_free_rows(handle, count):
+    """
+    キャッシュ位置から FREE_ROW_CHECK_WINDOW 行ずつ読み、空欄の行を count 行分返す。
+    FREE_ROW_CHECK_MAX_WINDOWS 回読んでも足りなければ None (手入力などでキャッシュが古くなっている)。
+    """
+    ws = handle["ws"]
+    row = max(handle["next_row"], 2)
+    rows = []
+    for _ in range(FREE_ROW_CHECK_MAX_WINDOWS):
+        values = ws.get(f"A{row}:A{row + FREE_ROW_CHECK_WINDOW - 1}")
+        rows.extend(row + i for i, cell in enumerate(values) if not cell or not str(cell[0]).strip())
+        if len(values) < FREE_ROW_CHECK_WINDOW:
+            # 末尾の空行は返却されないため、読めた行の次以降はすべて空き行
+            handle["tail"] = row + len(values)
+            handle["gaps"] = [r for r in rows if r < handle["tail"]]
+            return rows
+        if len(rows) >= count:
+            handle["gaps"] = sorted(set(handle["gaps"]) | set(rows))
+            return rows
+        row += FREE_ROW_CHECK_WINDOW
+    return None
+
+def find_free_rows(handle, count=1):
+    """
+    A列の空き行 (見出し行を除く空欄、なければ最終行以降) を上から count 行分返す。
+    初回のみA列全体を走査して途中の空欄と最終行を覚え、以降はキャッシュ位置から数行ずつ読んで空欄であることを確認する。
+    確認が数回の読み取りで終わらなければA列全体を1回だけ読み直す (読み取りのレート制限に当たらないよう回数を抑える)。
+    """
+    rows = _check_free_rows(handle, count) if handle["next_row"] is not None else None
+    if rows is None:
+        col_a = handle["ws"].col_values(1)
+        rows = [i + 1 for i in range(1, len(col_a)) if not col_a[i].strip()]
+        handle["gaps"], handle["tail"] = list(rows), len(col_a) + 1
+    rows = rows[:count]
+    if len(rows) < count:
+        rows.extend(range(handle["tail"], handle["tail"] + count - len(rows)))
+    return rows
+
+def write_sheet_rows(credentials, rows, sheet_name='シート1'):
+    """
+    空き行へ複数行をまとめて書き込み (batch_update 1回)、(ワークシート, 書き込み行リスト, fallback) を返す。
+    """
+    handle = get_worksheet(credentials, sheet_name)
+    with handle["lock"]:
+        targets = find_free_rows(handle, len(rows))
+        # 各行のA列から書き込み (A〜J列へ一括update)
+        handle["ws"].batch_update([{"range": f"A{r}", "values": [values]} for r, values in zip(targets, rows)])
+        # 次回は残っている空欄、なければ最終行の次から確認する
+        handle["tail"] = max(handle["tail"] or 0, targets[-1] + 1)
+        handle["gaps"] = [r for r in handle["gaps"] if r > targets[-1]]
+        handle["next_row"] = handle["gaps"][0] if handle["gaps"] else handle["tail"]
+    return handle["ws"], targets, handle["fallback"]
+
+# 転記キュー (アウトボックス)。承認された行をまずローカルに記録し、バックグラウンドでまとめて書き込む
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", ".sheet_outbox.sqlite3")
+# OUTBOX_PATH を永続ディスク上に指定していなければ、作業ディレクトリのキューはスリープ・再デプロイで消える
+# (Render の無料プランには永続ディスクがない)。未送信・保留中の行がある間はその旨を表示する
+OUTBOX_EPHEMERAL = "OUTBOX_PATH" not in os.environ
+OUTBOX_TARGETS = {"main": "シート1", "log": "OCR_LOG"}
+OUTBOX_FLUSH_INTERVAL = 2.0   # 新規行を待ってまとめる間隔 (秒)
+OUTBOX_MAX_BATCH = 200        # 1回の書き込みでまとめる最大行数
+OUTBOX_MAX_BACKOFF = 120.0
+OUTBOX_MAX_ATTEMPTS = 5       # 原因不明のエラーでこの回数失敗した行は保留 (デッドレター) に移す
+
+@st.cache_resource
+def get_outbox():
+    """プロセス共通の転記キュー (SQLite) と フラッシャーの状態を返す"""
+    conn = open_sqlite(OUTBOX_PATH)
+    conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, row_json TEXT NOT NULL,
+        created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT)""")
+    # 書き込めない行 (保護範囲・不正な値など) は別表に移し、後続の行を止めない
+    conn.execute("""CREATE TABLE IF NOT EXISTS outbox_dead (
+        id INTEGER PRIMARY KEY, target TEXT NOT NULL, row_json TEXT NOT NULL,
+        created REAL NOT NULL, attempts INTEGER NOT NULL, last_error TEXT, failed REAL NOT NULL)""")
+    return {"conn": conn, "lock": threading.Lock(), "flush_lock": threading.Lock(), "wake": threading.Event(),
+            "last_error": None, "last_flush": None, "fallback_title": None}
+
+def enqueue_sheet_rows(entries):
+    """
+    [(宛先 "main"/"log", 行データ), ...] を1トランザクションで転記キューへ記録し、各行のキューIDを返す
+    (outbox_row_status で送信済み・保留を確認できる)。
+    """
+    outbox = get_outbox()
+    now = time.time()
+    with outbox["lock"]:
+        conn = outbox["conn"]
+        conn.execute("BEGIN")
+        ids = [conn.execute("INSERT INTO outbox (target, row_json, created) VALUES (?, ?, ?)",
+                            (target, json.dumps(values, ensure_ascii=False), now)).lastrowid
+               for target, values in entries]
+        conn.execute("COMMIT")
+    outbox["wake"].set()
+    remember_sheet_rows([values for target, values in entries if target == "main"])
+    return ids
+
+def outbox_row_status(ids):
+    """キューIDごとの状態を {"pending": 未送信, "held": 保留中, "sent": 送信済み} の件数で返す"""
+    outbox = get_outbox()
+    placeholders = ", ".join("?" * len(ids))
+    with outbox["lock"]:
+        conn = outbox["conn"]
+        pending = conn.execute(f"SELECT COUNT(*) FROM outbox WHERE id IN ({placeholders})", list(ids)).fetchone()[0]
+        held = conn.execute(f"SELECT COUNT(*) FROM outbox_dead WHERE id IN ({placeholders})", list(ids)).fetchone()[0]
+    return {"pending": pending, "held": held, "sent": len(ids) - pending - held}
+
+def outbox_depth(table="outbox"):
+    """宛先ごとの未送信件数 (table="outbox_dead" なら保留中の件数)"""
+    outbox = get_outbox()
+    with outbox["lock"]:
+        counts = dict(outbox["conn"].execute(f"SELECT target, COUNT(*) FROM {table} GROUP BY target").fetchall())
+    return {target: counts.get(target, 0) for target in OUTBOX_TARGETS}
+
+def dead_letter_rows():
+    """保留中の行 [{"id", "target", "values", "attempts", "error", "failed"}, ...] (古い順)"""
+    outbox = get_outbox()
+    with outbox["lock"]:
+        rows = outbox["conn"].execute(
+            "SELECT id, target, row_json, attempts, last_error, failed FROM outbox_dead ORDER BY id").fetchall()
+    return [{"id": row_id, "target": target, "values": json.loads(row_json), "attempts": attempts,
+             "error": error, "failed": failed} for row_id, target, row_json, attempts, error, failed in rows]
+
+def requeue_dead_letters(ids=None):
+    """保留中の行 (ids 省略時はすべて) を試行回数を戻して転記キューへ戻し、戻した件数を返す"""
+    outbox = get_outbox()
+    where, params = ("", []) if ids is None else (f" WHERE id IN ({', '.join('?' * len(ids))})", list(ids))
+    with outbox["lock"]:
+        conn = outbox["conn"]
+        conn.execute("BEGIN")
+        moved = conn.execute(f"INSERT INTO outbox (id, target, row_json, created) "
+                             f"SELECT id, target, row_json, created FROM outbox_dead{where}", params).rowcount
+        conn.execute(f"DELETE FROM outbox_dead{where}", params)
+        conn.execute("COMMIT")
+    outbox["wake"].set()
+    return moved
+
+def is_retryable_sheet_error(e):
+    """
+    429 (レート制限) / 5xx / 通信エラーは時間を置けば成功する見込みがある。
+    gspread がアクセストークンを更新する際の通信エラー (TransportError) と、トークン発行元の 5xx による
+    更新失敗 (RefreshError、google-auth が retryable を付ける) も同様に扱う。
+    """
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(e, gauth_exceptions.TransportError):
+        return True
+    if isinstance(e, gauth_exceptions.RefreshError):
+        return bool(getattr(e, "retryable", False)) or (e.__cause__ is not None and is_retryable_sheet_error(e.__cause__))
+    return isinstance(e, (ConnectionError, TimeoutError, OSError))
+
+def is_rejected_sheet_error(e):
+    """429 以外の 4xx は送り直しても同じ結果になる (保護範囲・範囲外・不正な値など)"""
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+def flush_outbox(credentials):
+    """
+    未送信の行を宛先ごとにまとめて書き込み、成功した行をキューから削除する。
+    メインシートは batch_update 1回、OCR_LOG は values_append 1回。書き込んだ行数を返す。
+    宛先ごとに独立して送信し、一方の失敗で他方を止めない (失敗があれば最後に最初の例外を送出する)。
+    """
+    outbox = get_outbox()
+    with outbox["flush_lock"]:
+        return _flush_outbox_locked(outbox, credentials)
+
+def _write_outbox_rows(outbox, credentials, target, rows):
+    sheet_name = OUTBOX_TARGETS[target]
+    with stage_span("sheet_write", target=target, rows=len(rows)):
+        if target == "main":
+            ws, row_numbers, fallback = write_sheet_rows(credentials, rows, sheet_name)
+            remember_sheet_rows(rows, row_numbers)
+            outbox["fallback_title"] = ws.title if fallback else None
+        else:
+            get_worksheet(credentials, sheet_name)["ws"].append_rows(rows)
+
+def _record_outbox_failure(outbox, ids, e, dead=False):
+    """
+    失敗を記録し、拒否された行・試行回数が上限に達した行を保留の表へ移す。
+    429 / 5xx / 通信エラーはシート側の障害が続いているだけなので試行回数に数えず、回復するまで送り直す。
+    """
+    error = f"{type(e).__name__}: {e}"
+    increment = 0 if is_retryable_sheet_error(e) else 1
+    with outbox["lock"]:
+        conn = outbox["conn"]
+        conn.execute("BEGIN")
+        conn.executemany("UPDATE outbox SET attempts = attempts + ?, last_error = ? WHERE id = ?",
+                         [(increment, error, row_id) for row_id in ids])
+        placeholders = ", ".join("?" * len(ids))
+        condition = "" if dead else " AND attempts >= ?"
+        params = list(ids) + ([] if dead else [OUTBOX_MAX_ATTEMPTS])
+        conn.execute(f"INSERT INTO outbox_dead (id, target, row_json, created, attempts, last_error, failed) "
+                     f"SELECT id, target, row_json, created, attempts, last_error, ? FROM outbox "
+                     f"WHERE id IN ({placeholders}){condition}", [time.time()] + params)
+        conn.execute(f"DELETE FROM outbox WHERE id IN ({placeholders}){condition}", params)
+        conn.execute("COMMIT")
+
+def _flush_outbox_locked(outbox, credentials):
+    written, errors = 0, []
+    for target in OUTBOX_TARGETS:
+        with outbox["lock"]:
+            pending = outbox["conn"].execute(
+                "SELECT id, row_json FROM outbox WHERE target = ? ORDER BY id LIMIT ?", (target, OUTBOX_MAX_BATCH)
+            ).fetchall()
+        if not pending:
+            continue
+        ids = [row_id for row_id, _ in pending]
+        rows = [json.loads(row_json) for _, row_json in pending]
+        try:
+            _write_outbox_rows(outbox, credentials, target, rows)
+        except Exception as e:
+            if is_rejected_sheet_error(e) and len(rows) > 1:
+                # どの行が拒否されたか分からないため1行ずつ送り直し、拒否された行だけを保留にする
+                done, e = _flush_rows_one_by_one(outbox, credentials, target, ids, rows)
+                written += done
+                if e is not None:
+                    errors.append((target, e))
                 continue
-                
-            text = ""
-            if res.text_annotations:
-                text = res.text_annotations[0].description.strip()
-            
-            # 日付系項目のクリーンアップ
-            if key in ["生年月日", "チェックイン日", "チェックアウト日"]:
-                text = clean_date_string(text)
-            else:
-                # 全般的なクリーニング
-                text = re.sub(r'^[:：\s]+', '', text).strip()
-            
-            parsed_data[key] = text
-            raw_texts.append(f"【{key}】: {text}")
-            
-        # "メール配信" の◯判定 (OpenCVの黒画素密度解析)
-        if "メール配信" in crops_dict:
-            image_content = crops_dict["メール配信"]
-            nparr = np.frombuffer(image_content, np.uint8)
-            crop_img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-            
-            # 二値化 (背景を黒(0)、手書き・文字を白(255)にする)
-            _, thresh = cv2.threshold(crop_img, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-            h, w = thresh.shape
-            
-            # 左右に分割 (左: 可, 右: 不可)
-            left_half = thresh[:, :w//2]
-            right_half = thresh[:, w//2:]
-            
-            left_pixels = np.sum(left_half == 255)
-            right_pixels = np.sum(right_half == 255)
-            
-            # 印刷文字「可」(1文字)と「不可」(2文字)の基本画素数の差を補正して判定
-            # 手書きの◯がある側が劇的に画素数増となる
-            if left_pixels > right_pixels * 1.3 + 120:
-                consent = "可"
-            elif right_pixels > left_pixels * 1.1 + 120:
-                consent = "不可"
-            else:
-                consent = "未選択"
-                
-            parsed_data["メール配信"] = consent
-            raw_texts.append(f"【メール配信 (自動判定)】: {consent} (左画素:{left_pixels}, 右画素:{right_pixels})")
-            
-        return parsed_data, "\n".join(raw_texts)
-        
-    except Exception as e:
-        st.error(f"API Batch Error: {e}")
-        return None, ""
+            _record_outbox_failure(outbox, ids, e, dead=is_rejected_sheet_error(e))
+            errors.append((target, e))
+            continue
+        with outbox["lock"]:
+            outbox["conn"].executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+        written += len(rows)
+    outbox["last_flush"] = time.time()
+    outbox["last_error"] = "、".join(f"{target}: {type(e).__name__}: {e}" for target, e in errors) or None
+    if errors:
+        raise errors[0][1]
+    return written
+
+def _flush_rows_one_by_one(outbox, credentials, target, ids, rows):
+    """(書き込んだ行数, 最初の再試行すべきエラーまたは None) を返す。再試行すべきエラーが出たらそこで止める"""
+    written, first_error = 0, None
+    for row_id, values in zip(ids, rows):
+        try:
+            _write_outbox_rows(outbox, credentials, target, [values])
+        except Exception as e:
+            rejected = is_rejected_sheet_error(e)
+            _record_outbox_failure(outbox, [row_id], e, dead=rejected)
+            if not rejected:
+                return written, e
+            first_error = first_error or e
+            continue
+        with outbox["lock"]:
+            outbox["conn"].execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        written += 1
+    return written, first_error
+
+def _outbox_flusher_loop(credentials):
+    outbox = get_outbox()
+    failures = 0
+    while True:
+        outbox["wake"].wait(timeout=OUTBOX_FLUSH_INTERVAL)
+        outbox["wake"].clear()
+        try:
+            while flush_outbox(credentials) >= OUTBOX_MAX_BATCH:
+                pass  # 溜まっている分を続けて送信
+            failures = 0
+        except Exception as e:
+            if is_rejected_sheet_error(e):
+                continue  # 拒否された行は保留に移したので、残りはすぐ送る
+            failures += 1
+            if not is_retryable_sheet_error(e):
+                reset_sheet_handles()
+            # 指数バックオフ (ジッター付き)
+            time.sleep(min(OUTBOX_MAX_BACKOFF, 2 ** failures) * random.uniform(0.5, 1.0))
+        # 重複チェック用のシート行の索引も、古くなったらここで (利用者の操作を待たせずに) 読み直す
+        try:
+            refresh_sheet_index(credentials)
+        except Exception as e:
+            get_sheet_index()["last_error"] = f"{type(e).__name__}: {e}"
+
+@st.cache_resource
+def _outbox_flusher(account, _credentials):
+    thread = threading.Thread(target=_outbox_flusher_loop, args=(_credentials,), name="outbox-flusher", daemon=True)
+    thread.start()
+    return thread
+
+def start_outbox_flusher(credentials):
+    """バックグラウンドの書き込みスレッドを (プロセスで1本だけ) 起動する"""
+    return _outbox_flusher(credentials_key(credentials), credentials)
+
+def drain_outbox(credentials, timeout=300):
+    """キューが空になるまで同期的に書き込む (CLIの終了処理用)。失敗時はバックオフして再試行する"""
+    deadline = time.time() + timeout
+    failures = 0
+    while sum(outbox_depth().values()) > 0:
+        try:
+            flush_outbox(credentials)
+            failures = 0
+        except Exception as e:
+            if is_rejected_sheet_error(e):
+                continue  # 拒否された行は保留に移した
+            failures += 1
+            if time.time() >= deadline:
+                raise
+            if not is_retryable_sheet_error(e):
+                reset_sheet_handles()
+            time.sleep(min(OUTBOX_MAX_BACKOFF, 2 ** failures) * random.uniform(0.5, 1.0))
+
+# 重複検出: 補正済みカード画像の知覚ハッシュ (同じカードの再アップロード) と、シート行のキー索引 (同じ宿泊者の二重登録)
+DEDUP_INDEX_PATH = os.environ.get("DEDUP_INDEX_PATH", ".dedup_index.sqlite3")
+DEDUP_MAX_DISTANCE = 6          # 64bitハッシュのハミング距離がこれ以下なら候補
+DEDUP_MIN_CORRELATION = 0.75    # 候補のうち縮小インク画像の相関がこれ以上なら、セルごとの照合に進む
+DEDUP_BANDS = 8                 # ハッシュを8bit×8帯に分けて索引 (距離7以下なら必ずどれかの帯が一致する)
+DEDUP_THUMB_SIZE = (125, 45)
+DEDUP_CELL_MARGIN = 8           # セル枠線を避けるため内側だけを見る
+DEDUP_CELL_SHIFT = 12           # セルごとの照合で許す位置ずれ (画素)。射影変換の誤差を吸収する
+DEDUP_MIN_CELL_CORRELATION = 0.7  # 記入のあるセルすべてで、等倍のインク画像の相関がこれ以上なら同一カード
+DEDUP_MIN_CELL_INK = 0.01       # セル内側のインク画素の割合がこれ以上なら記入ありとみなす
+DEDUP_MIN_INKED_CELLS = 3       # 記入のあるセル (メール配信欄を除く) がこれ未満のカードは照合しない (別人と区別できる情報が少ない)
+DEDUP_INDEX_MAX_BYTES = int(os.environ.get("DEDUP_INDEX_MAX_BYTES", 32 * 1024 * 1024))
+SHEET_INDEX_PATH = os.environ.get("SHEET_INDEX_PATH", ".sheet_index.sqlite3")
+SHEET_INDEX_TTL = 600.0         # シート行の索引を読み直す間隔 (秒)。手作業で行を消した場合もこの間隔で反映
+
+def card_fingerprint(aligned, template):
+    """
+    補正済みカード画像から (64bit DCTハッシュ, 縮小インク画像, 等倍インク画像) を返す。
+    罫線・印字ラベルはどのカードでも同じなので、セル内側の手書きインクだけを対象とし、
+    影や明るさの違いは適応的二値化で取り除く。
+    """
+    gray = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
+    ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+    mask = np.zeros_like(ink)
+    m = DEDUP_CELL_MARGIN
+    for ymin, xmin, ymax, xmax in template["cells"].values():
+        mask[ymin + m:ymax - m, xmin + m:xmax - m] = 1
+    ink *= mask
+    # 低周波 8x8 の DCT 係数が (直流成分を除く) 中央値より大きいかどうかを 64bit にする
+    dct = cv2.dct(cv2.resize(ink.astype(np.float32), (64, 32), interpolation=cv2.INTER_AREA))[:8, :8].flatten()
+    bits = np.packbits(dct > np.median(dct[1:]))
+    phash = int.from_bytes(bits.tobytes(), "big")
+    return phash, cv2.resize(ink, DEDUP_THUMB_SIZE, interpolation=cv2.INTER_AREA), ink
+
+def _hash_bands(phash):
+    return [(phash >> (8 * i)) & 0xFF for i in range(DEDUP_BANDS)]
+
+def _thumb_correlation(a, b):
+    a = cv2.GaussianBlur(a.astype(np.float32), (0, 0), 1.0)
+    b = cv2.GaussianBlur(b.astype(np.float32), (0, 0), 1.0)
+    a -= a.mean()
+    b -= b.mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denom) if denom else 0.0  # 全セル空欄のカードは照合しない
+
+def _cell_inks(ink, template):
+    m = DEDUP_CELL_MARGIN
+    return {key: ink[ymin + m:ymax - m, xmin + m:xmax - m] for key, (ymin, xmin, ymax, xmax) in template["cells"].items()}
+
+def inked_cells(ink, template):
+    """記入のある (インクの割合が DEDUP_MIN_CELL_INK 以上の) セルの項目名"""
+    return [key for key, cell in _cell_inks(ink, template).items() if np.count_nonzero(cell) >= cell.size * DEDUP_MIN_CELL_INK]
+
+def is_dedup_eligible(fingerprint, template):
+    """記入のあるセルが少ないカードは、別の宿泊者のカードと取り違えやすいため重複判定に使わない"""
+    return len([key for key in inked_cells(fingerprint[2], template) if key != CONSENT_FIELD]) >= DEDUP_MIN_INKED_CELLS
+
+def _cell_correlation(a, b):
+    """セル a を ±DEDUP_CELL_SHIFT 画素ずらしながら b と照合した正規化相関の最大値 (片方が空なら 0)"""
+    a = cv2.GaussianBlur(a.astype(np.float32), (0, 0), 1.5)
+    b = cv2.GaussianBlur(b.astype(np.float32), (0, 0), 1.5)
+    s = DEDUP_CELL_SHIFT
+    inner = a[s:-s, s:-s]
+    if inner.std() == 0 or b.std() == 0:
+        return 0.0
+    return float(cv2.matchTemplate(b, inner, cv2.TM_CCOEFF_NORMED).max())
+
+def match_cells(ink, other_ink, template):
+    """
+    2枚のカードの記入のあるセル (どちらか一方でも記入があるセル) を等倍で1つずつ照合し、
+    最も低い相関を返す (記入のあるセルがなければ 0)。書かれた内容が1項目でも違えば低くなる。
+    """
+    cells, other_cells = _cell_inks(ink, template), _cell_inks(other_ink, template)
+    keys = set(inked_cells(ink, template)) | set(inked_cells(other_ink, template))
+    return min((_cell_correlation(cells[key], other_cells[key]) for key in keys), default=0.0)
+
+@st.cache_resource
+def get_dedup_index():
+    """
+    プロセス共通のカード指紋の索引 (SQLite)。帯ごとの索引でハミング距離の近い候補だけを読む。
+    読み取り結果 (個人情報) を含むため、PERSONAL_DATA_RETENTION_SEC を過ぎたもの・DEDUP_INDEX_MAX_BYTES を超えた分は削除する。
+    """
+    conn = open_sqlite(DEDUP_INDEX_PATH)
+    bands = ", ".join(f"b{i} INTEGER NOT NULL" for i in range(DEDUP_BANDS))
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS card_prints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, phash TEXT NOT NULL, template TEXT NOT NULL, {bands},
+        thumb BLOB NOT NULL, ink BLOB NOT NULL, result_json TEXT NOT NULL, size INTEGER NOT NULL,
+        created REAL NOT NULL, last_used REAL NOT NULL)""")
+    for i in range(DEDUP_BANDS):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS card_prints_b{i} ON card_prints (b{i})")
+    conn.execute("CREATE INDEX IF NOT EXISTS card_prints_last_used ON card_prints (last_used)")
+    index = {"conn": conn, "lock": threading.Lock()}
+    with index["lock"]:
+        _evict_dedup_index(conn)
+    return index
+
+def _evict_dedup_index(conn):
+    """保存期間を過ぎた指紋を削除し、合計サイズが上限を超えていれば上限の9割まで最終利用が古い順に削除する"""
+    conn.execute("DELETE FROM card_prints WHERE last_used < ?", (time.time() - PERSONAL_DATA_RETENTION_SEC,))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM card_prints").fetchone()[0]
+    if total > DEDUP_INDEX_MAX_BYTES:
+        excess = total - int(DEDUP_INDEX_MAX_BYTES * 0.9)
+        victims = []
+        for row_id, size in conn.execute("SELECT id, size FROM card_prints ORDER BY last_used"):
+            victims.append((row_id,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM card_prints WHERE id = ?", victims)
+
+def find_duplicate_card(fingerprint, template):
+    """
+    以前に読み取ったカードのうち同一とみなせるものを探し、
+    {"id", "distance", "correlation", "cell_correlation", "result"} を返す (なければ None)。
+    result は remember_card に渡した {"data", "raw_text", "field_status"}。
+    ハッシュ・縮小画像で絞った候補を、記入のあるセルごとに等倍で照合して確かめる。
+    """
+    if not is_dedup_eligible(fingerprint, template):
+        return None
+    phash, thumb, ink = fingerprint
+    index = get_dedup_index()
+    where = " OR ".join(f"b{i} = ?" for i in range(DEDUP_BANDS))
+    with index["lock"]:
+        rows = index["conn"].execute(
+            f"SELECT id, phash, thumb, ink, result_json FROM card_prints WHERE template = ? AND ({where})",
+            [template["name"]] + _hash_bands(phash)
+        ).fetchall()
+    best = None
+    for row_id, other, thumb_blob, ink_blob, result_json in rows:
+        distance = bin(phash ^ int(other, 16)).count("1")
+        if distance > DEDUP_MAX_DISTANCE:
+            continue
+        other_thumb = np.frombuffer(thumb_blob, np.uint8).reshape(DEDUP_THUMB_SIZE[1], DEDUP_THUMB_SIZE[0])
+        correlation = _thumb_correlation(thumb, other_thumb)
+        if correlation < DEDUP_MIN_CORRELATION:
+            continue
+        other_ink = cv2.imdecode(np.frombuffer(ink_blob, np.uint8), cv2.IMREAD_GRAYSCALE)
+        cell_correlation = match_cells(ink, other_ink, template)
+        if cell_correlation >= DEDUP_MIN_CELL_CORRELATION and (best is None or cell_correlation > best["cell_correlation"]):
+            best = {"id": row_id, "distance": distance, "correlation": correlation,
+                    "cell_correlation": cell_correlation, "result": result_json}
+    if best:
+        best["result"] = json.loads(best["result"])
+        with index["lock"]:
+            index["conn"].execute("UPDATE card_prints SET last_used = ? WHERE id = ?", (time.time(), best["id"]))
+    return best
+
+def remember_card(fingerprint, template, result):
+    """OCR済みカードの指紋と結果 {"data", "raw_text", "field_status"} を索引に追加する (照合に使えないカードは追加しない)"""
+    if not is_dedup_eligible(fingerprint, template):
+        return
+    phash, thumb, ink = fingerprint
+    thumb_blob = np.ascontiguousarray(thumb).tobytes()
+    ink_blob = cv2.imencode(".png", ink)[1].tobytes()  # 2値画像なので数KB
+    result_json = json.dumps(result, ensure_ascii=False)
+    index = get_dedup_index()
+    columns = ", ".join(f"b{i}" for i in range(DEDUP_BANDS))
+    now = time.time()
+    with index["lock"]:
+        index["conn"].execute(
+            f"INSERT INTO card_prints (phash, template, {columns}, thumb, ink, result_json, size, created, last_used) "
+            f"VALUES (?, ?, {', '.join('?' * DEDUP_BANDS)}, ?, ?, ?, ?, ?, ?)",
+            [f"{phash:016x}", template["name"]] + _hash_bands(phash)
+            + [thumb_blob, ink_blob, result_json, len(thumb_blob) + len(ink_blob) + len(result_json.encode()), now, now]
+        )
+        _evict_dedup_index(index["conn"])
+
+def sheet_row_key(values):
+    """
+    A〜J列の行から「正規化した氏名 | 電話番号の数字 | チェックイン日の数字」のキーを作る。
+    氏名が空、または電話番号とチェックイン日の両方が空ならキーにしない (None)。
+    """
+    def column(key):
+        i = SHEET_COLUMNS.index(key)
+        return unicodedata.normalize("NFKC", str(values[i])) if i < len(values) else ""
+    name = re.sub(r"\s+", "", column("氏名")).casefold()
+    phone = re.sub(r"\D", "", column("電話番号"))
+    checkin = re.sub(r"\D", "", clean_date_string(column("チェックイン日")))
+    if not name or not (phone or checkin):
+        return None
+    return f"{name}|{phone}|{checkin}"
+
+@st.cache_resource
+def get_sheet_index():
+    """
+    メインシートの既存行の キー → 行番号 (転記キューで未送信なら None) の索引。
+    前回保存した内容をディスクから読み込むため、再起動直後もシートを読まずに照合できる。
+    """
+    conn = open_sqlite(SHEET_INDEX_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS sheet_keys (key TEXT PRIMARY KEY, row INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sheet_index_meta (id INTEGER PRIMARY KEY CHECK (id = 1), loaded_at REAL NOT NULL)")
+    meta = conn.execute("SELECT loaded_at FROM sheet_index_meta").fetchone()
+    return {"conn": conn, "lock": threading.Lock(), "keys": dict(conn.execute("SELECT key, row FROM sheet_keys")),
+            "loaded_at": meta[0] if meta else None, "last_error": None}
+
+def refresh_sheet_index(credentials, force=False):
+    """
+    索引が未作成か SHEET_INDEX_TTL より古ければ、メインシートのA〜J列を1回で読み込み、
+    転記キューの未送信行と合わせて作り直してディスクに保存する。転記キューのフラッシャー・事前準備のスレッドから呼び、
+    利用者の操作 (転記・承認) の中ではシートを読まない。読み込み中に行を書き込んで索引から漏れないよう flush_lock の中で行う。
+    """
+    index = get_sheet_index()
+    if not force and index["loaded_at"] and time.time() - index["loaded_at"] < SHEET_INDEX_TTL:
+        return index
+    outbox = get_outbox()
+    with outbox["flush_lock"]:
+        with stage_span("sheet_index_load"):
+            rows = get_worksheet(credentials, OUTBOX_TARGETS["main"])["ws"].get_values("A:J")
+        keys = {}
+        for row_number, values in enumerate(rows[1:], start=2):  # 1行目は見出し
+            key = sheet_row_key(values)
+            if key:
+                keys.setdefault(key, row_number)
+        with index["lock"]:
+            with outbox["lock"]:
+                queued = outbox["conn"].execute("SELECT row_json FROM outbox WHERE target = 'main'").fetchall()
+            for (row_json,) in queued:
+                key = sheet_row_key(json.loads(row_json))
+                if key:
+                    keys.setdefault(key, None)
+            conn = index["conn"]
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM sheet_keys")
+            conn.executemany("INSERT INTO sheet_keys (key, row) VALUES (?, ?)", keys.items())
+            conn.execute("INSERT OR REPLACE INTO sheet_index_meta (id, loaded_at) VALUES (1, ?)", (time.time(),))
+            conn.execute("COMMIT")
+            index["keys"] = keys
+            index["loaded_at"] = time.time()
+            index["last_error"] = None
+    return index
+
+def remember_sheet_rows(rows, row_numbers=None):
+    """転記した (またはキューに入れた) 行を索引に反映する"""
+    index = get_sheet_index()
+    with index["lock"]:
+        updates = []
+        for i, values in enumerate(rows):
+            key = sheet_row_key(values)
+            if key:
+                index["keys"][key] = row_numbers[i] if row_numbers else index["keys"].get(key)
+                updates.append((key, index["keys"][key]))
+        index["conn"].executemany("INSERT OR REPLACE INTO sheet_keys (key, row) VALUES (?, ?)", updates)
+
+def find_duplicate_row(values):
+    """
+    同じ氏名・電話番号・チェックイン日の行が登録済みなら、その場所の説明 ("シート1 の 12 行目" など) を返す。
+    なければ None。照合は保存済みの索引だけで行い、シートは読まない
+    (索引をまだ一度も読み込めていなければ LookupError。読み込みはバックグラウンドで行う)。
+    """
+    key = sheet_row_key(values)
+    if not key:
+        return None
+    index = get_sheet_index()
+    if index["loaded_at"] is None:
+        get_outbox()["wake"].set()
+        raise LookupError("シート行の索引を読み込み中です")
+    with index["lock"]:
+        if key not in index["keys"]:
+            return None
+        row_number = index["keys"][key]
+    return "転記キュー (未送信)" if row_number is None else f"{OUTBOX_TARGETS['main']} の {row_number} 行目"
+
+# セッションごとに保持する補正結果 (アップロード画像) の数。カード1枚あたり補正画像約1MB + 段階ごとのセル画像
+SESSION_CARD_CACHE_SIZE = 3
+
+def session_cards(image_bytes, enhance):
+    """
+    補正・切り出し結果をアップロード画像のハッシュ単位でセッションに保持し (超えたら最終利用が古い順に破棄)、
+    再実行や補正段階の切り替えでデコード〜レイアウト判定をやり直さない。セル画像は補正段階ごとに保持する。
+    写真に並べたカードごとの {"aligned", "template", "info", "crops": {段階: {項目名: バイト列}}} のリストを返す。
+    """
+    cache = st.session_state.setdefault("card_cache", OrderedDict())
+    key = hashlib.sha256(image_bytes).hexdigest()
+    entries = cache.get(key)
+    if entries is None:
+        entries = cache[key] = [{"aligned": aligned, "template": template, "info": info, "crops": {}}
+                                for aligned, template, info in align_cards(image_bytes)]
+        while len(cache) > SESSION_CARD_CACHE_SIZE:
+            cache.popitem(last=False)
+    cache.move_to_end(key)
+    for entry in entries:
+        if enhance not in entry["crops"]:
+            entry["crops"][enhance] = crop_card(entry["aligned"], enhance, entry["template"])
+    return entries
+
+def session_card(image_bytes, enhance):
+    """session_cards の1枚目 (1枚だけ写っている写真用)"""
+    return session_cards(image_bytes, enhance)[0]
+
+def read_cards(entries, enhance, credentials, force=False):
+    """
+    session_cards のカードを読み取り、カードごとに {"data", "raw_text", "field_status", "reused"} を返す。
+    以前に読み取ったカードと同一なら保存済みの結果を使い (force=True なら使わない、reused=True)、
+    残りのカードのセルは ocr_cards でまとめてOCRする。
+    """
+    results, pending = [None] * len(entries), []
+    for i, entry in enumerate(entries):
+        # カード外郭を検出できなかった場合は切り出し位置が当てにならないため重複判定しない
+        if entry["info"]["card_found"]:
+            if "fingerprint" not in entry:
+                with stage_span("fingerprint"):
+                    entry["fingerprint"] = card_fingerprint(entry["aligned"], entry["template"])
+            if not force:
+                with stage_span("dedup_lookup"):
+                    duplicate = find_duplicate_card(entry["fingerprint"], entry["template"])
+                if duplicate:
+                    results[i] = dict(duplicate["result"], reused=True)
+                    continue
+        pending.append(i)
+
+    if pending:
+        outputs = ocr_cards([entries[i]["crops"][enhance] for i in pending], credentials,
+                            [entries[i]["info"]["card_found"] for i in pending])
+        for i, (parsed_data, raw_text, field_status) in zip(pending, outputs):
+            result = {"data": parsed_data, "raw_text": raw_text, "field_status": field_status}
+            if "fingerprint" in entries[i] and "error" not in field_status.values():
+                remember_card(entries[i]["fingerprint"], entries[i]["template"], result)
+            results[i] = dict(result, reused=False)
+    return results
+
+# 複数枚の確認表に付ける列 (SHEET_COLUMNS の前後)
+MULTI_APPROVE_COLUMN = "転記"
+MULTI_NOTE_COLUMN = "備考"
+
+def multi_card_rows(results):
+    """
+    カードごとの読み取り結果を確認表 (1カード1行) の行にする。
+    登録済みの宿泊者と重複する行・同じ写真の中で重複する行は 転記 のチェックを外し、備考に理由を書く。
+    """
+    rows, seen = [], set()
+    for i, result in enumerate(results, 1):
+        values = sheet_row(result["data"])
+        notes = []
+        if result["reused"]:
+            notes.append("前回の結果")
+        if any(status == "error" for status in result["field_status"].values()):
+            notes.append("読取エラーあり")
+        try:
+            duplicate_row = find_duplicate_row(values)
+        except Exception as e:
+            duplicate_row = None
+            notes.append(f"重複チェック不可 ({type(e).__name__})")
+        key = sheet_row_key(values)
+        if duplicate_row:
+            notes.append(f"重複: {duplicate_row}")
+        elif key is not None and key in seen:
+            notes.append("重複: この写真の別のカード")
+            duplicate_row = "この写真"
+        seen.add(key)
+        rows.append({MULTI_APPROVE_COLUMN: not duplicate_row, "カード": i, **dict(zip(SHEET_COLUMNS, values)),
+                     MULTI_NOTE_COLUMN: "、".join(notes)})
+    return rows
+
+def reread_field(entry, key, enhance, credentials):
+    """
+    1項目だけを指定段階で切り出し直して読み取り、(値, 生テキストの1行, 判定状態) を返す。
+    OCRキャッシュは使わずに Vision API へ送る ("メール配信" は◯判定をやり直す)。
+    """
+    image_content = crop_cell(entry["aligned"], key, enhance, entry["template"])
+    if key == CONSENT_FIELD:
+        consent, left_pixels, right_pixels = detect_mail_consent(image_content)
+        return consent, f"【{key} (再判定・{ENHANCE_TIERS[enhance]})】: {consent} (左画素:{left_pixels}, 右画素:{right_pixels})", "auto"
+    [(text, error)] = annotate_texts(get_vision_client(credentials), [image_content], use_cache=False)
+    if error:
+        raise RuntimeError(error)
+    text = clean_field_text(key, text)
+    return text, f"【{key} (再読取・{ENHANCE_TIERS[enhance]})】: {text}", "ocr"
 
 def show_custom_success_animation():
     image_path = "assets/nanji_v2.png"
@@ -284,29 +2070,203 @@ def show_custom_success_animation():
         st.markdown(f'<div class="floating-container">{"".join(particles)}</div>', unsafe_allow_html=True)
     else: st.balloons()
 
+# 入力モード: 1枚ずつアップロード / 連写・カメラ (フレームを採点して最良の1枚を自動でOCR)
+INPUT_MODES = {"single": "📄 1枚ずつ読み込む", "burst": "📸 連写・カメラ (自動選択)"}
+BURST_MAX_FRAMES = 12   # セッションに保持するフレームの採点結果の数 (超えたら最良のフレーム以外を古い順に破棄)
+
+def burst_capture():
+    """
+    連写した写真やカメラで撮ったフレームをローカルで採点し (score_frame)、基準を満たすうち最も鮮明なものを選ぶ。
+    (選んだフレームのバイト列 or None, 自動でOCRを実行するか) を返す。自動実行は選ばれたフレームごとに1回だけ。
+    スマホの写真は1枚数MBあるため、セッションには採点結果と、その時点で最良のフレームのバイト列だけを保持する。
+    採点済みのフレームは (保持数を超えて破棄したものも) ハッシュを覚えておき、再実行のたびに採点し直さない。
+    """
+    frames = st.session_state.setdefault('burst_frames', OrderedDict())
+    seen = st.session_state.setdefault('burst_seen', set())
+    best = st.session_state.setdefault('burst_best', {"key": None, "bytes": None})
+    uploader_key = st.session_state['uploader_key']
+    cols = st.columns(2)
+    uploads = cols[0].file_uploader("連写した写真をまとめて選択", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True,
+                                    key=f"burst_uploader_{uploader_key}")
+    shot = cols[1].camera_input("カメラで撮影 (何度でも撮り直せます)", key=f"camera_{uploader_key}")
+
+    for frame in list(uploads or []) + ([shot] if shot else []):
+        image_bytes = frame.getvalue()
+        key = hashlib.sha256(image_bytes).hexdigest()
+        if key in seen:
+            continue
+        seen.add(key)
+        frames[key] = {"name": frame.name, "score": score_frame(image_bytes)}
+        if best_frame({k: frames[k]["score"] for k in (best["key"], key) if k in frames}) == key:
+            best.update(key=key, bytes=image_bytes)
+        while len(frames) > BURST_MAX_FRAMES:
+            del frames[next(k for k in frames if k != best["key"])]
+    if not frames:
+        st.caption(f"ピンぼけ・白飛び・カードの写り具合をその場で判定し、基準を満たす中で最も鮮明な1枚だけをOCRします (最大 {BURST_MAX_FRAMES} 枚)。")
+        return None, False
+
+    best_key = best["key"]
+    with st.expander(f"フレームの判定 ({len(frames)} 枚)", expanded=not frames[best_key]["score"]["ok"]):
+        st.dataframe([{
+            "選択": "⭐" if key == best_key else "",
+            "フレーム": frame["name"],
+            "鮮明度": round(frame["score"]["sharpness"]),
+            "白飛び (%)": round(frame["score"]["glare"] * 100, 1),
+            "カード面積 (%)": round(frame["score"]["area_ratio"] * 100),
+            "セルの高さ (px)": round(frame["score"]["cell_height"]),
+            "判定": "✅ OK" if frame["score"]["ok"] else "、".join(frame["score"]["reasons"]),
+        } for key, frame in frames.items()], hide_index=True, use_container_width=True)
+
+    score = frames[best_key]["score"]
+    if not score["ok"]:
+        st.warning(f"⚠️ 基準を満たすフレームがありません ({'、'.join(score['reasons'])})。カードに光が反射しないよう、手ぶれに注意して撮り直してください。")
+        if not st.checkbox("基準未満でも最も鮮明なフレームを使う"):
+            return None, False
+        return best["bytes"], False
+    auto_ocr = st.session_state.get('burst_submitted') != best_key
+    st.session_state['burst_submitted'] = best_key
+    return best["bytes"], auto_ocr
+
+def show_multi_card_review():
+    """複数枚の読み取り結果を1カード1行の表で確認・修正し、チェックした行をまとめて転記キューへ登録する"""
+    state = st.session_state['multi_result']
+    st.subheader("2. データ確認・編集")
+    st.info(f"✏️ {len(state['rows'])} 枚のカードを読み取りました。セルをタップして修正し、転記する行にチェックを入れてください。", icon="👆")
+    edited = st.data_editor(
+        state["rows"], key=f"multi_editor_{st.session_state['uploader_key']}", hide_index=True, use_container_width=True,
+        disabled=["カード", MULTI_NOTE_COLUMN],
+        column_config={
+            MULTI_APPROVE_COLUMN: st.column_config.CheckboxColumn(MULTI_APPROVE_COLUMN, width="small"),
+            "カード": st.column_config.NumberColumn("カード", width="small"),
+            CONSENT_FIELD: st.column_config.SelectboxColumn(CONSENT_FIELD, options=["可", "不可", "未選択"]),
+        })
+    with st.expander("OCR生データを表示"):
+        st.text_area("解析前のテキスト", "\n\n".join(f"[カード{i}]\n{r['raw_text']}" for i, r in enumerate(state["results"], 1)), height=200)
+
+    approved = [row for row in edited if row[MULTI_APPROVE_COLUMN]]
+    allow_duplicate = False
+    if state.get("duplicate_warning"):
+        st.warning(state["duplicate_warning"])
+        allow_duplicate = st.checkbox("重複を承知で転記する")
+    if state["submitted"]:
+        st.success("✅ この写真のカードは転記キューに登録済みです。次の画像はサイドバーのリセットから読み込んでください。")
+        return
+    if not st.button(f"✅ チェックした {len(approved)} 件を承認してスプレッドシートへ転記", type="primary", disabled=not approved):
+        return
+
+    rows = [[row[key] or "" for key in SHEET_COLUMNS] for row in approved]
+    # 確認表で重複と表示済みの行を承知でチェックした場合を除き、修正後の値で重複を確認する
+    if not allow_duplicate:
+        duplicates = []
+        try:
+            with stage_span("duplicate_check", rows=len(rows)):
+                for row, values in zip(approved, rows):
+                    where = None if "重複:" in row[MULTI_NOTE_COLUMN] else find_duplicate_row(values)
+                    if where:
+                        duplicates.append(f"カード{row['カード']} ({where})")
+        except Exception as e:
+            st.warning(f"⚠️ 重複チェックをスキップしました: {type(e).__name__}: {e}")
+        if duplicates:
+            state["duplicate_warning"] = f"⚠️ 同じ氏名・電話番号・チェックイン日の行が既に登録されています: {'、'.join(duplicates)}"
+            st.rerun()
+    state.pop("duplicate_warning", None)
+
+    try:
+        ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        entries = []
+        for row, values in zip(approved, rows):
+            raw_lines = [l.strip() for l in state["results"][row["カード"] - 1]["raw_text"].splitlines() if l.strip()]
+            entries += [("main", values), ("log", [ts] + raw_lines)]
+        # 1トランザクションで転記キューへ記録し、スプレッドシートへの書き込みはバックグラウンドでまとめて行う
+        with stage_span("sheet_enqueue", rows=len(rows)):
+            ids = enqueue_sheet_rows(entries)
+        state["submitted"] = True
+        track_submitted_rows([row_id for row_id, (target, _) in zip(ids, entries) if target == "main"])
+    except Exception as e:
+        st.error(f"❌ 書き込み中に重大なエラーが発生しました: {type(e).__name__}: {str(e)}")
+
+# 転記キューへ登録した行の送信状況を確認する間隔 (秒)
+SUBMITTED_STATUS_POLL_SEC = 3
+
+def track_submitted_rows(ids):
+    """承認して転記キューへ登録したメインシートの行を、送信されるまで show_submitted_status で追跡する"""
+    st.session_state['submitted_rows'] = {"ids": ids, "celebrated": False}
+
+@st.fragment(run_every=SUBMITTED_STATUS_POLL_SEC)
+def show_submitted_status():
+    """
+    登録した行の状態 (送信待ち / 保留 / 送信済み) を表示する。登録しただけではシートに書き込まれていないため、
+    「転記完了」とアニメーションはフラッシャーが実際に書き込んでから表示する。
+    """
+    tracked = st.session_state.get('submitted_rows')
+    if not tracked:
+        return
+    status = outbox_row_status(tracked["ids"])
+    if status["held"]:
+        st.error(f"🚫 {status['held']} 件を転記できず保留にしました。サイドバーの「保留中の行を確認」から原因を直して再送してください。")
+    if status["pending"]:
+        depth = outbox_depth()["main"]
+        st.info(f"🕒 {status['pending']} 件を転記キューに登録しました。スプレッドシートへはバックグラウンドで送信します "
+                f"(キュー全体の未送信 {depth} 件)。")
+    elif not status["held"]:
+        st.success(f"✅ 転記完了！ {status['sent']} 件をスプレッドシートへ書き込みました（生データログも順次保存されます）")
+        if not tracked["celebrated"]:
+            tracked["celebrated"] = True
+            show_custom_success_animation()
+
+def show_dead_letters():
+    """転記できずに保留になった行をサイドバーに表示し、転記キューへ戻せるようにする"""
+    dead = dead_letter_rows()
+    if not dead:
+        return
+    st.sidebar.error(f"🚫 転記できなかった行: {len(dead)} 件 (保留中)")
+    with st.sidebar.expander("保留中の行を確認"):
+        st.dataframe([{"宛先": OUTBOX_TARGETS[row["target"]], "内容": " / ".join(str(v) for v in row["values"][:3]),
+                       "試行": row["attempts"], "エラー": row["error"]} for row in dead], hide_index=True)
+        st.caption("シートの保護範囲・権限などを直してから再送してください。")
+        if st.button("🔁 保留中の行をすべて再送する"):
+            moved = requeue_dead_letters([row["id"] for row in dead])
+            st.success(f"{moved} 件を転記キューに戻しました")
+
+def show_debug_panel():
+    """サイドバーに直近の処理の段階別時間と、プロセス全体の p50/p95 を表示する"""
+    spans = st.session_state.get('last_spans')
+    if spans:
+        st.sidebar.markdown("**直近のOCR処理**")
+        st.sidebar.dataframe([{"段階": stage, "ms": round(ms, 1)} for stage, ms in spans], hide_index=True)
+        st.sidebar.caption(f"合計 {sum(ms for _, ms in spans):.0f} ms")
+    summary = stage_summary()
+    if summary:
+        st.sidebar.markdown(f"**段階別 (直近{METRIC_RECENT_SAMPLES}件)**")
+        st.sidebar.dataframe(summary, hide_index=True)
+    status = startup_status()
+    st.sidebar.caption(f"起動: 画面表示 {status['shell_sec']} 秒 / 準備完了 {status['ready_sec']} 秒")
+    if status["steps"]:
+        st.sidebar.dataframe([{"準備": name, "ms / エラー": str(value)} for name, value in status["steps"].items()], hide_index=True)
+    with st.sidebar.expander("Prometheus 形式"):
+        st.code(render_prometheus_metrics(), language="text")
+
 def main():
+    st.set_page_config(
+        page_title="予約カードOCRシステム",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
     local_css()
     st.title("📋 予約カードOCR転記システム")
+    mark_shell_rendered()
+    # 画面の骨組みを先に表示し、ライブラリ・クライアントの準備はバックグラウンドで進める
+    # (serve.py で起動した場合は起動時に始まっている。streamlit run で直接起動した場合はここで始める)
+    start_background_services()
     if 'uploader_key' not in st.session_state: st.session_state['uploader_key'] = 0
 
     creds = None
-    if os.path.exists("service_account.json"):
-        creds = load_credentials("service_account.json")
-        st.sidebar.success("🔑 認証キー読込済み (Local)")
-    elif os.environ.get("GCP_SERVICE_ACCOUNT_JSON"):
-        try:
-            import json
-            creds_dict = json.loads(os.environ.get("GCP_SERVICE_ACCOUNT_JSON"))
-            creds = load_credentials(creds_dict)
-            st.sidebar.success("🔑 認証キー読込済み (Render Env)")
-        except Exception as e:
-            st.sidebar.error(f"Render Env Error: {e}")
-    elif 'gcp_service_account' in st.secrets:
-        try:
-            creds = load_credentials(dict(st.secrets['gcp_service_account']))
-            st.sidebar.success("🔑 認証キー読込済み (Secrets)")
-        except:
-            st.sidebar.error("Secrets Error")
+    try:
+        creds, source = get_credentials()
+        if creds:
+            st.sidebar.success(f"🔑 認証キー読込済み ({source})")
+    except Exception as e:
+        st.sidebar.error(f"認証キー読込エラー: {e}")
 
     if not creds:
         st.warning("⚠️ 認証キーが見つかりません。環境変数またはSecretsを設定してください。")
@@ -316,53 +2276,142 @@ def main():
         st.session_state['uploader_key'] += 1
         st.session_state.pop('ocr_result', None)
         st.session_state.pop('raw_text', None)
+        st.session_state.pop('field_status', None)
+        st.session_state.pop('dedup_hit', None)
+        st.session_state.pop('duplicate_warning', None)
+        st.session_state.pop('multi_result', None)
+        st.session_state.pop('burst_frames', None)
+        st.session_state.pop('burst_seen', None)
+        st.session_state.pop('burst_best', None)
+        st.session_state.pop('burst_submitted', None)
+        st.session_state.pop('submitted_rows', None)
         st.rerun()
 
-    uploaded_image = st.file_uploader("予約カードを撮影または選択", type=['png', 'jpg', 'jpeg'], key=f"uploader_{st.session_state['uploader_key']}", label_visibility="collapsed")
+    start_outbox_flusher(creds)
+    depth = outbox_depth()
+    outbox = get_outbox()
+    st.sidebar.caption(f"📤 転記キュー: 未送信 {depth['main']} 件 (ログ {depth['log']} 件)")
+    if outbox["last_error"]:
+        st.sidebar.warning(f"⚠️ 転記を再試行中: {outbox['last_error']}")
+    show_dead_letters()
+    if OUTBOX_EPHEMERAL and (sum(depth.values()) or sum(outbox_depth("outbox_dead").values())):
+        st.sidebar.warning("⚠️ 転記キューは永続ディスクに保存されていません。アプリのスリープ・再デプロイで未送信・保留中の行は失われます。"
+                           "送信が済むまでアプリを開いたままにし、保留中の行は内容を控えてください。")
+    if get_sheet_index()["last_error"]:
+        st.sidebar.warning(f"⚠️ 重複チェック用のシート行の索引を更新できません: {get_sheet_index()['last_error']}")
+    if outbox["fallback_title"]:
+        st.sidebar.warning(f"⚠️ 'シート1' が見つからないため一番左のシート '{outbox['fallback_title']}' に書き込んでいます。")
+
+    stats = ocr_cache_stats()
+    st.sidebar.caption(f"🗄️ OCRキャッシュ: ヒット {stats['hits']} / ミス {stats['misses']} "
+                       f"(保存 {stats['entries']} 件, {stats['bytes'] / 1024:.0f} KB)")
+    if not get_startup()["done"].is_set():
+        st.sidebar.caption("⏳ 起動準備中 (画像処理・API クライアントを読み込んでいます。そのまま操作できます)")
+
+    input_mode = st.sidebar.radio("入力モード", options=list(INPUT_MODES), format_func=INPUT_MODES.get)
+    image_bytes, auto_ocr = None, False
+    if input_mode == "burst":
+        image_bytes, auto_ocr = burst_capture()
+    else:
+        st.caption("📷 複数枚のカードを並べて1枚の写真で読み込むこともできます (カード同士は重ならないように離して並べてください)。")
+        uploaded_image = st.file_uploader("予約カードを撮影または選択", type=['png', 'jpg', 'jpeg'], key=f"uploader_{st.session_state['uploader_key']}", label_visibility="collapsed")
+        if uploaded_image:
+            # アップロードされたバイト列をそのまま使う (PILでの再エンコードは画質劣化とメモリ増の原因)
+            image_bytes = uploaded_image.getvalue()
     
-    if uploaded_image:
-        final_image = Image.open(uploaded_image)
+    if image_bytes:
         col1, col2 = st.columns([1, 1.2]) 
         
         with col1:
             st.subheader("1. 予約カード読込")
-            use_enhance = st.checkbox("手書き文字補正を行う (推奨)", value=True, help="文字を濃くし、影を除去して読み取りやすくします。")
-            st.image(final_image, caption='読込画像', use_container_width=True)
+            enhance = st.selectbox("手書き文字補正", options=list(ENHANCE_TIERS), index=2, format_func=ENHANCE_TIERS.get,
+                                   help="文字を濃くし、影を除去して読み取りやすくします。高速補正はノイズ除去を簡略化して処理時間を短縮します。")
+            st.image(image_bytes, caption='読込画像', use_container_width=True)
             
-            if st.button("🔍 OCR解析実行", type="primary"):
-                with st.spinner('テキスト解析実行中...'):
-                    img_byte_arr = io.BytesIO()
-                    final_image.save(img_byte_arr, format=final_image.format or 'JPEG')
-                    target_bytes = img_byte_arr.getvalue()
-                    
-                    # 1. 傾き補正およびセル切り出し
-                    aligned_img, crops_dict = get_aligned_card_and_crops(target_bytes, use_enhance=use_enhance)
+            run_ocr = st.button("🔍 OCR解析実行", type="primary")
+            force_ocr = st.session_state.pop('force_ocr', False)
+            if run_ocr or force_ocr or auto_ocr:
+                with st.spinner('テキスト解析実行中...'), collect_spans() as spans:
+                    # 1. 傾き補正およびセル切り出し (同じ画像・同じ補正段階ならセッション内の結果を再利用)
+                    #    カードを複数枚並べた写真ならカードごとに補正する
+                    cards = session_cards(image_bytes, enhance)
                     
                     # 補正後の画像をUIに表示（確認用）
                     with st.expander("補正後の画像を確認", expanded=True):
-                        st.image(aligned_img, caption="補正および規格化されたカード画像", channels='BGR', use_container_width=True)
+                        for i, card in enumerate(cards, 1):
+                            template, card_info = card["template"], card["info"]
+                            label = f"カード{i}: " if len(cards) > 1 else ""
+                            st.image(card["aligned"], caption=f"{label}補正および規格化されたカード画像 (レイアウト: {template['description'] or template['name']})", channels='BGR', use_container_width=True)
+                            if not card_info["card_found"]:
+                                st.warning("カードの外郭を検出できなかったため、写真全体を縮小して使っています。カード全体が写るように撮り直すと精度が上がります。")
+                            elif card_info["locate_tier"] != LOCATE_TIERS[0]:
+                                st.caption(f"外郭の一部が見えないため、{LOCATE_TIER_LABELS[card_info['locate_tier']]}でカード位置を推定しました。")
                     
-                    # 2. バッチOCRを実行
-                    parsed_data, raw_text_summary = perform_ocr_batch(crops_dict, creds)
+                    # 2. 以前に読み取ったカードの再アップロードなら前回の結果を使い (Vision API を呼ばない)、
+                    # 3. 残りのカードは全カードのセルをまとめてバッチOCRを実行
+                    try:
+                        results = read_cards(cards, enhance, creds, force=force_ocr)
+                    except Exception as e:
+                        st.error(f"API Batch Error: {e}")
+                        results = None
+                    st.session_state['last_spans'] = spans
                     
-                    if parsed_data:
-                        st.session_state['ocr_result'] = parsed_data
-                        st.session_state['raw_text'] = raw_text_summary
+                    if results and len(results) > 1:
+                        for key in ('ocr_result', 'raw_text', 'field_status', 'duplicate_warning'):
+                            st.session_state.pop(key, None)
+                        st.session_state['dedup_hit'] = any(r["reused"] for r in results)
+                        st.session_state['multi_result'] = {"results": results, "rows": multi_card_rows(results), "submitted": False}
+                        st.success(f"解析完了 ({len(results)} 枚)")
+                    elif results and results[0]["data"]:
+                        st.session_state.pop('multi_result', None)
+                        st.session_state['dedup_hit'] = results[0]["reused"]
+                        st.session_state['ocr_result'] = results[0]["data"]
+                        st.session_state['raw_text'] = results[0]["raw_text"]
+                        st.session_state['field_status'] = results[0]["field_status"]
                         st.success("解析完了")
                     else:
                         st.error("読み取り失敗")
 
+            if st.session_state.get('dedup_hit'):
+                st.info("🔁 以前に読み取ったカードと同一と判定したため、前回のOCR結果を表示しています。")
+                st.button("♻️ 前回の結果を使わずにOCRし直す", on_click=lambda: st.session_state.update(force_ocr=True))
+
         with col2:
-            if 'ocr_result' in st.session_state:
+            if 'multi_result' in st.session_state:
+                show_multi_card_review()
+            elif 'ocr_result' in st.session_state:
                 st.subheader("2. データ確認・編集")
                 st.info("✏️ 各項目をタップして修正できます。間違いがないかご確認ください。", icon="👆")
                 
                 data = st.session_state['ocr_result']
+                blank_fields = [k for k, v in st.session_state.get('field_status', {}).items() if v == "blank"]
+                if blank_fields:
+                    st.caption(f"⬜ 空欄と判定した項目 (OCR省略): {'、'.join(blank_fields)}。記入がある場合は手入力してください。")
+
+                # 読み取りが怪しい項目だけを、補正段階を変えて切り出し・OCRし直す (カード全体はやり直さない)
+                with st.expander("🔁 項目を再読み取り"):
+                    card = session_card(image_bytes, enhance)
+                    rcols = st.columns([2, 2, 1])
+                    reread_key = rcols[0].selectbox("項目", options=list(card["template"]["cells"]))
+                    reread_tier = rcols[1].selectbox("補正", options=list(ENHANCE_TIERS), index=list(ENHANCE_TIERS).index(enhance),
+                                                     format_func=ENHANCE_TIERS.get)
+                    if rcols[2].button("再読み取り"):
+                        try:
+                            with collect_spans() as spans:
+                                value, raw_line, status = reread_field(card, reread_key, reread_tier, creds)
+                            st.session_state['last_spans'] = spans
+                            st.session_state['ocr_result'][reread_key] = value
+                            st.session_state.setdefault('field_status', {})[reread_key] = status
+                            st.session_state['raw_text'] = "\n".join(filter(None, [st.session_state.get('raw_text', ''), raw_line]))
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"再読み取りに失敗しました: {type(e).__name__}: {e}")
                 with st.form("verify_form"):
                     cols = st.columns(2)
                     name = cols[0].text_input("氏名 (A列)", value=data.get("氏名"))
                     furigana = cols[0].text_input("フリガナ (B列)", value=data.get("フリガナ"))
-                    birthday = cols[0].text_input("生年月日 (C列)", value=data.get("生年月日"))
+                    birthday_label = "年齢 (C列・旧カード)" if data.get("年齢") and not data.get("生年月日") else "生年月日 (C列)"
+                    birthday = cols[0].text_input(birthday_label, value=sheet_row(data)[SHEET_COLUMNS.index("生年月日")])
                     job = cols[0].text_input("ご職業 (D列)", value=data.get("職業"))
                     phone = cols[0].text_input("電話番号 (F列)", value=data.get("電話番号"))
                     checkin = cols[1].text_input("チェックイン日 (H列)", value=data.get("チェックイン日"))
@@ -382,59 +2431,51 @@ def main():
                         st.text_area("解析前のテキスト", st.session_state.get('raw_text', ''), height=150)
 
                     st.markdown("---")
+                    allow_duplicate = False
+                    if st.session_state.get('duplicate_warning'):
+                        st.warning(st.session_state['duplicate_warning'])
+                        allow_duplicate = st.checkbox("重複を承知で転記する")
                     if st.form_submit_button("✅ 承認してスプレッドシートへ転記"):
-                        st.info("🔄 書き込み処理を開始します...")
+                        # J列まで含めた10項目のデータ配列 (A〜J列)
+                        write_data = [name, furigana, birthday, job, address, phone, email, checkin, checkout, mail_consent]  # SHEET_COLUMNS の順
+
+                        # 同じ氏名・電話番号・チェックイン日の行が既にあれば、確認するまで転記しない
+                        duplicate_row = None
+                        try:
+                            with stage_span("duplicate_check"):
+                                duplicate_row = find_duplicate_row(write_data)
+                        except Exception as e:
+                            st.warning(f"⚠️ 重複チェックをスキップしました: {type(e).__name__}: {e}")
+                        if duplicate_row and not allow_duplicate:
+                            st.session_state['duplicate_warning'] = f"⚠️ 同じ氏名・電話番号・チェックイン日の行が既に登録されています ({duplicate_row})。"
+                            st.rerun()
+                        st.session_state.pop('duplicate_warning', None)
+
+                        st.info("🔄 転記キューへ登録します...")
                         try:
-                            gc = gspread.authorize(creds)
-                            sh = gc.open_by_url(SPREADSHEET_URL)
-                            
-                            target_sheet_name = 'シート1' 
-                            try:
-                                ws = sh.worksheet(target_sheet_name)
-                            except gspread.WorksheetNotFound:
-                                ws = sh.get_worksheet(0)
-                                st.warning(f"⚠️ '{target_sheet_name}' が見つかりませんでした。代わりに一番左のシート '{ws.title}' に書き込みます。")
-                            
-                            st.write(f"書き込み先シート名: {ws.title}")
-                            
-                            # J列まで含めた10項目のデータ配列 (A〜J列)
-                            write_data = [name, furigana, birthday, job, address, phone, email, checkin, checkout, mail_consent]
                             st.write(f"書き込みデータを確認: {write_data}")
-                            
-                            # 空き行を探す
-                            col_a = ws.col_values(1)
-                            target_row_index = len(col_a) + 1
-                            
-                            for i in range(1, len(col_a)):
-                                if not col_a[i].strip():
-                                    target_row_index = i + 1
-                                    break
-                            
-                            next_row = target_row_index
-                            
-                            # A列のnext_row行目から書き込み (A〜J列へ一括update)
-                            ws.update(range_name=f'A{next_row}', values=[write_data])
-                            
-                            st.success(f"✅ シート '{ws.title}' の {next_row} 行目に追記しました")
-                            
-                            try:
-                                log_ws = sh.worksheet('OCR_LOG')
-                            except:
-                                log_ws = sh.add_worksheet(title='OCR_LOG', rows=1000, cols=50)
-                                log_ws.append_row(['タイムスタンプ'] + [f'Line {i+1}' for i in range(49)])
-                            
+
                             ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                             raw_lines = [l.strip() for l in st.session_state.get('raw_text','').splitlines() if l.strip()]
-                            log_ws.append_row([ts] + raw_lines)
-                            
-                            show_custom_success_animation()
-                            st.success("✅ 転記完了！（生データログも保存しました）")
+
+                            # ローカルの転記キューへ記録し、スプレッドシートへの書き込みはバックグラウンドでまとめて行う
+                            with stage_span("sheet_enqueue"):
+                                main_id, _ = enqueue_sheet_rows([("main", write_data), ("log", [ts] + raw_lines)])
+                            track_submitted_rows([main_id])
                         except Exception as e: 
                             st.error(f"❌ 書き込み中に重大なエラーが発生しました: {type(e).__name__}: {str(e)}")
                             import traceback
                             st.code(traceback.format_exc())
 
+    show_submitted_status()
+
+    if st.sidebar.checkbox("🐞 処理時間を表示 (デバッグ)"):
+        show_debug_panel()
+
     st.markdown('<div class="footer">Developed by Center of Okinawa Local Tourism</div>', unsafe_allow_html=True)
 
 if __name__ == "__main__":
-    main()
+    # Streamlit はこのファイルを __main__ として実行するが、st.cache_resource は関数のモジュール名ごとに別のキャッシュになる。
+    # serve.py が起動時に import した app と事前準備・認証キー・サーバーを共有するため、import した app の main を呼ぶ
+    import app
+    app.main()
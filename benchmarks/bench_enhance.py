@@ -0,0 +1,89 @@
+"""
+手書き文字補正の段階 (off / fast / accurate) ごとの処理時間とOCR一致率を比較するベンチマーク。
+
+    python benchmarks/bench_enhance.py scans/*.jpg
+    python benchmarks/bench_enhance.py scans/*.jpg --ocr --labels labels.json
+
+--ocr を付けると各段階のセル画像を Vision API でOCRし、一致率を求める。
+labels.json ({ファイル名: {項目名: 正解テキスト}}) があれば正解と、なければ accurate の結果と比較する。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+
+
+def normalize(text):
+    return "".join(text.split())
+
+
+def time_tier(image_bytes, tier, repeat):
+    """補正・切り出しを repeat 回実行し、(最短ではなく) 中央値の秒数とセル画像を返す"""
+    samples = []
+    crops = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        _, crops = app.get_aligned_card_and_crops(image_bytes, enhance=tier)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples), crops
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="手書き文字補正の段階別ベンチマーク")
+    parser.add_argument("images", nargs="+", help="カード画像")
+    parser.add_argument("--repeat", type=int, default=5, help="1画像あたりの計測回数")
+    parser.add_argument("--ocr", action="store_true", help="Vision API でOCRして一致率を求める")
+    parser.add_argument("--labels", help="正解データ JSON ({ファイル名: {項目名: テキスト}})")
+    args = parser.parse_args(argv)
+
+    labels = {}
+    if args.labels:
+        with open(args.labels, encoding="utf-8") as f:
+            labels = json.load(f)
+
+    client = None
+    if args.ocr:
+        creds, _ = app.find_credentials()
+        if not creds:
+            print("認証キーが見つかりません。", file=sys.stderr)
+            return 1
+        client = app.get_vision_client(creds)
+
+    latencies = {tier: [] for tier in app.ENHANCE_TIERS}
+    texts = {tier: {} for tier in app.ENHANCE_TIERS}
+    for path in args.images:
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        for tier in app.ENHANCE_TIERS:
+            elapsed, crops = time_tier(image_bytes, tier, args.repeat)
+            latencies[tier].append(elapsed)
+            if client:
+                keys = [k for k in crops if k != app.CONSENT_FIELD]
+                results = app.annotate_texts(client, [crops[k] for k in keys], use_cache=False)
+                texts[tier][path] = {k: app.clean_field_text(k, t) for k, (t, _) in zip(keys, results)}
+
+    print(f"{'tier':<10}{'p50 (ms)':>10}{'max (ms)':>10}{'一致率':>10}")
+    for tier in app.ENHANCE_TIERS:
+        p50 = statistics.median(latencies[tier]) * 1000
+        worst = max(latencies[tier]) * 1000
+        match = "-"
+        if client:
+            hit = total = 0
+            for path, fields in texts[tier].items():
+                expected = labels.get(os.path.basename(path)) or texts["accurate"][path]
+                for key, value in fields.items():
+                    if key in expected:
+                        total += 1
+                        hit += normalize(value) == normalize(expected[key])
+            match = f"{hit / total:.1%}" if total else "-"
+        print(f"{tier:<10}{p50:>10.1f}{worst:>10.1f}{match:>10}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
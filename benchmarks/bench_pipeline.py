@@ -0,0 +1,91 @@
+"""
+一括取り込みパイプライン (bulk_ingest.ingest_images) のスループット計測。
+
+合成カードを一時フォルダに書き出し、Vision API の代わりに rpc_ms だけ待つ非同期スタブで
+取り込みを実行する。補正とRPCが重なっていれば、スループットは「補正のみ」と「RPCのみ」の
+遅い方に近づく (両者の和にはならない)。
+
+    python benchmarks/bench_pipeline.py --cards 40 --rpc-ms 300 --workers 2 --concurrency 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+import bulk_ingest  # noqa: E402
+import synthetic_cards  # noqa: E402
+from run_benchmark import StubVisionClient  # noqa: E402
+
+
+class AsyncStubVisionClient(StubVisionClient):
+    """StubVisionClient の非同期版 (待ち時間中はイベントループを止めない)"""
+
+    async def batch_annotate_images(self, requests):
+        self.calls += 1
+        self.images += len(requests)
+        if self.rpc_ms:
+            await asyncio.sleep(self.rpc_ms / 1000)
+        return self.response(requests)
+
+
+class NullSink:
+    def write(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+def measure_align_only(paths, workers, enhance):
+    """RPCなしで補正・切り出しだけを同じプロセス数で実行した時間"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    started = time.perf_counter()
+    # bulk_ingest と同じく spawn で起動する (ワーカーの起動時間も含めて比べる)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        list(pool.map(bulk_ingest._align_worker, paths, [enhance] * len(paths)))
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="一括取り込みパイプラインのスループット計測")
+    parser.add_argument("--cards", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rpc-ms", type=float, default=300.0, help="スタブの疑似RPC待ち時間 (ms)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--concurrency", type=int, default=app.VISION_MAX_CONCURRENCY)
+    parser.add_argument("--enhance", choices=list(app.ENHANCE_TIERS), default="accurate")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # スタブの結果で本番のOCRキャッシュ・重複索引を汚さず、毎回すべてのセルをRPCに回す
+        app.OCR_CACHE_PATH = os.path.join(tmp, "ocr_cache.sqlite3")
+        app.DEDUP_INDEX_PATH = os.path.join(tmp, "dedup_index.sqlite3")
+        paths = []
+        for i, (image_bytes, _) in enumerate(synthetic_cards.generate(args.cards, args.seed)):
+            path = os.path.join(tmp, f"card_{i:04d}.jpg")
+            with open(path, "wb") as f:
+                f.write(image_bytes)
+            paths.append(path)
+
+        align_sec = measure_align_only(paths, args.workers, args.enhance)
+        client = AsyncStubVisionClient(args.rpc_ms)
+        stats = bulk_ingest.ingest_images(paths, None, NullSink(), workers=args.workers, enhance=args.enhance,
+                                          log=lambda _: None, concurrency=args.concurrency, client=client)
+
+    # RPCのみの所要時間: concurrency 件ずつ並行に送った場合の下限
+    rpc_sec = -(-client.calls // args.concurrency) * args.rpc_ms / 1000
+    print(f"cards: {args.cards}  workers: {args.workers}  concurrency: {args.concurrency}  rpc: {args.rpc_ms:.0f} ms")
+    print(f"align only : {align_sec:.2f} s")
+    print(f"rpc only   : {rpc_sec:.2f} s ({client.calls} calls, {client.images} images)")
+    print(f"pipeline   : {stats['elapsed_sec']:.2f} s  ({stats['cards_per_sec']:.2f} cards/s, "
+          f"sum of stages {align_sec + rpc_sec:.2f} s, slower stage {max(align_sec, rpc_sec):.2f} s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""
+合成カードによる補正・切り出し〜OCRまでのエンドツーエンド・ベンチマーク。
+
+画面と同じ align_cards → 補正 → JPEG化 の各段階 (デコード / 外郭検出 / 射影変換 / 補正 / JPEG化) と
+メール配信の◯判定、OCR (Vision API の代わりにローカルのスタブ) の処理時間を計測し、
+スループット・p50/p95・ピークメモリ・カード検出成功率・◯判定正解率を表示する。
+カードを 2x2 に並べた写真 (--multi 枚) で、全カードを読み取り順どおりに切り出せた割合も計測する。
+保存済みのベースライン (benchmarks/baseline.json) より悪化していれば終了コード 1 を返す
+(計測条件 params がベースラインと異なる場合は比較しない)。
+
+    python benchmarks/run_benchmark.py                      # ベースラインと比較
+    python benchmarks/run_benchmark.py --update-baseline    # ベースラインを更新
+    python benchmarks/run_benchmark.py --hard               # 外郭検出が難しい写真で検出段階ごとの成功率を見る (比較なし)
+    python benchmarks/run_benchmark.py --hard --baseline hard.json --update-baseline   # --hard 用のベースラインを作る
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+import synthetic_cards  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+STAGES = ["decode", "locate", "warp", "detect_template", "enhance", "encode", "consent", "blank_check", "ocr"]
+# カード四隅の誤差がカード幅のこの割合以内なら検出成功とみなす
+ALIGN_TOLERANCE = 0.02
+
+
+class StubVisionClient:
+    """batch_annotate_images だけを持つ Vision クライアントのスタブ (rpc_ms だけ待って固定テキストを返す)"""
+
+    def __init__(self, rpc_ms=0.0):
+        self.rpc_ms = rpc_ms
+        self.calls = 0
+        self.images = 0
+
+    def batch_annotate_images(self, requests):
+        self.calls += 1
+        self.images += len(requests)
+        if self.rpc_ms:
+            time.sleep(self.rpc_ms / 1000)
+        return self.response(requests)
+
+    @staticmethod
+    def response(requests):
+        ok = SimpleNamespace(message="")
+        return SimpleNamespace(responses=[
+            SimpleNamespace(error=ok, text_annotations=[SimpleNamespace(description="stub")]) for _ in requests
+        ])
+
+
+def run_card(image_bytes, enhance, client, timings):
+    """
+    1枚の写真を画面と同じ align_cards 経由で処理して段階ごとに計測し、写真内のカードごとの
+    (検出した四隅 or None, 検出段階, テンプレート名, ◯判定結果, 空欄判定した項目) のリストを読み取り順で返す。
+    各段階の時間は写真単位の合計を記録する (デコード〜レイアウト判定は align_cards 内の stage_span の記録を集計し、
+    外郭検出には find_card_quads も含む)。
+    """
+    photo = dict.fromkeys(STAGES, 0.0)
+
+    def timed(stage, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        photo[stage] += (time.perf_counter() - started) * 1000
+        return result
+
+    with app.collect_spans() as spans:
+        cards = app.align_cards(image_bytes)
+    for name, ms in spans:
+        if name in ("decode", "locate", "warp", "detect_template"):
+            photo[name] += ms
+
+    results, crops_list = [], []
+    for aligned, template, info in cards:
+        processed = timed("enhance", app.enhance_card, aligned, enhance, template)
+        crops = timed("encode", app.encode_crops, processed, template)
+        consent = "未選択"
+        if app.CONSENT_FIELD in crops:
+            consent, _, _ = timed("consent", app.detect_mail_consent, crops[app.CONSENT_FIELD])
+        blank_keys = timed("blank_check", app.find_blank_cells, crops) if info["card_found"] else []
+        results.append((info["quad"], info["locate_tier"], template["name"], consent, blank_keys))
+        crops_list.append(crops)
+
+    def ocr():
+        # ocr_cards と同じく写真内の全カードのセルを1つの列にまとめて送る
+        keys = [[k for k in crops if k != app.CONSENT_FIELD and k not in result[4]]
+                for crops, result in zip(crops_list, results)]
+        texts = app.annotate_texts(client, [crops[k] for crops, card_keys in zip(crops_list, keys) for k in card_keys],
+                                   use_cache=False)
+        start = 0
+        for crops, card_keys, result in zip(crops_list, keys, results):
+            app.assemble_ocr_result(crops, dict(zip(card_keys, texts[start:start + len(card_keys)])), result[4])
+            start += len(card_keys)
+    timed("ocr", ocr)
+    for stage, ms in photo.items():
+        timings[stage].append(ms)
+    return results
+
+
+def is_aligned(quad, corners):
+    if quad is None:
+        return False
+    error = np.abs(app.order_quad(quad) - np.array(corners, dtype="float32")).max()
+    width = np.linalg.norm(np.array(corners[1]) - np.array(corners[0]))
+    return error <= width * ALIGN_TOLERANCE
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run(cards=40, seed=0, enhance="accurate", rpc_ms=0.0, memory_cards=5, hard=False, multi=4):
+    samples = synthetic_cards.generate(cards, seed, hard=hard)
+    client = StubVisionClient(rpc_ms)
+    timings = {stage: [] for stage in STAGES}
+    aligned_ok = template_ok = consent_ok = 0
+    blank_hits = blank_false = blank_total = cells_total = 0
+    locate = {}  # 撮影条件 → {"cards", "aligned", 検出段階ごとの件数}
+
+    started = time.perf_counter()
+    for image_bytes, truth in samples:
+        results = run_card(image_bytes, enhance, client, timings)
+        quad, tier, template, consent, blank_keys = results[0]
+        # 1枚だけの写真で複数枚と判定した場合も検出失敗とみなす
+        aligned = int(len(results) == 1 and is_aligned(quad, truth["corners"]))
+        aligned_ok += aligned
+        counts = locate.setdefault(str(truth["hazard"] or "plain"), {"cards": 0, "aligned": 0})
+        counts["cards"] += 1
+        counts["aligned"] += aligned
+        counts[tier] = counts.get(tier, 0) + 1
+        template_ok += template == truth["template"]
+        consent_ok += consent == truth["consent"]
+        empty = {k for k, text in truth["fields"].items() if not text}
+        blank_total += len(empty)
+        blank_hits += len(empty & set(blank_keys))
+        blank_false += len(set(blank_keys) - empty)  # 記入があるのに空欄と判定 (読み落とし)
+        cells_total += len(truth["fields"])
+    elapsed = time.perf_counter() - started
+
+    # 複数枚を並べた写真: 全カードを読み取り順どおりに正しく切り出せた写真の割合 (処理時間は1枚の写真の集計に含めない)
+    multi_ok = multi_cards = 0
+    multi_timings = {stage: [] for stage in STAGES}
+    for image_bytes, truths in synthetic_cards.generate_multi(multi, seed):
+        results = run_card(image_bytes, enhance, client, multi_timings)
+        multi_cards += len(results)
+        multi_ok += len(results) == len(truths) and all(
+            is_aligned(quad, truth["corners"]) and template == truth["template"]
+            for (quad, _, template, _, _), truth in zip(results, truths))
+
+    # ピークメモリは計測の影響を避けるため別パスで数枚だけ測る
+    peak = 0
+    for image_bytes, _ in samples[:memory_cards]:
+        tracemalloc.start()
+        app.get_aligned_cards_and_crops(image_bytes, enhance=enhance)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    totals = [sum(values) for values in zip(*timings.values())]
+    return {
+        "params": {"cards": cards, "seed": seed, "enhance": enhance, "rpc_ms": rpc_ms, "hard": hard, "multi": multi},
+        "throughput_cards_per_sec": cards / elapsed,
+        "stages_ms": {
+            stage: {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+            for stage, values in dict(timings, total=totals).items()
+        },
+        "peak_memory_mb": peak / 2 ** 20,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "align_success_rate": aligned_ok / cards,
+        "locate": locate,
+        "template_accuracy": template_ok / cards,
+        "consent_accuracy": consent_ok / cards,
+        "multi_card_success_rate": multi_ok / multi if multi else 1.0,
+        "multi_card": {"photos": multi, "cards": multi_cards,
+                       "total_ms": {"p50": percentile([sum(v) for v in zip(*multi_timings.values())], 50),
+                                    "p95": percentile([sum(v) for v in zip(*multi_timings.values())], 95)}},
+        "blank_recall": blank_hits / blank_total if blank_total else 1.0,
+        "blank_false_rate": blank_false / cells_total,
+        "vision_calls": client.calls,
+        "vision_images": client.images,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """ベースラインより悪化した指標の説明リストを返す (空なら合格)"""
+    regressions = []
+    for stage, base in baseline["stages_ms"].items():
+        current = result["stages_ms"].get(stage)
+        # 1ms 未満の揺れは無視する
+        if current and current["p95"] > base["p95"] * (1 + tolerance) + 1.0:
+            regressions.append(f"{stage} p95: {base['p95']:.1f} → {current['p95']:.1f} ms")
+    if result["throughput_cards_per_sec"] < baseline["throughput_cards_per_sec"] * (1 - tolerance):
+        regressions.append(f"throughput: {baseline['throughput_cards_per_sec']:.2f} → {result['throughput_cards_per_sec']:.2f} cards/s")
+    if result["peak_memory_mb"] > baseline["peak_memory_mb"] * (1 + tolerance):
+        regressions.append(f"peak memory: {baseline['peak_memory_mb']:.1f} → {result['peak_memory_mb']:.1f} MB")
+    for key in ("align_success_rate", "template_accuracy", "consent_accuracy", "multi_card_success_rate"):
+        if key in baseline and result[key] < baseline[key] - 0.02:
+            regressions.append(f"{key}: {baseline[key]:.1%} → {result[key]:.1%}")
+    # 記入済みセルを空欄と誤判定すると情報が欠落するため、わずかな悪化も許容しない
+    if "blank_false_rate" in baseline and result["blank_false_rate"] > baseline["blank_false_rate"] + 0.005:
+        regressions.append(f"blank_false_rate: {baseline['blank_false_rate']:.1%} → {result['blank_false_rate']:.1%}")
+    return regressions
+
+
+def print_report(result):
+    print(f"cards: {result['params']['cards']}  enhance: {result['params']['enhance']}  "
+          f"throughput: {result['throughput_cards_per_sec']:.2f} cards/s")
+    print(f"{'stage':<10}{'p50 (ms)':>10}{'p95 (ms)':>10}")
+    for stage, values in result["stages_ms"].items():
+        print(f"{stage:<10}{values['p50']:>10.1f}{values['p95']:>10.1f}")
+    print(f"peak memory: {result['peak_memory_mb']:.1f} MB (max RSS {result['max_rss_mb']:.0f} MB)")
+    print(f"align success: {result['align_success_rate']:.1%}  template accuracy: {result['template_accuracy']:.1%}  "
+          f"consent accuracy: {result['consent_accuracy']:.1%}  vision calls: {result['vision_calls']} ({result['vision_images']} images)")
+    print(f"blank cells: recall {result['blank_recall']:.1%}  false blank {result['blank_false_rate']:.2%}")
+    if result["multi_card"]["photos"]:
+        print(f"multi-card photos (2x2): all cards aligned {result['multi_card_success_rate']:.1%}  "
+              f"cards found {result['multi_card']['cards']}/{result['multi_card']['photos'] * 4}  "
+              f"p50 {result['multi_card']['total_ms']['p50']:.0f} ms / photo")
+    for hazard, counts in result.get("locate", {}).items():
+        tiers = "  ".join(f"{tier} {counts[tier]}" for tier in (*app.LOCATE_TIERS, "resize") if counts.get(tier))
+        print(f"locate [{hazard}]: aligned {counts['aligned']}/{counts['cards']}  ({tiers})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成カードによるエンドツーエンド・ベンチマーク")
+    parser.add_argument("--cards", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--enhance", choices=list(app.ENHANCE_TIERS), default="accurate")
+    parser.add_argument("--rpc-ms", type=float, default=0.0, help="スタブの疑似RPC待ち時間 (ms)")
+    parser.add_argument("--hard", action="store_true", help="外郭検出が難しい撮影条件の写真で計測する")
+    parser.add_argument("--multi", type=int, default=4, help="カードを 2x2 に並べた写真の枚数")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.3, help="処理時間・メモリの許容悪化率")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果をベースラインとして保存する")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # スタブの結果で本番のOCRキャッシュ・重複索引を汚さない
+        app.OCR_CACHE_PATH = os.path.join(tmp, "ocr_cache.sqlite3")
+        app.DEDUP_INDEX_PATH = os.path.join(tmp, "dedup_index.sqlite3")
+        # 合成カードと同じ印字の無記入カードを参照画像にして、特徴点照合の段階も計測する
+        template_dir = os.path.join(tmp, "card_templates")
+        os.mkdir(template_dir)
+        synthetic_cards.write_reference_templates(template_dir)
+        app.CARD_TEMPLATE_DIR = template_dir
+        app.load_card_templates.clear()
+        app.get_reference_features.clear()
+        result = run(args.cards, args.seed, args.enhance, args.rpc_ms, hard=args.hard, multi=args.multi)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=1))
+    else:
+        print_report(result)
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=1)
+        print(f"ベースラインを更新しました: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("ベースラインがありません (--update-baseline で作成してください)")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["params"] != result["params"]:
+        # 条件の違う結果同士 (--hard など) は比べられないため、比較せずに終える
+        print(f"ベースラインと計測条件が異なるため比較しません ({baseline['params']})。"
+              f"この条件のベースラインは --baseline <ファイル> --update-baseline で作成してください")
+        return 0
+    regressions = compare(result, baseline, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""
+ベンチマーク用の合成予約カード画像ジェネレーター。
+
+card_templates/ の各レイアウト (1000x360) の罫線付きカードに手書き風の文字と
+メール配信欄の◯印を描き、ランダムな射影・ぼけ・影を加えた「撮影写真」を生成する。
+正解 (カード四隅の座標、レイアウト名、各項目のテキスト、メール配信の可否) も合わせて返す。
+--hard を付けると、輪郭検出だけでは外郭を取れない写真 (明るい机・指で端が隠れる・背景に直線が多い) を混ぜる。
+generate_multi は1枚の写真に複数枚のカードを格子状に並べた写真を作る。
+
+    python benchmarks/synthetic_cards.py out_dir --count 20
+"""
+import argparse
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app  # noqa: E402
+
+SURNAMES = ["Yamada", "Suzuki", "Higa", "Nakamura", "Kinjo", "Tanaka", "Oshiro", "Sato"]
+GIVEN_NAMES = ["Taro", "Hanako", "Ken", "Yui", "Sora", "Mei", "Riku", "Aoi"]
+JOBS = ["Engineer", "Teacher", "Nurse", "Student", "Farmer", "Designer", "Chef"]
+# 実際のカードでも空欄のまま提出されることが多い項目と、その空欄率
+OPTIONAL_FIELDS = {"職業": 0.3, "メールアドレス": 0.3, "生年月日": 0.2, "年齢": 0.2}
+CITIES = ["Naha", "Nago", "Urasoe", "Ginowan", "Itoman", "Okinawa"]
+# セルの上に印字された項目名 (実物のカードでは日本語。英字フォントしか使えないため英訳で代用)
+PRINTED_LABELS = {"氏名": "NAME", "フリガナ": "FURIGANA", "生年月日": "DATE OF BIRTH", "年齢": "AGE", "職業": "OCCUPATION",
+                  "住所": "ADDRESS", "電話番号": "PHONE", "メールアドレス": "E-MAIL", "チェックイン日": "CHECK-IN",
+                  "チェックアウト日": "CHECK-OUT", "メール配信": "NEWSLETTER"}
+# 外郭検出が難しい撮影条件: 白っぽい机 / 指でカードの辺の一部が隠れる / 背景に色々な直線
+HAZARDS = ["light", "finger", "clutter"]
+
+
+def random_fields(rng, template):
+    """テンプレートのセルに合わせて、カード1枚分の記入内容 (項目名 → テキスト) をランダムに作る"""
+    surname, given = rng.choice(SURNAMES), rng.choice(GIVEN_NAMES)
+    month, day = rng.integers(1, 13), rng.integers(1, 29)
+    stay = rng.integers(1, 5)
+    fields = {
+        "氏名": f"{surname} {given}",
+        "フリガナ": f"{surname.upper()} {given.upper()}",
+        "生年月日": f"{rng.integers(1950, 2006)}/{rng.integers(1, 13)}/{rng.integers(1, 29)}",
+        "職業": rng.choice(JOBS),
+        "住所": f"{rng.integers(1, 9)}-{rng.integers(1, 30)}-{rng.integers(1, 20)} {rng.choice(CITIES)} Okinawa",
+        "電話番号": f"090-{rng.integers(1000, 10000)}-{rng.integers(1000, 10000)}",
+        "メールアドレス": f"{given.lower()}{rng.integers(1, 99)}@example.jp",
+        "チェックイン日": f"2026/{month}/{day}",
+        "チェックアウト日": f"2026/{month}/{day + stay}",
+        "年齢": str(rng.integers(18, 90)),
+    }
+    for key, rate in OPTIONAL_FIELDS.items():
+        if rng.random() < rate:
+            fields[key] = ""
+    return {key: text for key, text in fields.items() if key in template["cells"]}
+
+
+def draw_handwriting(card, text, box, rng):
+    """セル枠 (ymin, xmin, ymax, xmax) の中に手書き風フォントで文字を書く (わずかな回転・太さのゆらぎ付き)"""
+    if not text:
+        return
+    ymin, xmin, ymax, xmax = box
+    h, w = ymax - ymin, xmax - xmin
+    scale = rng.uniform(0.75, 1.0)
+    thickness = int(rng.integers(1, 3))
+    font = cv2.FONT_HERSHEY_SCRIPT_SIMPLEX
+    (tw, th), _ = cv2.getTextSize(text, font, scale, thickness)
+    if tw > w - 10:
+        scale *= (w - 10) / tw
+        (tw, th), _ = cv2.getTextSize(text, font, scale, thickness)
+
+    patch = np.full((h, w), 255, np.uint8)
+    x = int(rng.integers(4, max(5, w - tw - 4)))
+    y = int((h + th) / 2 + rng.integers(-3, 4))
+    cv2.putText(patch, text, (x, y), font, scale, 0, thickness, cv2.LINE_AA)
+    rot = cv2.getRotationMatrix2D((w / 2, h / 2), rng.uniform(-2.5, 2.5), 1.0)
+    patch = cv2.warpAffine(patch, rot, (w, h), borderValue=255)
+
+    ink = np.array([rng.integers(20, 70), rng.integers(10, 40), rng.integers(0, 30)], np.float32)
+    alpha = (1.0 - patch.astype(np.float32) / 255.0)[..., None]
+    region = card[ymin:ymax, xmin:xmax].astype(np.float32)
+    card[ymin:ymax, xmin:xmax] = (region * (1 - alpha) + ink * alpha).astype(np.uint8)
+
+
+def render_card(rng, template=None, fields=None, consent=None):
+    """
+    正面から見た 1000x360 のカード画像と正解 {"template", "fields", "consent"} を返す。
+    consent は "可" / "不可" / "未選択" (省略時はランダム、メール配信欄のないレイアウトでは常に "未選択")。
+    """
+    template = template or app.get_card_template()
+    cells = template["cells"]
+    fields = fields if fields is not None else random_fields(rng, template)
+    if app.CONSENT_FIELD not in cells:
+        consent = "未選択"
+    consent = consent or rng.choice(["可", "不可", "未選択"])
+    target_w, target_h = app.CARD_SIZE
+    paper = int(rng.integers(228, 250))
+    card = np.full((target_h, target_w, 3), paper, np.uint8)
+
+    # 罫線 (外枠、セル行の上下、セル間の縦線) と印字ラベル
+    cv2.rectangle(card, (1, 1), (target_w - 2, target_h - 2), (30, 30, 30), 3)
+    for ymin, ymax in template["bands"]:
+        cv2.line(card, (0, ymin), (target_w - 1, ymin), (40, 40, 40), 2)
+        cv2.line(card, (0, ymax), (target_w - 1, ymax), (40, 40, 40), 2)
+    for key, (ymin, xmin, _, _) in cells.items():
+        cv2.putText(card, PRINTED_LABELS[key], (xmin + 8, ymin - 12), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (50, 50, 50), 2, cv2.LINE_AA)
+    for ymin, ymax, x in template["separators"]:
+        cv2.line(card, (x, ymin), (x, ymax), (40, 40, 40), 2)
+
+    for key, text in fields.items():
+        draw_handwriting(card, text, cells[key], rng)
+
+    if app.CONSENT_FIELD in cells:
+        # メール配信欄: 左に「可」(1文字)、右に「不可」(2文字) 相当の印字と、手書きの◯
+        ymin, xmin, ymax, xmax = cells[app.CONSENT_FIELD]
+        cy = (ymin + ymax) // 2
+        left_x, right_x = xmin + (xmax - xmin) // 4, xmin + 3 * (xmax - xmin) // 4
+        cv2.putText(card, "K", (left_x - 8, cy + 8), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (40, 40, 40), 2, cv2.LINE_AA)
+        cv2.putText(card, "FK", (right_x - 16, cy + 8), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (40, 40, 40), 2, cv2.LINE_AA)
+        if consent != "未選択":
+            cx = left_x if consent == "可" else right_x
+            axes = (int(rng.integers(28, 40)), int(rng.integers(15, 20)))
+            cv2.ellipse(card, (cx + int(rng.integers(-4, 5)), cy), axes, rng.uniform(-10, 10), 0, 360,
+                        (40, 20, 10), int(rng.integers(2, 4)), cv2.LINE_AA)
+
+    return card, {"template": template["name"], "fields": fields, "consent": consent}
+
+
+def render_photo(rng, photo_size=(1600, 1200), card=None, truth=None, hazard=None):
+    """
+    カード画像を背景に射影して「撮影写真」を作り、(JPEGバイト列, 正解) を返す。
+    正解には写真上のカード四隅 "corners" (左上, 右上, 右下, 左下) と撮影条件 "hazard" を含む。
+    hazard は HAZARDS のいずれか (None なら暗い机に置いただけの写真)。
+    """
+    if card is None:
+        card, truth = render_card(rng)
+    pw, ph = photo_size
+    photo = render_desk(rng, photo_size, hazard)
+
+    # カードの配置: 幅は写真の 60〜85%、回転 ±8°、四隅を最大 5% ずらして遠近感を付ける
+    width = pw * rng.uniform(0.6, 0.85)
+    center = np.array([pw / 2, ph / 2]) + rng.uniform(-0.06, 0.06, 2) * [pw, ph]
+    corners = place_card(rng, photo, card, center, width)
+    if hazard == "finger":
+        # ランダムな1辺の中央付近を肌色の楕円 (指) で隠す
+        i = int(rng.integers(4))
+        tip = (corners[i] + corners[(i + 1) % 4]) / 2
+        cv2.ellipse(photo, (int(tip[0]), int(tip[1])), (60, 140), rng.uniform(0, 180), 0, 360, (120, 150, 200), -1)
+
+    return finish_photo(rng, photo), dict(truth, corners=corners.tolist(), hazard=hazard)
+
+
+def render_multi_photo(rng, cards, photo_size=(2400, 1600), grid=(2, 2)):
+    """
+    複数枚のカード [(カード画像, 正解), ...] を grid (列, 行) に並べて1枚の写真にし、(JPEGバイト列, 正解のリスト) を返す。
+    正解は読み取り順 (上の行から、行内は左から) で、それぞれ写真上の四隅 "corners" を含む。
+    """
+    pw, ph = photo_size
+    cols, rows = grid
+    photo = render_desk(rng, photo_size)
+    truths = []
+    for i, (card, truth) in enumerate(cards):
+        # 格子の各マスの中央付近に、マス幅の 75〜85% の大きさで置く (隣のカードとは重ならない)
+        cell = np.array([pw / cols, ph / rows])
+        center = (np.array([i % cols, i // cols]) + 0.5 + rng.uniform(-0.03, 0.03, 2)) * cell
+        corners = place_card(rng, photo, card, center, cell[0] * rng.uniform(0.75, 0.85), max_angle=4, skew=0.03)
+        truths.append(dict(truth, corners=corners.tolist(), hazard="multi"))
+    return finish_photo(rng, photo), truths
+
+
+def render_desk(rng, photo_size, hazard=None):
+    """机の天板を想定した暗めのノイズ画像 ("light" ではカードと見分けにくい白っぽい机、"clutter" では色々な直線入り)"""
+    pw, ph = photo_size
+    base = rng.integers(185, 225, size=3) if hazard == "light" else rng.integers(40, 120, size=3)
+    photo = np.clip(base + rng.normal(0, 8, (ph, pw, 3)), 0, 255).astype(np.uint8)
+    if hazard == "clutter":
+        for _ in range(12):
+            color = tuple(int(v) for v in rng.integers(0, 255, 3))
+            p1 = (int(rng.integers(0, pw)), int(rng.integers(0, ph)))
+            p2 = (int(rng.integers(0, pw)), int(rng.integers(0, ph)))
+            cv2.line(photo, p1, p2, color, int(rng.integers(2, 8)))
+    return photo
+
+
+def place_card(rng, photo, card, center, width, max_angle=8, skew=0.05):
+    """
+    カード画像を写真の center に幅 width で射影して描き込み、写真上の四隅 (4x2) を返す。
+    回転は ±max_angle 度、四隅をカード幅の skew 倍まで ずらして遠近感を付ける。
+    """
+    target_w, target_h = app.CARD_SIZE
+    height = width * target_h / target_w
+    angle = np.deg2rad(rng.uniform(-max_angle, max_angle))
+    rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    corners = np.array([[-width / 2, -height / 2], [width / 2, -height / 2], [width / 2, height / 2], [-width / 2, height / 2]])
+    corners = (corners @ rot.T + center + rng.uniform(-skew, skew, (4, 2)) * width).astype(np.float32)
+
+    src = np.array([[0, 0], [target_w - 1, 0], [target_w - 1, target_h - 1], [0, target_h - 1]], np.float32)
+    M = cv2.getPerspectiveTransform(src, corners)
+    cv2.warpPerspective(card, M, (photo.shape[1], photo.shape[0]), dst=photo, borderMode=cv2.BORDER_TRANSPARENT)
+    return corners
+
+
+def finish_photo(rng, photo):
+    """影・ぼけ・センサーノイズを加えて JPEG にエンコードする"""
+    ph, pw = photo.shape[:2]
+    # 影: ランダムな向きの直線グラデーションで最大 35% 暗くする
+    yy, xx = np.mgrid[0:ph, 0:pw].astype(np.float32)
+    theta = rng.uniform(0, 2 * np.pi)
+    ramp = (np.cos(theta) * xx / pw + np.sin(theta) * yy / ph)
+    ramp = (ramp - ramp.min()) / (ramp.max() - ramp.min() + 1e-6)
+    shade = 1.0 - rng.uniform(0.0, 0.35) * np.clip(ramp * 1.5 - 0.5, 0, 1)
+    photo = (photo.astype(np.float32) * shade[..., None]).astype(np.uint8)
+
+    # ぼけ・センサーノイズ
+    sigma = rng.uniform(0.0, 1.6)
+    if sigma > 0.3:
+        photo = cv2.GaussianBlur(photo, (0, 0), sigma)
+    photo = np.clip(photo + rng.normal(0, 3, photo.shape), 0, 255).astype(np.uint8)
+
+    _, encoded = cv2.imencode(".jpg", photo, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(82, 95))])
+    return encoded.tobytes()
+
+
+def generate(count, seed=0, photo_size=(1600, 1200), mixed=True, hard=False):
+    """
+    (JPEGバイト列, 正解) を count 件生成する (seed が同じなら同じ画像列)。
+    mixed=True なら全テンプレートのカードを混ぜる (旧カードが混在する束を想定)。
+    hard=True なら各写真に HAZARDS のいずれかの撮影条件を付ける。
+    """
+    rng = np.random.default_rng(seed)
+    templates = list(app.load_card_templates().values()) if mixed else [app.get_card_template()]
+    samples = []
+    for _ in range(count):
+        card, truth = render_card(rng, templates[rng.integers(len(templates))])
+        hazard = rng.choice(HAZARDS) if hard else None
+        samples.append(render_photo(rng, photo_size, card, truth, hazard))
+    return samples
+
+
+def write_reference_templates(out_dir, seed=0):
+    """
+    card_templates/ のテンプレートJSONを out_dir に写し、合成カードと同じ印字の無記入カード画像を
+    特徴点照合用の "reference" として付ける (ベンチマークで特徴点照合の段階を動かすため)。
+    """
+    rng = np.random.default_rng(seed)
+    for filename in sorted(os.listdir(app.CARD_TEMPLATE_DIR)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(app.CARD_TEMPLATE_DIR, filename), encoding="utf-8") as f:
+            spec = json.load(f)
+        template = app.compile_card_template(spec)
+        card, _ = render_card(rng, template, {key: "" for key in template["cells"]}, consent="未選択")
+        spec["reference"] = f"{spec['name']}_reference.png"
+        cv2.imwrite(os.path.join(out_dir, spec["reference"]), card)
+        with open(os.path.join(out_dir, filename), "w", encoding="utf-8") as f:
+            json.dump(spec, f, ensure_ascii=False, indent=2)
+
+
+def generate_multi(count, seed=0, grid=(2, 2)):
+    """
+    grid (列, 行) に並べた複数枚のカードの写真 (JPEGバイト列, 正解のリスト) を count 件生成する。
+    カードのレイアウトは全テンプレートを混ぜる。
+    """
+    rng = np.random.default_rng(seed)
+    templates = list(app.load_card_templates().values())
+    return [render_multi_photo(rng, [render_card(rng, templates[rng.integers(len(templates))])
+                                     for _ in range(grid[0] * grid[1])], grid=grid)
+            for _ in range(count)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成予約カード画像の生成")
+    parser.add_argument("out_dir", help="出力フォルダ")
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hard", action="store_true", help="外郭検出が難しい撮影条件の写真を生成する")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    labels = {}
+    for i, (image_bytes, truth) in enumerate(generate(args.count, args.seed, hard=args.hard)):
+        name = f"card_{i:04d}.jpg"
+        with open(os.path.join(args.out_dir, name), "wb") as f:
+            f.write(image_bytes)
+        labels[name] = dict(truth["fields"], **{app.CONSENT_FIELD: truth["consent"]})
+    # bench_enhance.py --labels でそのまま使える形式
+    with open(os.path.join(args.out_dir, "labels.json"), "w", encoding="utf-8") as f:
+        json.dump(labels, f, ensure_ascii=False, indent=1)
+    print(f"{args.count} 枚を {args.out_dir} に出力しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+"""
+予約カード画像の一括取り込み (ヘッドレス実行)。
+
+フォルダまたはglobで指定したカード画像をプロセスプールで並列に傾き補正・セル切り出しし、
+複数カード分のセル画像を VISION_BATCH_LIMIT 枚単位の batch_annotate_images にまとめてOCRする。
+補正 (プロセスプール) と Vision API 呼び出し (非同期クライアント、同時 --concurrency 件) は
+asyncio のキューでつないだパイプラインとして並行に進むため、処理速度は遅い方の段階で決まる。
+完了したカードから順に CSV / JSONL / スプレッドシートへ書き出し、
+処理済みファイルを状態ファイルに記録するため、中断後は続きから再開できる。
+以前に読み取ったカードと同一と判定した画像はOCRせず保存済みの結果を使い、
+--sheet では登録済みの宿泊者 (氏名・電話番号・チェックイン日が同じ行) を転記しない。
+
+    python bulk_ingest.py "scans/*.jpg" -o result.jsonl
+    python bulk_ingest.py scans/ --sheet --workers 4
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import app
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def collect_image_paths(targets):
+    """ディレクトリ / globパターン / ファイルパスの列から画像パスをソート済みで返す"""
+    paths = []
+    for target in targets:
+        if os.path.isdir(target):
+            candidates = [os.path.join(target, f) for f in os.listdir(target)]
+        else:
+            candidates = glob.glob(target)
+        paths.extend(p for p in candidates if p.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(p))
+    return sorted(set(paths))
+
+
+def load_done_paths(state_path):
+    """状態ファイルから処理済みの画像パスを読み込む"""
+    if not state_path or not os.path.exists(state_path):
+        return set()
+    with open(state_path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def _align_worker(path, enhance):
+    """
+    プロセスプール用: 画像を読み込んで補正・切り出し・空欄判定・指紋計算し、
+    セル画像と指紋のみを返す (aligned画像は転送しない)
+    """
+    info = {}
+    with open(path, "rb") as f:
+        aligned, crops = app.get_aligned_card_and_crops(f.read(), enhance=enhance, info=info)
+    # 空欄判定・指紋もCPU処理なのでワーカー側で行う (カード外郭を検出できなかった場合は全セルをOCRし、重複判定もしない)
+    blank_keys, fingerprint = [], None
+    if info["card_found"]:
+        blank_keys = app.find_blank_cells(crops)
+        fingerprint = app.card_fingerprint(aligned, app.get_card_template(info["template"]))
+    return path, crops, info["template"], blank_keys, fingerprint
+
+
+class CsvSink:
+    def __init__(self, path):
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._f = open(path, "a", encoding="utf-8-sig" if is_new else "utf-8", newline="")
+        self._writer = csv.writer(self._f)
+        if is_new:
+            self._writer.writerow(["source"] + app.SHEET_COLUMNS)
+
+    def write(self, record):
+        self._writer.writerow([record["source"]] + app.sheet_row(record["data"]))
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class JsonlSink:
+    def __init__(self, path):
+        self._f = open(path, "a", encoding="utf-8")
+
+    def write(self, record):
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class SheetSink:
+    """
+    転記キュー経由でメインシートへ1カード1行 (A〜J列) と OCR_LOG を書き込む。
+    同じ氏名・電話番号・チェックイン日の行が既にあれば (allow_duplicates=False のとき) 転記せず duplicates に記録する。
+    シートに拒否されるなどして保留の表へ移った行は、close() の後 held に入る (今回の取り込みで保留になったもの)。
+    """
+
+    def __init__(self, credentials, allow_duplicates=False):
+        self._credentials = credentials
+        self._allow_duplicates = allow_duplicates
+        self.duplicates = []
+        self.held = []
+        self._held_before = {row["id"] for row in app.dead_letter_rows()}
+        if not allow_duplicates:
+            app.refresh_sheet_index(credentials)  # 取り込みを始める前に重複チェック用の索引を用意する
+        app.start_outbox_flusher(credentials)
+
+    def write(self, record):
+        row = app.sheet_row(record["data"])
+        if not self._allow_duplicates:
+            where = app.find_duplicate_row(row)
+            if where:
+                self.duplicates.append((record["source"], where))
+                return
+        ts = time.strftime('%Y-%m-%d %H:%M:%S')
+        raw_lines = [l.strip() for l in record["raw_text"].splitlines() if l.strip()]
+        app.enqueue_sheet_rows([
+            ("main", row),
+            ("log", [ts] + raw_lines),
+        ])
+
+    def close(self):
+        # キューが空になっても、送れなかった行は保留の表に残っているだけなので数えておく
+        app.drain_outbox(self._credentials)
+        self.held = [row for row in app.dead_letter_rows() if row["id"] not in self._held_before]
+
+
+def open_sink(output=None, fmt=None, credentials=None, sheet=False, allow_duplicates=False):
+    if sheet:
+        return SheetSink(credentials, allow_duplicates)
+    fmt = fmt or ("csv" if output.lower().endswith(".csv") else "jsonl")
+    return CsvSink(output) if fmt == "csv" else JsonlSink(output)
+
+
+def ingest_images(paths, credentials, sink, workers=None, enhance="accurate", state_path=None, log=print,
+                  concurrency=None, client=None):
+    """
+    画像パスのリストを一括OCRし、完了したカードから順に sink.write() へ渡す。
+    state_path を指定すると処理済みパスを記録し、既に記録済みのパスはスキップする。
+    処理件数・所要時間・カード/秒を dict で返す (ingest_images_async の同期版)。
+    """
+    return asyncio.run(ingest_images_async(paths, credentials, sink, workers, enhance, state_path, log,
+                                           concurrency, client))
+
+
+async def ingest_images_async(paths, credentials, sink, workers=None, enhance="accurate", state_path=None, log=print,
+                              concurrency=None, client=None):
+    """
+    補正 → OCR のパイプライン。
+    生産側は補正をプロセスプールで実行して結果を有限長のキューへ入れ、消費側はセルを16枚単位に詰めて
+    RPC を最大 concurrency 件まで並行に送る (client 省略時は ImageAnnotatorAsyncClient を生成)。
+    RPC の応答待ちの間も次のカードの補正が進み、キューが満杯になれば補正側が待つ。
+    """
+    done = load_done_paths(state_path)
+    todo = [p for p in paths if p not in done]
+    if done:
+        log(f"再開: 処理済み {len(paths) - len(todo)} 件をスキップします")
+
+    workers = workers or os.cpu_count()
+    concurrency = concurrency or app.VISION_MAX_CONCURRENCY
+    own_client = client is None
+    if own_client:
+        client = app.new_async_vision_client(credentials)
+    loop = asyncio.get_running_loop()
+    state_f = open(state_path, "a", encoding="utf-8") if state_path else None
+
+    # 補正済みカードのキュー (長さを制限してメモリを抑える)、OCR待ちのセル (カードID, 項目名, 画像)、カードごとの途中結果
+    aligned_queue = asyncio.Queue(maxsize=workers * 2)
+    pending = []
+    cards = {}
+    rpc_slots = asyncio.Semaphore(concurrency)
+    rpc_tasks = set()
+    stats = {"processed": 0, "failed": 0, "skipped": len(paths) - len(todo), "reused": 0}
+    started = time.perf_counter()
+
+    def emit(path, reused=None):
+        card = cards.pop(path)
+        if reused:
+            # 以前に読み取ったカードの再取り込み: 保存済みの結果をそのまま使う
+            parsed_data, raw_text, field_status = reused["data"], reused["raw_text"], reused["field_status"]
+            stats["reused"] += 1
+        else:
+            parsed_data, raw_text, field_status = app.assemble_ocr_result(card["crops"], card["texts"], card["blank"])
+            if card["fingerprint"] is not None and "error" not in field_status.values():
+                app.remember_card(card["fingerprint"], app.get_card_template(card["template"]),
+                                  {"data": parsed_data, "raw_text": raw_text, "field_status": field_status})
+        sink.write({"source": path, "template": card["template"], "data": parsed_data,
+                    "field_status": field_status, "raw_text": raw_text})
+        if state_f:
+            state_f.write(path + "\n")
+            state_f.flush()
+            os.fsync(state_f.fileno())
+        stats["processed"] += 1
+        elapsed = time.perf_counter() - started
+        log(f"[{stats['processed'] + stats['failed']}/{len(todo)}] {path}  ({stats['processed'] / elapsed:.2f} cards/s)")
+
+    def fail(path, message):
+        stats["failed"] += 1
+        log(f"{message}: {path}")
+
+    async def produce(pool):
+        # プールを遊ばせない程度 (workers * 2 件) だけ先行して投入する
+        in_flight = asyncio.Semaphore(workers * 2)
+
+        async def align(path):
+            async with in_flight:
+                try:
+                    item = (path, await loop.run_in_executor(pool, _align_worker, path, enhance), None)
+                except Exception as e:
+                    item = (path, None, e)
+                await aligned_queue.put(item)
+
+        await asyncio.gather(*(align(p) for p in todo))
+        await aligned_queue.put(None)
+
+    async def send(chunk):
+        try:
+            results = await app.async_annotate_texts(client, [image for _, _, image in chunk])
+        except Exception as e:
+            # 再試行しても失敗したカードは出力せず状態ファイルにも記録しない (次回の実行で再処理)
+            for path in dict.fromkeys(path for path, _, _ in chunk):
+                if cards.pop(path, None) is not None:
+                    fail(path, f"OCR失敗 ({type(e).__name__}: {e})")
+            return
+        finally:
+            rpc_slots.release()
+        for (path, key, _), result in zip(chunk, results):
+            card = cards.get(path)
+            if card is None:
+                continue  # 同じカードの別リクエストが失敗済み
+            card["texts"][key] = result
+            card["remaining"] -= 1
+            if card["remaining"] == 0:
+                emit(path)
+
+    async def dispatch(final=False):
+        # 満杯のリクエスト単位で送信し、端数は次のカードと相乗りさせる (最後のみ端数も送信)
+        while pending and (final or len(pending) >= app.VISION_BATCH_LIMIT):
+            chunk = pending[:app.VISION_BATCH_LIMIT]
+            del pending[:app.VISION_BATCH_LIMIT]
+            await rpc_slots.acquire()  # 同時RPC数の上限に達していれば空くまで待つ
+            for task in [t for t in rpc_tasks if t.done()]:
+                rpc_tasks.discard(task)
+                task.result()  # 書き出し側の例外はここで送出する
+            rpc_tasks.add(asyncio.create_task(send(chunk)))
+
+    try:
+        # 親プロセスでは転記キューの書き込みスレッドや gRPC のスレッドが動いているため、fork するとロックを握ったまま
+        # 複製されてワーカーが止まることがある。spawn で起動し直す (ワーカーごとに app の import 分だけ起動が遅くなる)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            producer = asyncio.create_task(produce(pool))
+            try:
+                while (item := await aligned_queue.get()) is not None:
+                    path, aligned, error = item
+                    if error is not None:
+                        fail(path, f"補正失敗 ({error})")
+                        continue
+                    _, crops, template, blank_keys, fingerprint = aligned
+                    ocr_keys = [k for k in crops if k != app.CONSENT_FIELD and k not in blank_keys]
+                    cards[path] = {"crops": crops, "template": template, "blank": blank_keys, "fingerprint": fingerprint,
+                                   "texts": {}, "remaining": len(ocr_keys)}
+                    duplicate = (app.find_duplicate_card(fingerprint, app.get_card_template(template))
+                                 if fingerprint is not None else None)
+                    if duplicate:
+                        emit(path, reused=duplicate["result"])
+                        continue
+                    if not ocr_keys:
+                        emit(path)
+                        continue
+                    pending.extend((path, k, crops[k]) for k in ocr_keys)
+                    await dispatch()
+                await dispatch(final=True)
+                await asyncio.gather(*rpc_tasks)
+            finally:
+                producer.cancel()
+                for task in rpc_tasks:
+                    task.cancel()
+    finally:
+        if state_f:
+            state_f.close()
+        if own_client:
+            await client.transport.close()
+
+    stats["elapsed_sec"] = time.perf_counter() - started
+    stats["cards_per_sec"] = stats["processed"] / stats["elapsed_sec"] if stats["elapsed_sec"] else 0.0
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="予約カード画像の一括OCR取り込み")
+    parser.add_argument("targets", nargs="+", help="画像フォルダ / globパターン / 画像ファイル")
+    parser.add_argument("-o", "--output", help="出力ファイル (.csv または .jsonl)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="出力形式 (省略時は拡張子から判定)")
+    parser.add_argument("--sheet", action="store_true", help="ファイルではなくスプレッドシートへ転記する")
+    parser.add_argument("--state", help="再開用の状態ファイル (省略時は <output>.state)")
+    parser.add_argument("--workers", type=int, help="補正処理のプロセス数 (省略時はCPUコア数)")
+    parser.add_argument("--enhance", choices=list(app.ENHANCE_TIERS), default="accurate", help="手書き文字補正の段階 (既定: accurate)")
+    parser.add_argument("--concurrency", type=int, help=f"Vision API の同時リクエスト数 (既定: {app.VISION_MAX_CONCURRENCY})")
+    parser.add_argument("--allow-duplicates", action="store_true",
+                        help="--sheet で、同じ氏名・電話番号・チェックイン日の行が既にあっても転記する")
+    parser.add_argument("--credentials", help="サービスアカウントJSONのパス")
+    args = parser.parse_args(argv)
+
+    if not args.sheet and not args.output:
+        parser.error("--output または --sheet を指定してください")
+
+    if args.credentials:
+        creds = app.load_credentials(args.credentials)
+    else:
+        creds, _ = app.find_credentials()
+    if not creds:
+        print("認証キーが見つかりません。--credentials または GCP_SERVICE_ACCOUNT_JSON を設定してください。", file=sys.stderr)
+        return 1
+
+    paths = collect_image_paths(args.targets)
+    if not paths:
+        print("対象画像が見つかりません。", file=sys.stderr)
+        return 1
+
+    state_path = args.state or ((args.output or "sheet") + ".state")
+    sink = open_sink(args.output, args.format, creds, args.sheet, args.allow_duplicates)
+    try:
+        stats = ingest_images(paths, creds, sink, workers=args.workers,
+                              enhance=args.enhance, state_path=state_path, concurrency=args.concurrency)
+    finally:
+        sink.close()
+
+    print(f"完了: {stats['processed']} 件 (失敗 {stats['failed']} / スキップ {stats['skipped']} / 前回結果を再利用 {stats['reused']}) "
+          f"{stats['elapsed_sec']:.1f} 秒, {stats['cards_per_sec']:.2f} cards/s")
+    for source, where in getattr(sink, "duplicates", []):
+        print(f"重複のため転記せず: {source} ({where})")
+    held = getattr(sink, "held", [])
+    for row in held:
+        target = "メインシート" if row["target"] == "main" else "OCR_LOG"
+        print(f"転記できず保留: {target} {row['values'][:3]} ({row['error']})", file=sys.stderr)
+    if held:
+        # 状態ファイルでは処理済みのため、再実行しても送り直さない。原因を直してから画面のサイドバーで再送する
+        print(f"{len(held)} 行を保留にしました。原因を直してから、画面のサイドバーの「保留中の行をすべて再送する」で送り直してください。",
+              file=sys.stderr)
+        return 3
+    return 0 if stats["failed"] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
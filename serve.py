@@ -0,0 +1,65 @@
+"""
+本番用の起動スクリプト (render.yaml の startCommand)。
+
+Streamlit サーバーを起動すると同時に、重いライブラリ (cv2 / Vision / gspread) の import と
+app の事前準備 (認証キー・Vision クライアント・転記キュー・シート行の索引) をバックグラウンドで始め、
+スリープ明けの最初の利用者が画面を開く前に済ませておく。/healthz・/warmup・/metrics は Streamlit と同じポート
+(Render が公開する $PORT) で起動時から応答する (画面が一度も開かれていなくても /warmup で準備を待てる)。
+プロセスの起動時刻を環境変数 APP_PROCESS_STARTED で app.py に渡し、起動時間
+(画面表示まで・準備完了まで) をプロセスの起動から計測できるようにする。
+
+    python serve.py --server.port $PORT --server.address 0.0.0.0
+"""
+import importlib
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault("APP_PROCESS_STARTED", str(time.time()))  # app.PROCESS_STARTED_ENV
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+# app.py が LazyModule で遅らせているモジュール
+PRELOAD_MODULES = ("cv2", "google.cloud.vision", "gspread", "google.oauth2.service_account", "google.api_core.exceptions")
+
+
+def preload():
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"preload: {name}: {e}", file=sys.stderr)
+
+
+def parse_config(args):
+    """`streamlit run` と同じ `--server.port 8501` / `--server.port=8501` 形式の設定を {設定名: 値} にする"""
+    config, args = {}, list(args)
+    while args:
+        option = args.pop(0)
+        if not option.startswith("--"):
+            raise SystemExit(f"不明な引数です: {option}")
+        name, sep, value = option[2:].partition("=")
+        if not sep:
+            if not args:
+                raise SystemExit(f"{option} の値がありません")
+            value = args.pop(0)
+        config[name] = int(value) if value.isdigit() else value
+    return config
+
+
+def main(argv=None):
+    config = parse_config(sys.argv[1:] if argv is None else argv)
+    threading.Thread(target=preload, name="preload", daemon=True).start()
+    # app の import は軽い (重いモジュールは LazyModule)。事前準備とヘルスチェック用サーバーはここでプロセスごとに1回起動し、
+    # Streamlit が実行する app.py も同じ app モジュールを使う (app.py 末尾)
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    import app
+    app.start_background_services()
+    import streamlit as st
+    sys.argv = sys.argv[:1]  # 設定は config で渡す (残りはスクリプトの引数として扱われる)
+    st.App(APP_PATH, routes=app.health_routes()).run(config=config)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""同一カードの再アップロード判定のテスト (合成カードを使う)"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import app
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic_cards  # noqa: E402
+
+# 記入が少ないカード (別の宿泊者でもインクの位置が似る)
+SPARSE_FIELDS = ("氏名", "電話番号", "チェックイン日")
+
+
+@pytest.fixture
+def dedup_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "DEDUP_INDEX_PATH", str(tmp_path / "dedup.sqlite3"))
+    app.get_dedup_index.clear()
+    yield app.get_dedup_index()
+    app.get_dedup_index.clear()
+
+
+def photograph(rng, fields, template):
+    """同じカードを別々に撮った2枚の写真の指紋"""
+    card, truth = synthetic_cards.render_card(rng, template, fields, consent="未選択")
+    prints = []
+    for _ in range(2):
+        photo, _ = synthetic_cards.render_photo(rng, card=card, truth=truth)
+        [(aligned, _, info)] = app.align_cards(photo)
+        assert info["card_found"]
+        prints.append(app.card_fingerprint(aligned, template))
+    return prints
+
+
+def sparse_fields(rng, template):
+    fields = synthetic_cards.random_fields(rng, template)
+    return {key: text if key in SPARSE_FIELDS else "" for key, text in fields.items()}
+
+
+def test_sparse_cards_of_different_guests_are_not_merged(dedup_index):
+    rng = np.random.default_rng(11)
+    template = app.get_card_template("v2")
+    guests = []
+    for _ in range(8):
+        fields = sparse_fields(rng, template)
+        stored, again = photograph(rng, fields, template)
+        app.remember_card(stored, template, {"data": {"氏名": fields["氏名"]}, "raw_text": "", "field_status": {}})
+        guests.append((fields["氏名"], again))
+
+    found = 0
+    for name, again in guests:
+        duplicate = app.find_duplicate_card(again, template)
+        if duplicate:
+            assert duplicate["result"]["data"]["氏名"] == name  # 別の宿泊者の結果は決して返さない
+            found += 1
+    assert found >= 6  # 撮り直した写真の大半は再利用できる (見逃してもOCRし直すだけ)
+
+    for _ in range(8):
+        fields = sparse_fields(rng, template)
+        new_guest, _ = photograph(rng, fields, template)
+        assert app.find_duplicate_card(new_guest, template) is None
+
+
+def test_cards_with_little_ink_are_not_indexed(dedup_index):
+    rng = np.random.default_rng(3)
+    template = app.get_card_template("v2")
+    fields = {key: "" for key in synthetic_cards.random_fields(rng, template)}
+    fields["氏名"] = "Higa Sora"
+    stored, again = photograph(rng, fields, template)
+    assert not app.is_dedup_eligible(stored, template)
+    app.remember_card(stored, template, {"data": {}, "raw_text": "", "field_status": {}})
+    assert dedup_index["conn"].execute("SELECT COUNT(*) FROM card_prints").fetchone()[0] == 0
+    assert app.find_duplicate_card(again, template) is None
+
+
+def test_old_prints_are_evicted(dedup_index, monkeypatch):
+    rng = np.random.default_rng(5)
+    template = app.get_card_template("v2")
+    stored, again = photograph(rng, synthetic_cards.random_fields(rng, template), template)
+    app.remember_card(stored, template, {"data": {}, "raw_text": "", "field_status": {}})
+    assert app.find_duplicate_card(again, template) is not None
+
+    dedup_index["conn"].execute("UPDATE card_prints SET last_used = last_used - ?", (app.PERSONAL_DATA_RETENTION_SEC + 1,))
+    monkeypatch.setattr(app, "DEDUP_INDEX_MAX_BYTES", 1)
+    app.remember_card(again, template, {"data": {}, "raw_text": "", "field_status": {}})
+    # 期限切れの行は消え、上限を超えた分も古い順に消える
+    assert dedup_index["conn"].execute("SELECT COUNT(*) FROM card_prints").fetchone()[0] == 0
@@ -0,0 +1,71 @@
+"""撮影フレームの品質判定 (score_frame / best_frame) のテスト (合成カードを使う)"""
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import app
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic_cards  # noqa: E402
+
+
+def photo(seed=1, photo_size=(1600, 1200)):
+    """合成カードの写真 (デコード済みの画像, 正解)"""
+    image_bytes, truth = synthetic_cards.render_photo(np.random.default_rng(seed), photo_size=photo_size)
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR), truth
+
+
+def encode(img):
+    return cv2.imencode(".jpg", img)[1].tobytes()
+
+
+def test_sharp_card_is_ok():
+    img, _ = photo()
+    score = app.score_frame(encode(img))
+    assert score["ok"] and score["reasons"] == []
+    assert score["cell_height"] >= app.FRAME_MIN_CELL_HEIGHT
+
+
+def test_blurred_card_is_rejected():
+    img, _ = photo()
+    score = app.score_frame(encode(cv2.GaussianBlur(img, (0, 0), 4)))
+    # ぼけたカードの外郭が取れるかは OpenCV のバージョンで変わるため、鮮明度の判定だけを確かめる
+    assert score["sharpness"] < app.FRAME_MIN_SHARPNESS
+    assert "ピンぼけ" in score["reasons"] and "白飛び" not in score["reasons"]
+    assert not score["ok"]
+
+
+def test_glare_on_card_is_rejected():
+    img, truth = photo()
+    center = np.array(truth["corners"]).mean(axis=0).astype(int)
+    cv2.ellipse(img, tuple(int(v) for v in center), (260, 90), 0, 0, 360, (255, 255, 255), -1)
+    score = app.score_frame(encode(img))
+    assert score["reasons"] == ["白飛び"]
+
+
+def test_small_card_is_rejected_even_if_detected():
+    # 写真の 1/4 ほどを占めて外郭は取れるが、560x420 の写真ではセルが FRAME_MIN_CELL_HEIGHT に満たない (面積比では判定できない)
+    img, _ = photo(photo_size=(560, 420))
+    score = app.score_frame(encode(img))
+    assert score["card_found"] and score["area_ratio"] > app.CARD_MIN_AREA_RATIO
+    assert score["cell_height"] < app.FRAME_MIN_CELL_HEIGHT
+    assert score["reasons"] == ["カードが小さい"]
+
+
+def test_best_frame_prefers_ok_frame_over_sharper_rejected_one():
+    img, truth = photo()
+    glare = img.copy()
+    center = np.array(truth["corners"]).mean(axis=0).astype(int)
+    cv2.ellipse(glare, tuple(int(v) for v in center), (260, 90), 0, 0, 360, (255, 255, 255), -1)
+    scores = {"blur": app.score_frame(encode(cv2.GaussianBlur(img, (0, 0), 4))),
+              "soft": app.score_frame(encode(cv2.GaussianBlur(img, (0, 0), 1.3))),  # 基準は満たすがやや甘い
+              "glare": app.score_frame(encode(glare))}
+    assert scores["glare"]["sharpness"] > scores["soft"]["sharpness"]
+    assert app.best_frame(scores) == "soft"
+
+    # 基準を満たすフレームがなければ、基準未満で最も鮮明なもの
+    del scores["soft"]
+    assert app.best_frame(scores) == "glare"
+    assert app.best_frame({}) is None
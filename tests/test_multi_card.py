@@ -0,0 +1,37 @@
+"""1枚の写真に並べた複数枚のカードの検出テスト (合成カードを使う)"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import app
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic_cards  # noqa: E402
+
+# 四隅の誤差の許容値 (カード幅に対する割合、run_benchmark.py の ALIGN_TOLERANCE と同じ)
+ALIGN_TOLERANCE = 0.02
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_align_cards_finds_grid_in_reading_order(seed):
+    [(photo, truths)] = synthetic_cards.generate_multi(1, seed, grid=(2, 2))
+    cards = app.align_cards(photo)
+
+    assert len(cards) == 4
+    for (aligned, template, info), truth in zip(cards, truths):
+        corners = np.array(truth["corners"], dtype="float32")
+        width = np.linalg.norm(corners[1] - corners[0])
+        assert info["card_found"]
+        assert np.abs(info["quad"] - corners).max() <= width * ALIGN_TOLERANCE
+        assert template["name"] == truth["template"]
+        assert aligned.shape[:2] == (app.CARD_SIZE[1], app.CARD_SIZE[0])
+
+
+def test_align_cards_single_card_is_one_entry():
+    [(photo, truth)] = synthetic_cards.generate(1, seed=3)
+    [(_, template, info)] = app.align_cards(photo)
+
+    assert info["card_found"]
+    assert template["name"] == truth["template"]
@@ -0,0 +1,29 @@
+"""OCR結果キャッシュの保存期間・サイズ上限のテスト"""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def ocr_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "OCR_CACHE_PATH", str(tmp_path / "ocr_cache.sqlite3"))
+    app.get_ocr_cache.clear()
+    yield app.get_ocr_cache()
+    app.get_ocr_cache.clear()
+
+
+def test_expired_entries_are_not_returned_and_are_deleted(ocr_cache):
+    app.ocr_cache_put({"old": "沖縄太郎", "new": "那覇花子"})
+    ocr_cache["conn"].execute("UPDATE ocr_cache SET last_used = last_used - ? WHERE key = 'old'",
+                              (app.PERSONAL_DATA_RETENTION_SEC + 1,))
+    assert app.ocr_cache_get(["old", "new"]) == {"new": "那覇花子"}  # 期限切れは使わない
+
+    app.ocr_cache_put({"next": "名護一郎"})
+    keys = {key for (key,) in ocr_cache["conn"].execute("SELECT key FROM ocr_cache")}
+    assert keys == {"new", "next"}
+
+
+def test_size_limit_evicts_least_recently_used(ocr_cache, monkeypatch):
+    monkeypatch.setattr(app, "OCR_CACHE_MAX_BYTES", 1)
+    app.ocr_cache_put({"a": "テキスト"})
+    assert app.ocr_cache_stats()["entries"] == 0
@@ -0,0 +1,259 @@
+"""転記キュー (アウトボックス) と空き行キャッシュのテスト。スプレッドシートの代わりにスタブのワークシートを使う"""
+import re
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+class StubAPIError(Exception):
+    """gspread.exceptions.APIError と同じく response.status_code を持つ例外"""
+
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.response = SimpleNamespace(status_code=status)
+
+
+class StubWorksheet:
+    """A列から書き込む行だけを扱うワークシートのスタブ。呼び出しを calls に記録する"""
+
+    def __init__(self, title, rows=None):
+        self.title = title
+        self.rows = [list(r) for r in rows or [["見出し"]]]
+        self.calls = []
+        self.fail = None  # 行データを受け取り、送出する例外 (または None) を返す関数
+
+    def _check(self, rows):
+        if self.fail:
+            for values in rows:
+                error = self.fail(values)
+                if error:
+                    raise error
+
+    def col_values(self, col):
+        self.calls.append("col_values")
+        values = [r[0] if r else "" for r in self.rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def get(self, a1):
+        self.calls.append(f"get {a1}")
+        first, last = map(int, re.findall(r"\d+", a1))
+        values = [[self.rows[i][0]] if i < len(self.rows) and self.rows[i] and self.rows[i][0] else []
+                  for i in range(first - 1, last)]
+        while values and not values[-1]:
+            values.pop()  # 末尾の空行は返されない
+        return values
+
+    def get_values(self, a1):
+        self.calls.append(f"get_values {a1}")
+        return [list(r) for r in self.rows]
+
+    def batch_update(self, data):
+        self._check([d["values"][0] for d in data])
+        self.calls.append("batch_update")
+        for d in data:
+            row = int(d["range"][1:])
+            while len(self.rows) < row:
+                self.rows.append([])
+            self.rows[row - 1] = list(d["values"][0])
+
+    def append_rows(self, rows):
+        self._check(rows)
+        self.calls.append("append_rows")
+        self.rows.extend(list(r) for r in rows)
+
+
+@pytest.fixture
+def sheets(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "OUTBOX_PATH", str(tmp_path / "outbox.sqlite3"))
+    monkeypatch.setattr(app, "SHEET_INDEX_PATH", str(tmp_path / "sheet_index.sqlite3"))
+    app.get_outbox.clear()
+    app.get_sheet_index.clear()
+    worksheets = {"シート1": StubWorksheet("シート1"), "OCR_LOG": StubWorksheet("OCR_LOG")}
+    handles = {name: {"ws": ws, "fallback": False, "next_row": None, "gaps": [], "tail": None, "lock": threading.Lock()}
+               for name, ws in worksheets.items()}
+    monkeypatch.setattr(app, "get_worksheet", lambda credentials, sheet_name: handles[sheet_name])
+    monkeypatch.setattr(app, "reset_sheet_handles", lambda: None)
+    yield worksheets
+    app.get_outbox.clear()
+    app.get_sheet_index.clear()
+
+
+def main_row(name):
+    return [name, "", "", "", "", "090-0000-0000", "", "2026/10/17", "", "未選択"]
+
+
+def test_find_free_rows_scans_once_then_checks_window():
+    ws = StubWorksheet("シート1", [["見出し"], ["a"], [""], ["b"]])
+    handle = {"ws": ws, "next_row": None, "gaps": [], "tail": None}
+    assert app.find_free_rows(handle, 3) == [3, 5, 6]
+    assert ws.calls == ["col_values"]
+
+    ws.rows[2] = ["手入力"]  # キャッシュ位置の行が埋まっていれば飛ばす
+    handle["next_row"] = 3
+    assert app.find_free_rows(handle, 2) == [5, 6]
+    assert ws.calls[1:] == [f"get A3:A{3 + app.FREE_ROW_CHECK_WINDOW - 1}"]
+
+
+def test_find_free_rows_rescans_when_window_check_runs_long():
+    ws = StubWorksheet("シート1", [["見出し"]] + [["済"]] * 200)
+    handle = {"ws": ws, "next_row": 2, "gaps": [], "tail": 2}  # 手入力で大きく埋まった古いキャッシュ
+    assert app.find_free_rows(handle, 1) == [202]
+    assert ws.calls.count("col_values") == 1
+    assert len(ws.calls) == app.FREE_ROW_CHECK_MAX_WINDOWS + 1
+
+
+def test_write_sheet_rows_jumps_from_top_gap_to_known_tail(sheets):
+    ws = sheets["シート1"]
+    ws.rows.extend([["済"]] * 3000)
+    ws.rows[4] = [""]  # 5行目だけ空欄
+    _, targets, _ = app.write_sheet_rows(None, [main_row("一")])
+    assert targets == [5]
+    _, targets, _ = app.write_sheet_rows(None, [main_row("二")])
+    assert targets == [3002]
+    _, targets, _ = app.write_sheet_rows(None, [main_row("三")])
+    assert targets == [3003]
+    reads = [call for call in ws.calls if call.startswith(("get ", "col_values"))]
+    assert reads == ["col_values", "get A3002:A3021", "get A3003:A3022"]
+
+
+def test_write_sheet_rows_advances_cached_row(sheets):
+    ws = sheets["シート1"]
+    _, targets, _ = app.write_sheet_rows(None, [main_row("一"), main_row("二")])
+    assert targets == [2, 3]
+    _, targets, _ = app.write_sheet_rows(None, [main_row("三")])
+    assert targets == [4]
+    assert ws.calls.count("col_values") == 1  # 2回目以降は A 列全体を読まない
+    assert [r[0] for r in ws.rows] == ["見出し", "一", "二", "三"]
+
+
+def test_flush_writes_and_deletes_rows(sheets):
+    app.enqueue_sheet_rows([("main", main_row("沖縄太郎")), ("log", ["ts", "line"])])
+    assert app.outbox_depth() == {"main": 1, "log": 1}
+    assert app.flush_outbox(None) == 2
+    assert app.outbox_depth() == {"main": 0, "log": 0}
+    assert sheets["シート1"].rows[1][0] == "沖縄太郎"
+    assert sheets["OCR_LOG"].rows[1] == ["ts", "line"]
+    assert app.flush_outbox(None) == 0
+
+
+def test_retryable_error_keeps_rows_and_other_target_is_flushed(sheets):
+    sheets["シート1"].fail = lambda values: StubAPIError(503)
+    app.enqueue_sheet_rows([("main", main_row("沖縄太郎")), ("log", ["ts", "line"])])
+    with pytest.raises(StubAPIError):
+        app.flush_outbox(None)
+    assert app.outbox_depth() == {"main": 1, "log": 0}  # メインの失敗でログを止めない
+    assert app.outbox_depth("outbox_dead") == {"main": 0, "log": 0}
+    assert "503" in app.get_outbox()["last_error"]
+
+    sheets["シート1"].fail = None
+    assert app.flush_outbox(None) == 1
+    assert app.outbox_depth() == {"main": 0, "log": 0}
+    assert app.get_outbox()["last_error"] is None
+
+
+def test_rejected_row_is_dead_lettered_without_blocking_queue(sheets):
+    sheets["シート1"].fail = lambda values: StubAPIError(400) if values[0] == "保護" else None
+    app.enqueue_sheet_rows([("main", main_row("一")), ("main", main_row("保護")), ("main", main_row("三"))])
+    with pytest.raises(StubAPIError):
+        app.flush_outbox(None)
+    assert app.outbox_depth() == {"main": 0, "log": 0}
+    assert [r[0] for r in sheets["シート1"].rows[1:]] == ["一", "三"]
+    [dead] = app.dead_letter_rows()
+    assert dead["values"][0] == "保護" and dead["target"] == "main" and "400" in dead["error"]
+
+    # 原因を直してから再送すると書き込まれる
+    sheets["シート1"].fail = None
+    assert app.requeue_dead_letters() == 1
+    assert app.dead_letter_rows() == []
+    assert app.flush_outbox(None) == 1
+    assert [r[0] for r in sheets["シート1"].rows[1:]] == ["一", "三", "保護"]
+
+
+def test_row_status_follows_queued_rows_until_sent_or_held(sheets):
+    sheets["シート1"].fail = lambda values: StubAPIError(400) if values[0] == "保護" else None
+    ids = app.enqueue_sheet_rows([("main", main_row("一")), ("log", ["ts", "line"]), ("main", main_row("保護"))])
+    main_ids = [ids[0], ids[2]]
+    assert app.outbox_row_status(main_ids) == {"pending": 2, "held": 0, "sent": 0}  # 登録しただけでは未送信
+    with pytest.raises(StubAPIError):
+        app.flush_outbox(None)
+    assert app.outbox_row_status(main_ids) == {"pending": 0, "held": 1, "sent": 1}
+    assert app.outbox_row_status([ids[0]]) == {"pending": 0, "held": 0, "sent": 1}
+
+
+def test_unknown_error_is_dead_lettered_after_max_attempts(sheets):
+    sheets["OCR_LOG"].fail = lambda values: RuntimeError("broken")
+    app.enqueue_sheet_rows([("log", ["ts", "line"])])
+    for _ in range(app.OUTBOX_MAX_ATTEMPTS - 1):
+        with pytest.raises(RuntimeError):
+            app.flush_outbox(None)
+        assert app.outbox_depth()["log"] == 1
+    with pytest.raises(RuntimeError):
+        app.flush_outbox(None)
+    assert app.outbox_depth()["log"] == 0
+    [dead] = app.dead_letter_rows()
+    assert dead["attempts"] == app.OUTBOX_MAX_ATTEMPTS
+
+
+def refresh_error_from_5xx():
+    from google.auth.exceptions import RefreshError
+    return RefreshError("Internal Server Error", {"error": "server_error"}, retryable=True)
+
+
+def transport_error_on_refresh():
+    from google.auth.exceptions import TransportError
+    return TransportError("Connection reset by peer")
+
+
+@pytest.mark.parametrize("make_error", [lambda: StubAPIError(503), transport_error_on_refresh, refresh_error_from_5xx],
+                         ids=["http-503", "token-transport", "token-5xx"])
+def test_retryable_error_is_not_counted_towards_max_attempts(sheets, make_error):
+    error = make_error()
+    sheets["シート1"].fail = lambda values: error
+    app.enqueue_sheet_rows([("main", main_row("沖縄太郎"))])
+    for _ in range(app.OUTBOX_MAX_ATTEMPTS * 2):
+        with pytest.raises(type(error)):
+            app.flush_outbox(None)
+    assert app.outbox_depth()["main"] == 1  # 障害が長引いても保留に移さない
+    assert app.dead_letter_rows() == []
+
+    sheets["シート1"].fail = None
+    assert app.flush_outbox(None) == 1
+    assert sheets["シート1"].rows[1][0] == "沖縄太郎"
+
+
+def test_sheet_sink_reports_rows_held_while_draining(sheets, monkeypatch):
+    import bulk_ingest
+    monkeypatch.setattr(app, "start_outbox_flusher", lambda credentials: None)
+    sheets["シート1"].fail = lambda values: StubAPIError(400) if values[0] == "保護" else None
+    sink = bulk_ingest.SheetSink(None, allow_duplicates=True)
+    for name in ("一", "保護"):
+        sink.write({"data": {"氏名": name}, "raw_text": name, "source": f"{name}.jpg"})
+    sink.close()
+    assert app.outbox_depth() == {"main": 0, "log": 0}
+    assert [(row["target"], row["values"][0]) for row in sink.held] == [("main", "保護")]
+
+
+def test_sheet_index_is_refreshed_in_background_and_kept_on_disk(sheets):
+    sheets["シート1"].rows.append(main_row("沖縄太郎"))
+    with pytest.raises(LookupError):
+        app.find_duplicate_row(main_row("沖縄太郎"))  # 未読み込みでも照合のためにシートは読まない
+    assert not any(call.startswith("get_values") for call in sheets["シート1"].calls)
+
+    app.enqueue_sheet_rows([("main", main_row("那覇花子"))])
+    app.refresh_sheet_index(None)
+    assert app.find_duplicate_row(main_row("沖縄太郎")) == "シート1 の 2 行目"
+    assert app.find_duplicate_row(main_row("那覇花子")) == "転記キュー (未送信)"
+    assert app.find_duplicate_row(main_row("名護一郎")) is None
+
+    app.flush_outbox(None)
+    # 再起動後 (プロセス共通の索引を作り直しても) ディスクの内容で照合でき、期限内ならシートを読み直さない
+    app.get_sheet_index.clear()
+    calls = len(sheets["シート1"].calls)
+    app.refresh_sheet_index(None)
+    assert app.find_duplicate_row(main_row("那覇花子")) == "シート1 の 3 行目"
+    assert sheets["シート1"].calls[calls:] == []